@@ -0,0 +1,115 @@
+'''
+print -- CSLabs Print Server
+admission -- Admission Control
+
+This module decides whether the server should accept more work right now, so that a
+burst of expensive submissions is turned away quickly instead of piling up inside the
+request workers.
+
+Two mechanisms are provided:
+
+-The RateLimiter, which keeps a token bucket per key (the print view uses the user ID).
+ Each bucket holds up to "burst" tokens and refills at "rate" tokens per second; every
+ accepted submission takes one token.
+-The ConcurrencyLimit, which allows at most "limit" holders at a time (the print view
+ keeps one for soffice conversions, which preview rendering shares; jobs reach CUPS
+ through fairshare instead). A caller waits at most "wait" seconds for a free slot.
+
+Both raise Busy when the request must be refused. Busy.retry_after is the number of
+seconds after which the client should try again; the print view turns this into a 429
+response with a Retry-After header.
+
+	limiter.Check(user.id)
+	with conversions:
+		convert()
+
+A caller that can use several slots at once (a merged job converts its members in
+parallel) takes them with AcquireUpTo(n), which only ever waits for the first, and gives
+them back with Release(n).
+'''
+
+import threading
+import time
+import math
+
+class Busy(Exception):
+	def __init__(self, what, retry_after):
+		Exception.__init__(self, what, retry_after)
+		self.what        = what
+		self.retry_after = int(math.ceil(retry_after))
+
+class TokenBucket(object):
+	def __init__(self, rate, burst, now):
+		self.rate   = rate
+		self.burst  = burst
+		self.tokens = float(burst)
+		self.stamp  = now
+	def Refill(self, now):
+		self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+		self.stamp  = now
+	def Take(self, now):
+		self.Refill(now)
+		if self.tokens >= 1:
+			self.tokens -= 1
+			return 0
+		return (1 - self.tokens) / self.rate
+
+class RateLimiter(object):
+	# Full buckets are dropped once this many are held, to keep memory bounded
+	PRUNE_SIZE = 1024
+	def __init__(self, rate, burst):
+		self.rate    = rate
+		self.burst   = burst
+		self.buckets = {}
+		self.lock    = threading.Lock()
+	def Check(self, key):
+		now = time.time()
+		with self.lock:
+			bucket = self.buckets.get(key)
+			if bucket is None:
+				if len(self.buckets) >= self.PRUNE_SIZE:
+					self._prune(now)
+				bucket = self.buckets[key] = TokenBucket(self.rate, self.burst, now)
+			wait = bucket.Take(now)
+		if wait:
+			raise Busy('rate', wait)
+	def _prune(self, now):
+		for key, bucket in self.buckets.items():
+			bucket.Refill(now)
+			if bucket.tokens >= bucket.burst:
+				del self.buckets[key]
+
+class ConcurrencyLimit(object):
+	def __init__(self, what, limit, wait, retry_after):
+		self.what        = what
+		self.limit       = limit
+		self.wait        = wait
+		self.retry_after = retry_after
+		self.active      = 0
+		self.cond        = threading.Condition()
+	def Acquire(self):
+		deadline = time.time() + self.wait
+		with self.cond:
+			while self.active >= self.limit:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					raise Busy(self.what, self.retry_after)
+				self.cond.wait(remaining)
+			self.active += 1
+	def AcquireUpTo(self, n):
+		'''Takes one slot (waiting as Acquire does) and up to n-1 more that are free now; returns the number taken.'''
+		self.Acquire()
+		with self.cond:
+			extra = max(0, min(n - 1, self.limit - self.active))
+			self.active += extra
+		return 1 + extra
+	def Release(self, n=1):
+		with self.cond:
+			self.active -= n
+			self.cond.notify(n)
+	def __enter__(self):
+		self.Acquire()
+		return self
+	def __exit__(self, *exc):
+		self.Release()
+		return False
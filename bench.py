@@ -0,0 +1,440 @@
+'''
+print -- CSLabs Print Server
+bench -- Benchmarks
+
+This script holds the print server's benchmarks. Each is run by name:
+
+	python bench.py <benchmark> [options]
+
+and prints its results as a table. The benchmarks are self-contained; they do not write
+to the user or session databases or touch any printer. The following are defined:
+
+-async compares how many concurrent submissions one worker can carry with print.app on a
+ fixed pool of threads (the uwsgi --threads model) and with serve.py's app on gevent.
+ Each submission is a real POST to the print page of one or more RTF files, which go
+ through sniffing, admission control, conversion (through runner, and convert.mapper
+ or the pool for several files), the scheduler and IPP. soffice is replaced by a
+ script that waits and writes a one-page PDF, and CUPS by FakeIPPServer. The server
+ runs in a process of its own, as root, through a session in the memory store; its
+ directories are temporary, and its conversion and rate limits are lifted, so that
+ admission control refuses nothing.
+-ipp compares submitting jobs with ipp.IPPClient over one persistent connection, with a
+ new IPPClient (and connection) per job, and by forking a process per job the way lp is
+ run; all against FakeIPPServer, a local stand-in for cupsd. If lp is installed it is
+ pointed at the fake server; otherwise "sh -c 'cat FILE'" stands in for its fork and
+ exec. It also times batched status queries (IPPClient.JobStates).
+-sessions compares the session stores of sessionstore: each thread creates sessions,
+ looks each one up several times (as every request does) and updates it (as logging in
+ does). The sqlite store runs on a temporary database file.
+-render measures print.app (through Flask's test client) serving the main page
+ (print_main) and the print page (op_print) to an anonymous user, in debug mode (see
+ conf.DEBUG: templates checked for changes on every render, nothing cached) and in
+ production (templates compiled at import through a bytecode cache, and the parts that
+ are the same for every user rendered once), the latter with an empty and with a full
+ cache. Each mode runs in a process of its own, with sessions kept in memory; it only
+ reads the user database. It also reports whether the app's Jinja environment has the
+ bytecode cache, and how long importing print.py took.
+'''
+
+import os
+import sys
+import time
+import socket
+import argparse
+import json
+import threading
+import subprocess
+import urllib2
+import tempfile
+import shutil
+import sqlite3
+import BaseHTTPServer
+import SocketServer
+
+import ipp
+import sessionstore
+
+BENCHMARKS = {}
+
+def benchmark(f):
+	BENCHMARKS[f.__name__.partition('_')[2]] = f
+	return f
+
+def free_port():
+	s = socket.socket()
+	s.bind(('127.0.0.1', 0))
+	port = s.getsockname()[1]
+	s.close()
+	return port
+
+def wait_for_port(port, timeout=10):
+	deadline = time.time() + timeout
+	while time.time() < deadline:
+		try:
+			socket.create_connection(('127.0.0.1', port), 0.5).close()
+			return
+		except socket.error:
+			time.sleep(0.05)
+	raise RuntimeError('Server on port %d did not start'%(port,))
+
+# Builds a multipart/form-data body holding files, a list of (filename, data); returns
+# (body, content type)
+def multipart(files):
+	boundary = 'benchboundary'
+	parts = ['--%s\r\nContent-Disposition: form-data; name="file"; filename="%s"\r\nContent-Type: application/octet-stream\r\n\r\n%s\r\n'%(boundary, name, data) for name, data in files]
+	parts.append('--%s--\r\n'%(boundary,))
+	return ''.join(parts), 'multipart/form-data; boundary='+boundary
+
+# Fires n requests at once, request(i) being the i-th; returns (seconds until all
+# completed, failures), where a request fails unless its response contains expect
+def fire(request, n, timeout, expect=''):
+	failures = [0]
+	def one(i):
+		try:
+			if expect not in urllib2.urlopen(request(i), timeout=timeout).read():
+				failures[0] += 1
+		except Exception:
+			failures[0] += 1
+	threads = [threading.Thread(target=one, args=(i,)) for i in xrange(n)]
+	start = time.time()
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	return time.time() - start, failures[0]
+
+# A minimal IPP server that accepts every job and remembers it, standing in for cupsd; jobs
+# submitted held stay so until released
+class FakeIPPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	def __init__(self):
+		BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FakeIPPHandler)
+		self.jobs = []
+		self.held = set()
+		self.lock = threading.Lock()
+		thread = threading.Thread(target=self.serve_forever)
+		thread.daemon = True
+		thread.start()
+	@property
+	def address(self):
+		return self.server_address
+	# Clients dropping their connections (as the async benchmark's servers do when they
+	# are stopped) is not an error here
+	def handle_error(self, request, client_address):
+		pass
+
+class FakeIPPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+	wbufsize = -1
+	def log_message(self, *args):
+		pass
+	def do_POST(self):
+		body = self.rfile.read(int(self.headers['Content-Length']))
+		code, request_id, groups, data = ipp.decode(body)
+		rgroups = [(ipp.TAG_OPERATION, [(ipp.TAG_CHARSET, 'attributes-charset', ['utf-8']), (ipp.TAG_LANGUAGE, 'attributes-natural-language', ['en'])])]
+		status = 0
+		if code == ipp.OP_CUPS_GET_DEFAULT:
+			rgroups.append((ipp.TAG_PRINTER, [(ipp.TAG_NAME, 'printer-name', ['fake'])]))
+		elif code == ipp.OP_PRINT_JOB:
+			held = any(gtag == ipp.TAG_JOB and attrs.get('job-hold-until') == ['indefinite'] for gtag, attrs in groups)
+			with self.server.lock:
+				self.server.jobs.append(len(data))
+				job_id = len(self.server.jobs)
+				if held:
+					self.server.held.add(job_id)
+			rgroups.append((ipp.TAG_JOB, [(ipp.TAG_INTEGER, 'job-id', [job_id]), (ipp.TAG_ENUM, 'job-state', [4 if held else 3])]))
+		elif code == ipp.OP_RELEASE_JOB:
+			job_id = dict(groups).get(ipp.TAG_OPERATION, {}).get('job-id', [0])[0]
+			with self.server.lock:
+				if job_id in self.server.held:
+					self.server.held.remove(job_id)
+				else:
+					# client-error-not-possible
+					status = 0x040C
+		elif code == ipp.OP_GET_JOBS:
+			with self.server.lock:
+				jobs = [(job_id, size, job_id in self.server.held) for job_id, size in enumerate(self.server.jobs, 1)]
+			for job_id, size, held in jobs:
+				rgroups.append((ipp.TAG_JOB, [(ipp.TAG_INTEGER, 'job-id', [job_id]), (ipp.TAG_ENUM, 'job-state', [4 if held else 9]), (ipp.TAG_NAME, 'job-originating-user-name', ['root']), (ipp.TAG_INTEGER, 'job-k-octets', [size // 1024])]))
+		resp = ipp.encode(status, request_id, rgroups)
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/ipp')
+		self.send_header('Content-Length', str(len(resp)))
+		self.end_headers()
+		self.wfile.write(resp)
+
+def which(name):
+	for d in os.environ.get('PATH', '').split(os.pathsep):
+		if os.access(os.path.join(d, name), os.X_OK):
+			return os.path.join(d, name)
+	return None
+
+# Builds a one-page PDF
+def minimal_pdf():
+	objs = ['<< /Type /Catalog /Pages 2 0 R >>', '<< /Type /Pages /Kids [3 0 R] /Count 1 >>', '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] >>']
+	out = '%PDF-1.4\n'
+	offsets = []
+	for i, obj in enumerate(objs):
+		offsets.append(len(out))
+		out += '%d 0 obj\n%s\nendobj\n'%(i+1, obj)
+	xref = len(out)
+	out += 'xref\n0 %d\n0000000000 65535 f \n'%(len(objs)+1,) + ''.join('%010d 00000 n \n'%(o,) for o in offsets)
+	return out + 'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n'%(len(objs)+1, xref)
+
+# Stands in for soffice in the async benchmark: waits $BENCH_DELAY seconds, then writes
+# the PDF next to it to the output directory, named after the input
+FAKE_SOFFICE = """#!/bin/sh
+while [ $# -gt 1 ]; do
+	if [ "$1" = --outdir ]; then outdir=$2; fi
+	shift
+done
+sleep "$BENCH_DELAY"
+base=$(basename "$1")
+cp "$(dirname "$0")/page.pdf" "$outdir/${base%.*}.pdf"
+"""
+
+# Points the print server's configuration at temporary directories and the fake IPP
+# server, keeps sessions in memory and lifts the admission limits (see bench_async)
+def bench_conf(tmpdir, ipp_port):
+	import conf
+	for name in ('SPOOL_DIR', 'PREVIEW_DIR', 'PROFILE_DIR', 'BACKUP_DIR', 'TEMPLATE_CACHE_DIR'):
+		setattr(conf, name, os.path.join(tmpdir, name.lower()))
+	conf.DEBUG = False
+	conf.SESSION_BACKEND = 'memory'
+	conf.SPOOLER = 'ipp'
+	conf.IPP_SOCKET = ('127.0.0.1', ipp_port)
+	conf.IPP_PRINTER = 'fake'
+	conf.MAX_CONVERSIONS = 1 << 20
+	conf.RATE_LIMIT_BURST = 1 << 20
+
+# Prints the ID of a new session of root, for the client to send as its cookie
+def root_session():
+	from sessiondb import Session
+	from userdb import User
+	print Session.Create(User.ROOT).id
+	sys.stdout.flush()
+
+def serve_threads(port, threads):
+	from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+	from multiprocessing.pool import ThreadPool
+	app = __import__('print').app
+	root_session()
+	class QuietHandler(WSGIRequestHandler):
+		def log_message(self, *args):
+			pass
+	class PoolServer(WSGIServer):
+		request_queue_size = 1024
+		pool = ThreadPool(threads)
+		def process_request(self, request, client_address):
+			self.pool.apply_async(self._process, (request, client_address))
+		def _process(self, request, client_address):
+			try:
+				self.finish_request(request, client_address)
+			finally:
+				self.shutdown_request(request)
+	make_server('127.0.0.1', port, app, PoolServer, QuietHandler).serve_forever()
+
+def serve_gevent(port):
+	# Importing serve monkey-patches the standard library and sets up convert.mapper
+	import serve
+	import gevent.pool
+	from gevent.pywsgi import WSGIServer
+	root_session()
+	WSGIServer(('127.0.0.1', port), serve.app, spawn=gevent.pool.Pool(serve.conf.ASYNC_CONNECTIONS), log=None).serve_forever()
+
+@benchmark
+def bench_async(argv):
+	parser = argparse.ArgumentParser(prog='bench.py async')
+	parser.add_argument('--threads', type=int, default=8, help='threads in the thread model (default 8)')
+	parser.add_argument('--delay', type=float, default=0.5, help='seconds each conversion takes (default 0.5)')
+	parser.add_argument('--files', type=int, default=1, help='files per submission, merged into one job (default 1)')
+	parser.add_argument('--concurrency', default='8,32,128', help='comma-separated numbers of simultaneous submissions')
+	args = parser.parse_args(argv)
+	server = FakeIPPServer()
+	tmpdir = tempfile.mkdtemp()
+	with open(os.path.join(tmpdir, 'page.pdf'), 'wb') as f:
+		f.write(minimal_pdf())
+	with open(os.path.join(tmpdir, 'soffice'), 'w') as f:
+		f.write(FAKE_SOFFICE)
+	os.chmod(os.path.join(tmpdir, 'soffice'), 0755)
+	env = dict(os.environ, PATH=tmpdir+os.pathsep+os.environ.get('PATH', ''), BENCH_DELAY=str(args.delay))
+	counter = [0]
+	def submission(port, sid):
+		def request(i):
+			counter[0] += 1
+			# Distinct contents, so that no submission is a duplicate
+			body, ctype = multipart([('doc%d.rtf'%(j,), '{\\rtf1 document %d part %d}'%(counter[0], j)) for j in xrange(args.files)])
+			return urllib2.Request('http://127.0.0.1:%d/print/op/print/'%(port,), body, {'Content-Type': ctype, 'Cookie': 'session='+sid})
+		return request
+	print 'Each conversion takes %.2fs, %d file(s) per submission; thread model has %d threads.'%(args.delay, args.files, args.threads)
+	print '{model:10}{n:>8}{secs:>10}{rate:>12}{fail:>8}'.format(model='MODEL', n='CONC', secs='SECONDS', rate='REQ/S', fail='FAILED')
+	try:
+		for model in ('threads', 'gevent'):
+			port = free_port()
+			proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), '_serve', model, str(port), str(args.threads), tmpdir, str(server.address[1])], stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'), env=env)
+			try:
+				sid = proc.stdout.readline().strip()
+				wait_for_port(port)
+				for n in [int(c) for c in args.concurrency.split(',')]:
+					secs, failed = fire(submission(port, sid), n, 120, 'Queued for printing')
+					print '{model:10}{n:>8}{secs:>10.2f}{rate:>12.1f}{fail:>8}'.format(model=model, n=n, secs=secs, rate=n/secs, fail=failed)
+			finally:
+				proc.terminate()
+				proc.wait()
+		print '%d jobs reached the fake CUPS server; %d were released'%(len(server.jobs), len(server.jobs)-len(server.held))
+	finally:
+		shutil.rmtree(tmpdir, True)
+
+@benchmark
+def bench_ipp(argv):
+	parser = argparse.ArgumentParser(prog='bench.py ipp')
+	parser.add_argument('--jobs', type=int, default=200, help='jobs submitted per method (default 200)')
+	parser.add_argument('--size', type=int, default=64*1024, help='size of each document in bytes')
+	args = parser.parse_args(argv)
+	server = FakeIPPServer()
+	host, port = server.address
+	doc = tempfile.NamedTemporaryFile(suffix='.pdf')
+	doc.write(os.urandom(args.size))
+	doc.flush()
+	attrs = [(ipp.TAG_INTEGER, 'copies', [1]), (ipp.TAG_KEYWORD, 'sides', ['one-sided'])]
+	lp = which('lp')
+	if lp:
+		fork_cmd, fork_name = [lp, '-h', '%s:%d'%(host, port), '-d', 'fake', doc.name], 'fork lp'
+	else:
+		fork_cmd, fork_name = ['sh', '-c', 'cat "$0" >/dev/null', doc.name], 'fork sh'
+	client = ipp.IPPClient((host, port))
+	def persistent():
+		client.PrintJob(doc.name, 'bench', 'bench', attrs)
+	def reconnect():
+		other = ipp.IPPClient((host, port), 'fake')
+		other.PrintJob(doc.name, 'bench', 'bench', attrs)
+		other.Close()
+	def fork():
+		subprocess.call(fork_cmd, stdout=open(os.devnull, 'w'))
+	print '%d jobs of %d bytes each%s'%(args.jobs, args.size, '' if lp else ' (lp not installed; sh stands in for its fork)')
+	print '{method:20}{secs:>10}{per:>12}'.format(method='METHOD', secs='SECONDS', per='MS/JOB')
+	for name, func in (('ipp persistent', persistent), ('ipp new connection', reconnect), (fork_name, fork)):
+		start = time.time()
+		for i in xrange(args.jobs):
+			func()
+		secs = time.time() - start
+		print '{method:20}{secs:>10.3f}{per:>12.3f}'.format(method=name, secs=secs, per=1000*secs/args.jobs)
+	ids = range(1, len(server.jobs)+1)
+	start = time.time()
+	states = client.JobStates(ids)
+	print 'JobStates for %d jobs: %.3f ms in one Get-Jobs request'%(len(states), 1000*(time.time()-start))
+	client.Close()
+	server.shutdown()
+	server.server_close()
+
+@benchmark
+def bench_sessions(argv):
+	parser = argparse.ArgumentParser(prog='bench.py sessions')
+	parser.add_argument('--sessions', type=int, default=2000, help='sessions created per thread (default 2000)')
+	parser.add_argument('--lookups', type=int, default=10, help='lookups of each session (default 10)')
+	parser.add_argument('--threads', default='1,8', help='comma-separated numbers of threads')
+	args = parser.parse_args(argv)
+	dbfile = tempfile.NamedTemporaryFile(suffix='.db')
+	init = sqlite3.connect(dbfile.name)
+	init.execute('CREATE TABLE sessions (id INTEGER PRIMARY KEY, uid INTEGER)')
+	init.commit()
+	init.close()
+	backends = (
+		('sqlite', lambda: sessionstore.SqliteBackend(dbfile.name)),
+		('memory', sessionstore.MemoryBackend),
+		('cookie', lambda: sessionstore.SignedCookieBackend(os.urandom(32), 3600)),
+	)
+	print '%d sessions per thread, each looked up %d times and updated once'%(args.sessions, args.lookups)
+	print '{backend:10}{threads:>8}{secs:>10}{ops:>10}{create:>12}{lookup:>12}{update:>12}'.format(backend='BACKEND', threads='THREADS', secs='SECONDS', ops='OPS/S', create='CREATE US', lookup='LOOKUP US', update='UPDATE US')
+	for name, make in backends:
+		for nthreads in [int(t) for t in args.threads.split(',')]:
+			backend = make()
+			times = {'create': [], 'lookup': [], 'update': []}
+			def work():
+				start = time.time()
+				ids = [str(backend.Create(i)) for i in xrange(args.sessions)]
+				lap = time.time()
+				times['create'].append(lap - start)
+				for i in xrange(args.lookups):
+					for id in ids:
+						if backend.Get(id) is None:
+							raise RuntimeError('Session %s was lost'%(id,))
+				start, lap = lap, time.time()
+				times['lookup'].append(lap - start)
+				for id in ids:
+					backend.Update(backend.Get(id)[0], 0)
+				times['update'].append(time.time() - lap)
+			threads = [threading.Thread(target=work) for i in xrange(nthreads)]
+			start = time.time()
+			for t in threads:
+				t.start()
+			for t in threads:
+				t.join()
+			secs = time.time() - start
+			ops = nthreads * args.sessions * (args.lookups + 3)
+			# Mean latency of one operation, in microseconds
+			us = lambda op, n: 1e6 * sum(times[op]) / (nthreads * n)
+			print '{backend:10}{threads:>8}{secs:>10.3f}{ops:>10.0f}{create:>12.1f}{lookup:>12.1f}{update:>12.1f}'.format(backend=name, threads=nthreads, secs=secs, ops=ops/secs, create=us('create', args.sessions), lookup=us('lookup', args.sessions*args.lookups), update=us('update', args.sessions))
+
+# Runs in a process of its own (see bench_render): imports print.app in the given mode and
+# requests each page, printing the timings as JSON
+def render_worker(debug, cachedir, requests):
+	import conf
+	conf.DEBUG = debug
+	conf.TEMPLATE_CACHE_DIR = cachedir
+	# So that the benchmark does not touch sessions.db
+	conf.SESSION_BACKEND = 'memory'
+	start = time.time()
+	module = __import__('print')
+	app = module.app
+	# Nor CUPS, for jobs to restore (see print.restore_jobs)
+	module.scheduler.restore = None
+	result = {'import': time.time() - start, 'bytecode_cache': app.jinja_env.bytecode_cache is not None, 'rates': {}}
+	client = app.test_client()
+	for page in RENDER_PAGES:
+		client.get(page)
+		start = time.time()
+		for i in xrange(requests):
+			resp = client.get(page)
+			if resp.status_code != 200:
+				raise RuntimeError('%s returned %d'%(page, resp.status_code))
+		result['rates'][page] = requests / (time.time() - start)
+	print json.dumps(result)
+
+# The main page (print_main) and the print page (op_print)
+RENDER_PAGES = ('/print/', '/print/op/print/')
+
+@benchmark
+def bench_render(argv):
+	parser = argparse.ArgumentParser(prog='bench.py render')
+	parser.add_argument('--requests', type=int, default=2000, help='requests for each page per mode (default 2000)')
+	args = parser.parse_args(argv)
+	cachedir = tempfile.mkdtemp()
+	runs = (('debug', True), ('production (cold)', False), ('production (warm)', False))
+	try:
+		print '%d requests for each page per mode'%(args.requests,)
+		print '{mode:20}{bcc:>10}{imp:>12}{main:>12}{page:>12}'.format(mode='MODE', bcc='BCCACHE', imp='IMPORT MS', main='MAIN/S', page='PRINT/S')
+		for name, debug in runs:
+			out = subprocess.check_output([sys.executable, os.path.abspath(__file__), '_render', '1' if debug else '0', cachedir, str(args.requests)])
+			result = json.loads(out.strip().splitlines()[-1])
+			print '{mode:20}{bcc:>10}{imp:>12.1f}{main:>12.0f}{page:>12.0f}'.format(mode=name, bcc='yes' if result['bytecode_cache'] else 'no', imp=1000*result['import'], main=result['rates'][RENDER_PAGES[0]], page=result['rates'][RENDER_PAGES[1]])
+	finally:
+		shutil.rmtree(cachedir)
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1 and sys.argv[1] == '_serve':
+		model, port, threads = sys.argv[2], int(sys.argv[3]), int(sys.argv[4])
+		bench_conf(sys.argv[5], int(sys.argv[6]))
+		if model == 'threads':
+			serve_threads(port, threads)
+		else:
+			serve_gevent(port)
+		sys.exit(0)
+	if len(sys.argv) > 1 and sys.argv[1] == '_render':
+		render_worker(sys.argv[2] == '1', sys.argv[3], int(sys.argv[4]))
+		sys.exit(0)
+	if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+		print 'Usage: python bench.py <benchmark> [options]'
+		print 'Benchmarks:', ', '.join(sorted(BENCHMARKS))
+		sys.exit(2)
+	BENCHMARKS[sys.argv[1]](sys.argv[2:])
@@ -15,8 +15,93 @@ The following are defined:
 -VER_CODE_LEN is the size of a verification code (in bytes, not in characters; it's
  usually b64 encoded).
 -MAINTAINERS is a list of emails that will receive messages sent through the contact form.
+-DEDUP_WINDOW is the number of seconds during which an identical submission (same user,
+ file contents and options) is treated as a duplicate and not printed again.
+-DEDUP_SIZE is the maximum number of recent submissions remembered for duplicate detection.
+-RATE_LIMIT_PER_MINUTE and RATE_LIMIT_BURST configure the per-user token bucket for print
+ submissions: a user may submit RATE_LIMIT_BURST jobs at once, after which they get
+ RATE_LIMIT_PER_MINUTE more every minute.
+-MAX_CONVERSIONS is the number of soffice conversions that may run at the same time in a
+ worker.
+-ADMISSION_WAIT is how long (in seconds) a submission may wait for a free conversion
+ slot before it is refused as busy, and BUSY_RETRY_AFTER is the retry delay (in
+ seconds) suggested to the client when that happens.
+-SPOOL_DIR is the directory in which resumable uploads are stored while they are in progress.
+-UPLOAD_CHUNK_SIZE is the size (in bytes) of each chunk of a resumable upload,
+ UPLOAD_MAX_SIZE is the largest document (in bytes) that may be uploaded that way, and
+ UPLOAD_EXPIRY is the number of seconds after its last chunk that an unfinished upload
+ is discarded.
+-IMAGE_EXTENSIONS are the (allowed) extensions of images, which are downsampled to
+ PRINTER_DPI and recompressed at JPEG quality IMAGE_QUALITY before they are spooled.
+-API_MAX_FILES is the largest number of files that may be submitted in one batch through
+ the JSON print API.
+-ARCHIVE_EXTENSIONS are the extensions of archives whose printable members are converted
+ and merged into one job, as are multiple files submitted together. CONVERT_WORKERS is
+ the number of processes converting such members in parallel; ARCHIVE_MAX_MEMBERS and
+ ARCHIVE_MAX_SIZE bound the number of members and the extracted size (in bytes) of an
+ archive.
+-ASYNC_CONNECTIONS is the number of requests served at once by serve.py (the gevent
+ server); each is a greenlet rather than a thread.
+-SPOOLER selects how jobs reach CUPS: 'ipp' submits them over IPP on the CUPS socket
+ IPP_SOCKET, to the printer IPP_PRINTER (or the CUPS default printer if None), falling
+ back to lp if that fails; 'lp' always runs lp. IPP_STATUS_TTL is how long (in seconds)
+ job states fetched from CUPS are reused before they are asked for again.
+-JOB_POLL_INTERVAL is how often (in seconds) the state of printing jobs is fetched from
+ CUPS, and JOB_STATUS_KEEP is the number of recent jobs per user whose state is kept.
+-SSE_DURATION is how long (in seconds) a job status event stream stays open before the
+ browser is asked to reconnect after SSE_RETRY seconds; SSE_KEEPALIVE is the longest
+ silence (in seconds) on a stream, and the longest wait of a long-poll request. Streams
+ are only kept open this long under serve.py, where a waiting request holds a greenlet
+ rather than a thread; otherwise no request (stream or poll) waits at all, and the print
+ page polls for job status every JOB_POLL_INTERVAL seconds instead.
+-SESSION_BACKEND selects where sessions are kept (see sessionstore): 'sqlite' in
+ sessions.db, 'memory' in the worker process (for tests only), or 'cookie' in the
+ session cookie itself, signed with SESSION_SECRET (which must then be set, to the same
+ value on every host) and valid for SESSION_MAX_AGE seconds.
+-SNIFF_SIZE is the number of bytes at the start of an upload that are examined to tell
+ whether its content matches its extension (see sniff).
+-CONVERT_TIMEOUT, CONVERT_MEMORY and CONVERT_CPU bound each conversion (soffice, ps2pdf,
+ pdfunite) in wall-clock seconds, bytes of address space and seconds of CPU time; the
+ process group of a conversion that exceeds them is killed (see runner). SPOOL_TIMEOUT
+ and SPOOL_MEMORY bound each lp run the same way.
+-PREVIEW_DIR is the directory in which page thumbnails are cached, and PREVIEW_CACHE_SIZE
+ the most it may hold (in bytes) before the least recently viewed documents are evicted.
+ PREVIEW_PAGES is the number of pages rendered from the start of a document and from its
+ page selection, at PREVIEW_DPI, by PREVIEW_WORKERS background threads per worker; at
+ most PREVIEW_QUEUE documents wait for them before previews are refused as busy.
+-USAGE_BATCH is the number of PyKota job history rows rolled up into the usage tables in
+ one transaction (see usage); the usage page rolls up at most one batch, when the last
+ refresh is older than USAGE_REFRESH_INTERVAL seconds. USAGE_DAYS is the number of days
+ shown by usage reports by default, and USAGE_TOP the number of users they list.
+-PROFILE_DIR holds the sampling profiler's control file and the samples of each worker
+ (see profiler). By default, profiling samples PROFILE_RATE of requests every
+ PROFILE_INTERVAL seconds, for PROFILE_DURATION seconds. Workers look for changes to the
+ control file every PROFILE_CHECK seconds and write their samples every PROFILE_FLUSH.
+-BACKUP_DIR is where database backups are written (see maint); the BACKUP_KEEP newest of
+ each database are kept. Backups copy BACKUP_STEP_PAGES pages at a time, BACKUP_STEP_SLEEP
+ seconds apart, and start over at most BACKUP_RESTARTS times when the database changes.
+ VACUUM_STEP_PAGES is the number of pages freed per incremental VACUUM transaction,
+ ANALYZE_LIMIT the number of rows of each index read by ANALYZE, and MAINT_BUSY_TIMEOUT
+ how long (in seconds) maintenance waits for a locked database. MAINT_INTERVAL is the
+ default time between runs of scheduled maintenance (the console's `maint every`).
+-SCHED_WINDOW is the number of jobs a worker lets CUPS print at once; the others wait
+ and are released in fair-share order (see fairshare). A job is released at the latest
+ after SCHED_MAX_WAIT seconds. Users are put in the classes of SCHED_CLASSES, which are
+ (pages, name) pairs, by the pages they submitted recently, which count for half every
+ SCHED_HALF_LIFE seconds; waits are reported per class. Waiting jobs are held in CUPS
+ rather than in the worker, so they survive restarts: when a worker starts, it queues
+ again every job held on the printer, which must not be used to hold jobs otherwise. The
+ scheduler runs on a thread of its own, as does the job status poller (see jobstatus),
+ so under uwsgi the server must be run with --enable-threads (see test.sh).
+-DEBUG turns on Flask's debug mode, in which templates are reloaded when they change and
+ nothing is cached. Otherwise every template is compiled once at startup, through a
+ bytecode cache in TEMPLATE_CACHE_DIR (so that restarted workers load them rather than
+ compile them again), and the parts of pages that are the same for every user are
+ rendered once (see print.cached_fragment).
 '''
 
+import os
+
 class ExtenAllowAll(object):
 	def __iter__(self):
 		return iter(['frickin\' everything'])
@@ -26,7 +111,8 @@ class ExtenAllowAll(object):
 DEFAULT_BALANCE = 200
 ALLOWED_EXTENSIONS = sorted(["txt", "pdf", "ps", "png", "jpg", "jpeg", "gif", "tex", "prn", "c", "cpp", "h", "hpp", "java", "pl", "py", "php", "sh", "b", "xml", "conf", "asm", "bat", "bib", "cs", "erl", "ini", "js", "lisp", "sql", "m", "pas", "patch", "pro", "scm", "hs", "sol"])
 CONVERTABLE_EXTENSIONS = sorted(["docx", "doc","odt","pptx","ppt","odp","xlsx","xls","ods","csv","odf","odg","rtf"])
-ALL_EXTENSIONS = sorted(ALLOWED_EXTENSIONS+CONVERTABLE_EXTENSIONS)
+ARCHIVE_EXTENSIONS = ["zip"]
+ALL_EXTENSIONS = sorted(ALLOWED_EXTENSIONS+CONVERTABLE_EXTENSIONS+ARCHIVE_EXTENSIONS)
 #ALLOWED_EXTENSIONS = ExtenAllowAll()
 VER_CODE_LEN = 16
 MAINTAINERS = [
@@ -34,3 +120,71 @@ MAINTAINERS = [
 	'lannonbr@clarkson.edu',
 ]
 MX = 'aspmx.l.google.com'
+DEDUP_WINDOW = 60
+DEDUP_SIZE = 512
+RATE_LIMIT_PER_MINUTE = 4
+RATE_LIMIT_BURST = 6
+MAX_CONVERSIONS = 2
+ADMISSION_WAIT = 1.0
+BUSY_RETRY_AFTER = 10
+SPOOL_DIR = os.path.join(os.path.dirname(__file__), 'spool')
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_MAX_SIZE = 256 * 1024 * 1024
+UPLOAD_EXPIRY = 24 * 3600
+IMAGE_EXTENSIONS = ["png", "jpg", "jpeg", "gif"]
+PRINTER_DPI = 300
+IMAGE_QUALITY = 85
+API_MAX_FILES = 20
+CONVERT_WORKERS = 4
+ARCHIVE_MAX_MEMBERS = 100
+ARCHIVE_MAX_SIZE = 200 * 1024 * 1024
+ASYNC_CONNECTIONS = 200
+SPOOLER = 'ipp'
+IPP_SOCKET = '/var/run/cups/cups.sock'
+IPP_PRINTER = None
+IPP_STATUS_TTL = 1.0
+JOB_POLL_INTERVAL = 2.0
+JOB_STATUS_KEEP = 20
+SSE_DURATION = 300
+SSE_RETRY = 3
+SSE_KEEPALIVE = 25
+SESSION_BACKEND = 'sqlite'
+SESSION_SECRET = None
+SESSION_MAX_AGE = 30 * 24 * 3600
+SNIFF_SIZE = 4096
+CONVERT_TIMEOUT = 120
+CONVERT_MEMORY = 2 * 1024 * 1024 * 1024
+CONVERT_CPU = 120
+SPOOL_TIMEOUT = 60
+SPOOL_MEMORY = 256 * 1024 * 1024
+PREVIEW_DIR = os.path.join(os.path.dirname(__file__), 'previews')
+PREVIEW_CACHE_SIZE = 64 * 1024 * 1024
+PREVIEW_PAGES = 4
+PREVIEW_DPI = 20
+PREVIEW_WORKERS = 1
+PREVIEW_QUEUE = 8
+USAGE_BATCH = 5000
+USAGE_REFRESH_INTERVAL = 60
+USAGE_DAYS = 30
+USAGE_TOP = 20
+PROFILE_DIR = os.path.join(os.path.dirname(__file__), 'profiles')
+PROFILE_RATE = 0.1
+PROFILE_INTERVAL = 0.005
+PROFILE_DURATION = 600
+PROFILE_CHECK = 1.0
+PROFILE_FLUSH = 5.0
+BACKUP_DIR = os.path.join(os.path.dirname(__file__), 'backups')
+BACKUP_KEEP = 7
+BACKUP_STEP_PAGES = 256
+BACKUP_STEP_SLEEP = 0.05
+BACKUP_RESTARTS = 10
+VACUUM_STEP_PAGES = 256
+ANALYZE_LIMIT = 1000
+MAINT_BUSY_TIMEOUT = 10
+MAINT_INTERVAL = 24 * 3600
+SCHED_WINDOW = 2
+SCHED_MAX_WAIT = 300
+SCHED_HALF_LIFE = 3600
+SCHED_CLASSES = [(0, 'light'), (20, 'regular'), (100, 'heavy')]
+DEBUG = False
+TEMPLATE_CACHE_DIR = os.path.join(os.path.dirname(__file__), 'templatecache')
@@ -6,21 +6,58 @@ import fnmatch
 import hashlib
 import time
 import sys
+import csv
+import json
+import argparse
 
 import userdb
+import usage
+import profiler
+import maint
+import conf
 
 def match_users(pat):
-	res = set()
+	# Each term loads its own User objects; a user matched by several is kept once
+	res = {}
 	for part in pat.split(','):
-		res |= match_terms(part)
-	return sorted(list(res), key=lambda u: u.id)
+		for u in match_terms(part):
+			res[u.id] = u
+	return sorted(res.values(), key=lambda u: u.id)
+
+# Returns the IDs of the users matched by a pattern component from userdb.name_index, or
+# None if it must be matched against every user: only U: and E: patterns that are a literal
+# name (or email) or a literal followed by "*" are looked up
+def index_match(pat):
+	if ':' in pat:
+		tp, col, pat = pat.partition(':')
+	else:
+		tp = 'U'
+	if tp not in ('U', 'E'):
+		return None
+	literal = pat[:-1] if pat.endswith('*') else pat
+	if any(c in literal for c in '*?['):
+		return None
+	field = 'username' if tp == 'U' else 'email'
+	if pat.endswith('*'):
+		return userdb.name_index.Prefix(literal, field)
+	return userdb.name_index.Equal(literal, field)
 
 def match_terms(pat):
 	# XXX reimplement?
-	users = userdb.User.All()
+	parts = pat.split(';')
+	users = None
+	# x: matches depend on every user, not only those of another component
+	if not any(part.lstrip('!').startswith('x:') for part in parts):
+		for part in parts:
+			ids = index_match(part) if part[0] != '!' else None
+			if ids is not None:
+				users = userdb.User.FromIDs(ids)
+				break
+	if users is None:
+		users = userdb.User.All()
 	uset = set(users)
 	ret = set(users)
-	for part in pat.split(';'):
+	for part in parts:
 		if part[0] == '!':
 			pset = uset - set(match_pat(part[1:], users))
 		else:
@@ -88,6 +125,36 @@ def match_pat(pat, users):
 		return sum(filter(lambda bin, n=n: len(bin) >= n, bins.values()), [])
 	raise ValueError('Unknown class: %s'%(tp))
 
+# Converts a row read by `import` into a row for User.BulkImport
+def import_row(row):
+	if not row.get('username'):
+		raise ValueError('Row without a username: %r'%(row,))
+	ret = dict((k, row[k]) for k in userdb.User.IMPORT_FIELDS if row.get(k) is not None)
+	if row.get('passwd'):
+		ret['password'] = hashlib.sha512(row['passwd'].encode('utf-8')).hexdigest()
+	for k in ('balance', 'overcharge'):
+		if k in ret:
+			ret[k] = float(ret[k])
+	if 'status' in ret:
+		try:
+			ret['status'] = int(ret['status'])
+		except ValueError:
+			ret['status'] = _STATUS_NAMES.index(ret['status'].upper())
+	return ret
+
+def show_progress(done, total):
+	sys.stdout.write('\r%d/%d rows written'%(done, total))
+	sys.stdout.flush()
+
+def show_pages(done, total):
+	sys.stdout.write('\r%d/%d pages copied'%(done, total))
+	sys.stdout.flush()
+	if done >= total:
+		print
+
+# Most names offered by tab completion
+COMPLETE_LIMIT = 100
+
 NAG_SECONDS = 10
 NAG_RESOLUTION = 4
 
@@ -108,12 +175,67 @@ for idx, v in enumerate(_STATUS_NAMES):
 class PrintConsole(cmd.Cmd):
 	prompt = '?> '
 	intro = 'Print Server User Console\n(Try `help` and `help <command>`)'
+	# In batch mode, errors propagate out of onecmd and nothing is prompted for
+	batch = False
+	assume_yes = False
 	def onecmd(self, s):
 		try:
 			cmd.Cmd.onecmd(self, s)
 		except Exception, e:
+			if self.batch:
+				raise
 			print '!!! An error occurred during the command:', s
 			traceback.print_exc()
+	def default(self, line):
+		# cmd.Cmd only prints a message, which would let a mistyped command pass in a batch
+		if self.batch:
+			raise ValueError('Unknown command: %s'%(line,))
+		cmd.Cmd.default(self, line)
+	def run_batch(self, lines, transaction=False, keep_going=False):
+		'''Runs commands from lines, returning True if all of them succeeded.
+
+With transaction, all commands run in one database transaction, which is rolled back
+(and the batch stopped) on the first error.'''
+		self.batch = True
+		timings = []
+		try:
+			if transaction:
+				with userdb.Transaction():
+					self._run_lines(lines, timings, False)
+			else:
+				self._run_lines(lines, timings, keep_going)
+		except Exception:
+			if transaction:
+				print '!!! Transaction rolled back; no changes were saved.'
+		finally:
+			self.batch = False
+		print
+		print '{status:8}{secs:>10}  {cmd}'.format(status='STATUS', secs='SECONDS', cmd='COMMAND')
+		for status, secs, line in timings:
+			print '{status:8}{secs:>10.3f}  {cmd}'.format(status=status, secs=secs, cmd=line)
+		print '%d commands, %d failed, %.3fs total'%(len(timings), sum(1 for t in timings if t[0] != 'ok'), sum(t[1] for t in timings))
+		return all(t[0] == 'ok' for t in timings)
+	def _run_lines(self, lines, timings, keep_going):
+		for line in lines:
+			line = line.strip()
+			if not line or line.startswith('#'):
+				continue
+			print self.prompt+line
+			start = time.time()
+			try:
+				self.onecmd(line)
+			except Exception:
+				timings.append(('FAILED', time.time()-start, line))
+				print '!!! An error occurred during the command:', line
+				traceback.print_exc()
+				if not keep_going:
+					raise
+			else:
+				timings.append(('ok', time.time()-start, line))
+	def getpass(self, prompt):
+		if self.batch:
+			raise RuntimeError('Passwords cannot be prompted for in batch mode (see `help import`).')
+		return getpass.getpass(prompt)
 	def _expect(self, line, *types):
 		parts = shlex.split(line)
 		ret = []
@@ -138,6 +260,29 @@ class PrintConsole(cmd.Cmd):
 			elif tp[0] == TP.EXPR:
 				ret.append(eval(part))
 		return ret
+	def _complete_users(self, line, begidx, endidx, arg):
+		# Completes the term of a user pattern being typed as argument number arg, from
+		# userdb.name_index. readline also splits words at punctuation (such as ":", "@"
+		# and ","), so the term is found here, and completions start at begidx.
+		wstart = line.rfind(' ', 0, endidx) + 1
+		if len(line[:wstart].split()) - 1 != arg:
+			return []
+		start = max([wstart] + [line.rfind(c, wstart, endidx) + 1 for c in ',;!'])
+		term = line[start:endidx]
+		scheme = ''
+		if term[1:2] == ':':
+			scheme, term = term[:2], term[2:]
+			if scheme not in ('U:', 'E:'):
+				return []
+		values = userdb.name_index.Complete(term, 'email' if scheme == 'E:' else 'username', COMPLETE_LIMIT)
+		return [(scheme+value.encode('utf-8'))[begidx-start:] for value in values]
+	def complete_view(self, text, line, begidx, endidx):
+		return self._complete_users(line, begidx, endidx, 0)
+	complete_status = complete_passwd = complete_balance = complete_overcharge = complete_view
+	complete_remove = complete_enable = complete_disable = complete_verify = complete_view
+	def complete_enroll(self, text, line, begidx, endidx):
+		return self._complete_users(line, begidx, endidx, 1)
+	complete_unenroll = complete_enroll
 	def do_quit(self, line):
 		'''quit
 
@@ -159,6 +304,11 @@ View information about the users matching the given pattern.'''
 			status = STATUS_NAMES.get(u.status, repr(u.status)+'?!')
 			print '{u.id:<8}{u.username:20}{u.email:32}{status:14}{u.balance:<8}{u.overcharge:<8}'.format(u=u, status=status)
 	def confirm(self, prompt):
+		if self.assume_yes:
+			print prompt+'[y/n] y'
+			return
+		if self.batch:
+			raise RuntimeError('Confirmation needed in batch mode (use --yes): '+prompt)
 		ch = ''
 		while not ch:
 			ch = raw_input(prompt+'[y/n] ')
@@ -188,7 +338,7 @@ Change the password of a user.'''
 		user = self._expect(line, (TP.USER,))[0][0]
 		self.show_pat([user])
 		self.confirm('Change password of %s? '%(user.username))
-		passwd = getpass.getpass('Password: ')
+		passwd = self.getpass('Password: ')
 		if passwd:
 			passwd = hashlib.sha512(passwd).hexdigest()
 		user.password = passwd
@@ -246,7 +396,7 @@ Create a new user account. The account will be immediately active, limited by ba
 You will be prompted for a password for the user. Entering an empty string will lock the account--see `help passwd`.'''
 		username, email = self._expect(line, (TP.STRING,), (TP.STRING,))
 		self.confirm('Create user %s with email %s? '%(username, email))
-		passwd = getpass.getpass('Password: ')
+		passwd = self.getpass('Password: ')
 		if passwd:
 			passwd = hashlib.sha512(passwd).hexdigest()
 		userdb.User.Create(username, passwd, email, 0, 1.0, None, userdb.User.ST_NORMAL)
@@ -259,7 +409,7 @@ Remove the specified users. This action CANNOT be undone.'''
 		print 'NOTE: You will be asked TWICE whether or not you would like to complete this action.'
 		print 'Deleting users is generally HIGHLY DISCOURAGED, and you SHOULD NOT DO THIS unless you have to.'
 		print 'For a better alternative, see `help status` (or `help disable`).'
-		if not hasattr(self, 'nagged'):
+		if not hasattr(self, 'nagged') and not self.assume_yes:
 			print '---PLEASE read the above---'
 			for i in range(NAG_SECONDS * NAG_RESOLUTION):
 				print (NAG_SECONDS - float(i)/NAG_RESOLUTION),
@@ -272,7 +422,6 @@ Remove the specified users. This action CANNOT be undone.'''
 		self.confirm('REALLY delete these users?')
 		for u in users:
 			u.Delete()
-		userdb.db.commit()
 	def do_enable(self, line):
 		'''enable <users>
 
@@ -291,6 +440,278 @@ Alias to `status <users> 1`'''
 Alias to `status <users> 0`'''
 		arg = self._expect(line, (TP.STRING,))[0]
 		self.onecmd('status "'+arg+'" 0')
+	def do_export(self, line):
+		'''export <file> [csv|json]
+
+Write every user to a file ("-" for standard output), as CSV with a header row or as JSON lines (one object per user). The format defaults to json for files ending in .json or .jsonl, and csv otherwise. Users are streamed from the database, so this works in constant memory.'''
+		parts = shlex.split(line)
+		if not parts:
+			raise TypeError('Expected a file name')
+		fname = parts[0]
+		fmt = parts[1] if len(parts) > 1 else ('json' if fname.endswith(('.json', '.jsonl')) else 'csv')
+		if fmt not in ('csv', 'json'):
+			raise ValueError('Unknown format: %s'%(fmt,))
+		f = sys.stdout if fname == '-' else open(fname, 'wb')
+		try:
+			fields = ('id',)+userdb.User.IMPORT_FIELDS
+			if fmt == 'csv':
+				writer = csv.writer(f)
+				writer.writerow(fields)
+			count = 0
+			for u in userdb.User.Iter():
+				values = [getattr(u, field) for field in fields]
+				if fmt == 'csv':
+					writer.writerow([v.encode('utf-8') if isinstance(v, unicode) else v for v in values])
+				else:
+					f.write(json.dumps(dict(zip(fields, values)))+'\n')
+				count += 1
+		finally:
+			if f is not sys.stdout:
+				f.close()
+		if f is not sys.stdout:
+			print 'Exported', count, 'users to', fname
+	def do_import(self, line):
+		'''import <file> [csv|json] [--update] [--dry-run]
+
+Create users in bulk from a file ("-" for standard input) in the format written by `export` (CSV with a header row, or JSON lines). Only the username column is required; the others are password (a SHA-512 hash, as stored), passwd (a plain password, which is hashed), email, balance, overcharge, vcode and status (a number or a name from `help statuses`). The id column is ignored.
+
+Users that already exist are skipped, unless --update is given, in which case their columns present in the file are overwritten. All changes are made in one transaction. With --dry-run, nothing is saved; the counts of what would happen are shown instead.'''
+		parts = shlex.split(line)
+		flags = set(p for p in parts if p.startswith('--'))
+		parts = [p for p in parts if not p.startswith('--')]
+		if flags - set(['--update', '--dry-run']):
+			raise ValueError('Unknown flags: %s'%(', '.join(flags - set(['--update', '--dry-run'])),))
+		if not parts:
+			raise TypeError('Expected a file name')
+		fname = parts[0]
+		fmt = parts[1] if len(parts) > 1 else ('json' if fname.endswith(('.json', '.jsonl')) else 'csv')
+		f = sys.stdin if fname == '-' else open(fname, 'rb')
+		try:
+			if fmt == 'csv':
+				rows = [dict((k, v.decode('utf-8')) for k, v in row.iteritems() if v != '') for row in csv.DictReader(f)]
+			elif fmt == 'json':
+				rows = [json.loads(l) for l in f if l.strip()]
+			else:
+				raise ValueError('Unknown format: %s'%(fmt,))
+		finally:
+			if f is not sys.stdin:
+				f.close()
+		rows = [import_row(row) for row in rows]
+		update = '--update' in flags
+		created, updated, skipped = userdb.User.BulkImport(rows, update, True)
+		print 'Read %d rows: %d users to create, %d to update, %d existing to skip.'%(len(rows), created, updated, len(skipped))
+		if skipped:
+			print 'Skipped:', ', '.join(skipped)
+		if '--dry-run' in flags or not (created or updated):
+			return
+		self.confirm('Import these users? ')
+		start = time.time()
+		created, updated, skipped = userdb.User.BulkImport(rows, update, False, show_progress)
+		print
+		print 'Created %d and updated %d users in %.2fs.'%(created, updated, time.time()-start)
+	def _group_users(self, line):
+		parts = shlex.split(line)
+		if len(parts) < 2:
+			raise TypeError('Expected a group name and a user pattern (or --roster <file>)')
+		group = userdb.Group.FromName(parts[0])
+		if parts[1] != '--roster':
+			return group, match_users(parts[1])
+		if len(parts) < 3:
+			raise TypeError('Expected a roster file name')
+		f = sys.stdin if parts[2] == '-' else open(parts[2], 'rb')
+		try:
+			names = [l.strip().decode('utf-8') for l in f if l.strip()]
+		finally:
+			if f is not sys.stdin:
+				f.close()
+		users = sorted(userdb.User.FromNames(names), key=lambda u: u.id)
+		missing = set(names) - set(u.username for u in users)
+		if missing:
+			print 'Warning: no such users (ignored):', ', '.join(sorted(missing))
+		return group, users
+	def do_members(self, line):
+		'''members <group>
+
+View the members of a group.'''
+		group = userdb.Group.FromName(self._expect(line, (TP.STRING, 'a group name'))[0])
+		members = group.Users()
+		self.show_pat([m for m in members if isinstance(m, userdb.User)])
+		missing = [m for m in members if not isinstance(m, userdb.User)]
+		if missing:
+			print 'Memberships of nonexistent user IDs:', ', '.join(str(m) for m in missing)
+	def do_who(self, line):
+		'''who <access>
+
+View the users who have the given access, after group inheritance, levels and revocations are applied (as for a user's AccessToken). The root user has every access.
+
+See also accesses.'''
+		access = self._expect(line, (TP.STRING, 'an access string'))[0]
+		start = time.time()
+		users = userdb.access_index.Users(access)
+		elapsed = time.time() - start
+		self.show_pat(users)
+		print '(%.2f ms)'%(1000*elapsed,)
+	def do_accesses(self, line):
+		'''accesses
+
+List every access string mentioned in an access entry, with the number of users who have it.'''
+		for access in userdb.access_index.Accesses():
+			print '{count:8}  {access}'.format(count=len(userdb.access_index.Who(access)), access=access)
+	def do_enroll(self, line):
+		'''enroll <group> <users>
+enroll <group> --roster <file>
+
+Add the users matching the pattern, or named in the roster file ("-" for standard input; one username per line), to a group. Users already in the group are left alone; all the memberships are added in one transaction.
+
+See also unenroll, members.'''
+		group, users = self._group_users(line)
+		self.show_pat(users)
+		self.confirm('Add these users to %s? '%(group.name,))
+		added = group.AddUsers(users)
+		print 'Added %d users to %s (%d were already members).'%(added, group.name, len(users)-added)
+	def do_unenroll(self, line):
+		'''unenroll <group> <users>
+unenroll <group> --roster <file>
+
+Remove the users matching the pattern, or named in the roster file, from a group, in one transaction (see enroll).'''
+		group, users = self._group_users(line)
+		self.show_pat(users)
+		self.confirm('Remove these users from %s? '%(group.name,))
+		removed = group.RemoveUsers(users)
+		print 'Removed %d users from %s.'%(removed, group.name)
+	def do_usage(self, line):
+		'''usage [days|users|printers|hours|refresh] [<days>]
+usage user <user> [<days>]
+
+Report printing from the PyKota job history over the last <days> days (conf.USAGE_DAYS by default, ending today): totals per day (the default), the users who printed the most pages, totals per printer or per hour of the day, or the days of one user.
+
+Reports read the usage rollup tables, after rolling up any history added since the last refresh; `usage refresh` only does the latter. See usage for more information.'''
+		parts = shlex.split(line)
+		report = parts.pop(0) if parts else 'days'
+		if report.isdigit():
+			report, parts = 'days', [report]+parts
+		if report == 'refresh':
+			start = time.time()
+			count = usage.rollup.Refresh()
+			print 'Rolled up %d job history rows in %.2fs (up to row %d).'%(count, time.time()-start, usage.rollup.Watermark())
+			return
+		user = None
+		if report == 'user':
+			if not parts:
+				raise TypeError('Expected a single-user pattern')
+			users = match_users(parts.pop(0))
+			if len(users) != 1:
+				raise ValueError('User pattern produced %d matches instead of 1'%(len(users)))
+			user = users[0]
+		days = int(parts[0]) if parts else conf.USAGE_DAYS
+		start, end = usage.Period(days)
+		usage.rollup.Refresh()
+		if report in ('days', 'user'):
+			key, label, rows = 'day', 'DAY', usage.rollup.Days(start, end, user.id if user else None)
+		elif report == 'users':
+			key, label, rows = 'username', 'USERNAME', usage.rollup.Users(start, end, conf.USAGE_TOP)
+		elif report == 'printers':
+			key, label, rows = 'printername', 'PRINTER', usage.rollup.Printers(start, end)
+		elif report == 'hours':
+			key, label, rows = 'hour', 'HOUR', usage.rollup.Hours(start, end)
+		else:
+			raise ValueError('Unknown report: %s'%(report,))
+		print 'Usage from %s to %s%s:'%(start, end, ' by '+user.username if user else '')
+		hdr = '{key:20}{jobs:>8}{denied:>8}{pages:>10}{price:>12}'.format(key=label, jobs='JOBS', denied='DENIED', pages='PAGES', price='PRICE')
+		print hdr
+		print '='*len(hdr)
+		for row in rows:
+			name = row[key]
+			if name is None:
+				name = '#%s'%(row.get('userid', row.get('printerid')),)
+			print '{name:20}{r[jobs]:>8}{r[denied]:>8}{r[pages]:>10}{r[price]:>12.2f}'.format(name=name, r=row)
+		print '{name:20}{jobs:>8}{denied:>8}{pages:>10}{price:>12.2f}'.format(name='TOTAL', **dict((col, sum(row[col] for row in rows)) for col in ('jobs', 'denied', 'pages', 'price')))
+	def do_profile(self, line):
+		'''profile [status|stop]
+profile start [<rate> [<seconds> [<interval>]]]
+profile dump <file> [<endpoint>]
+
+Control the sampling profiler of the running workers (see profiler). `start` samples the given fraction of requests (conf.PROFILE_RATE by default) for the given number of seconds (conf.PROFILE_DURATION), every <interval> seconds (conf.PROFILE_INTERVAL), discarding earlier samples; `stop` ends profiling early. `status` (the default) shows the settings and, per endpoint, the requests sampled, their mean time and the samples taken. `dump` writes the samples (of every endpoint, or only one) to a file ("-" for standard output) in the folded format of flamegraph.pl.
+
+Workers write their samples every conf.PROFILE_FLUSH seconds, so the latest ones may be missing.'''
+		parts = shlex.split(line)
+		action = parts.pop(0) if parts else 'status'
+		if action == 'start':
+			args = [float(p) for p in parts[:3]]
+			rate, duration, interval = args + [None]*(3-len(args))
+			profiler.Start(rate, interval, duration)
+		elif action == 'stop':
+			profiler.Stop()
+		elif action == 'dump':
+			if not parts:
+				raise TypeError('Expected a file name')
+			folded = profiler.Folded(parts[1] if len(parts) > 1 else None)
+			if parts[0] == '-':
+				sys.stdout.write(folded)
+			else:
+				with open(parts[0], 'w') as f:
+					f.write(folded)
+				print 'Wrote %d stacks to %s'%(folded.count('\n'), parts[0])
+			return
+		elif action != 'status':
+			raise ValueError('Unknown action: %s'%(action,))
+		settings = profiler.Settings()
+		if not settings:
+			print 'Profiling has not been started.'
+			return
+		remaining = settings['until'] - time.time()
+		if remaining > 0:
+			print 'Profiling %g of requests every %gs, for %ds more.'%(settings['rate'], settings['interval'], remaining)
+		else:
+			print 'Profiling is off.'
+		summary = profiler.Summary()
+		hdr = '{endpoint:32}{requests:>10}{mean:>10}{samples:>10}'.format(endpoint='ENDPOINT', requests='REQUESTS', mean='MEAN MS', samples='SAMPLES')
+		print hdr
+		print '='*len(hdr)
+		for endpoint, entry in sorted(summary.iteritems(), key=lambda item: -item[1]['samples']):
+			mean = 1000*entry['seconds']/entry['requests'] if entry['requests'] else 0
+			print '{endpoint:32}{e[requests]:>10}{mean:>10.1f}{e[samples]:>10}'.format(endpoint=endpoint, e=entry, mean=mean)
+	def do_maint(self, line):
+		'''maint backup|vacuum|analyze|check|quickcheck|all [<database>]
+maint every [<seconds>] [<database>]
+
+Maintain the sqlite databases while the server runs (see maint): back up to conf.BACKUP_DIR in small steps, return free pages to the filesystem with incremental VACUUM, update the query planner's statistics with ANALYZE, or check integrity. `all` does a quick check, a backup, ANALYZE and VACUUM, stopping if the check fails. <database> is pykota, sessions or all (the default). Each operation reports the file size, page count and free pages before and after, and the time taken.
+
+`every` runs `all` now and then every <seconds> (conf.MAINT_INTERVAL by default) until interrupted; it is meant to be run in the background, in batch mode.
+
+The first VACUUM of a database without auto_vacuum=INCREMENTAL is a full VACUUM, which locks the database until it is done.'''
+		parts = shlex.split(line)
+		if not parts:
+			raise TypeError('Expected an operation')
+		action = parts.pop(0)
+		interval = conf.MAINT_INTERVAL
+		if action == 'every' and parts and parts[0].isdigit():
+			interval = int(parts.pop(0))
+		names = sorted(maint.DATABASES) if not parts or parts[0] == 'all' else [parts[0]]
+		tasks = {'backup': ('backup',), 'vacuum': ('vacuum',), 'analyze': ('analyze',), 'quickcheck': ('check',), 'all': maint.TASKS, 'every': maint.TASKS}.get(action)
+		if action == 'check':
+			reports = [maint.Check(name) for name in names]
+		elif tasks is None:
+			raise ValueError('Unknown operation: %s'%(action,))
+		else:
+			reports = None
+		while True:
+			if reports is None:
+				for name in names:
+					for report in maint.Maintain(name, tasks, show_pages if action == 'backup' and not self.batch else None):
+						print report
+			else:
+				for report in reports:
+					print report
+			if action != 'every':
+				break
+			print 'Next maintenance at', time.ctime(time.time()+interval)
+			sys.stdout.flush()
+			try:
+				time.sleep(interval)
+			except KeyboardInterrupt:
+				print
+				break
 	def do_q(self, line):
 		'''q
 
@@ -299,7 +720,7 @@ Alias to `quit`'''
 	def help_userpat(self, *whatever):
 		print '''User Patterns:
 
-User patterns are used wherever users may be specified. The present implementation is documented as follows:
+User patterns are used wherever users may be specified (and may be completed with the Tab key). The present implementation is documented as follows:
 A pattern is a disjunction of term patterns; each component is separated by a comma (","). With more than one term pattern, the union of the criteria is generated.
 A term pattern may be specified by a pattern component; these are separated by semicolons (";"). When more than one component is given, the intersection of the criteria is generated.
 A term component may be negated by prefixing a "!".
@@ -326,6 +747,8 @@ Users with the same email address as some other user in the set: x:E
 Users with unique statuses: !x:S
 Verified users who share their balance with more than 5 other users: x:B:6;S:NOR*
 
+U: and E: patterns that are a literal name or email, or a literal followed by "*" (e.g. "doe*"), are looked up in an index instead of being matched against every user, as long as the term has no x: component.
+
 This implementation is subject to change.'''
 	def help_statuses(self, *whatever):
 		print '''User Statuses:
@@ -340,5 +763,16 @@ uses a name; see `help userpat`:'''
 
 
 if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Print Server User Console')
+	parser.add_argument('--batch', metavar='FILE', help='run the commands in FILE ("-" for standard input) instead of prompting')
+	parser.add_argument('--yes', action='store_true', help='answer yes to every confirmation')
+	parser.add_argument('--transaction', action='store_true', help='in batch mode, run all commands in one transaction, rolled back on the first error')
+	parser.add_argument('--keep-going', action='store_true', help='in batch mode (without --transaction), continue after a command fails')
+	args = parser.parse_args()
 	interp = PrintConsole()
+	interp.assume_yes = args.yes
+	if args.batch:
+		f = sys.stdin if args.batch == '-' else open(args.batch)
+		ok = interp.run_batch(f, args.transaction, args.keep_going)
+		sys.exit(0 if ok else 1)
 	interp.cmdloop()
@@ -0,0 +1,202 @@
+'''
+print -- CSLabs Print Server
+convert -- Document Conversion
+
+This module turns uploaded documents into PDFs, and merges several documents into one
+PDF so that they can be spooled (and charged) as a single job.
+
+-ToPDF(fname) converts one file, choosing the converter by its extension: PDFs are used
+ as they are, images go through PIL (see preprocess), PostScript through ps2pdf, office
+ documents (conf.CONVERTABLE_EXTENSIONS) through soffice, and anything else that may be
+ printed is read by soffice as plain text. It returns the path of the PDF (next to the
+ input), or None if conversion failed. Converters run through runner, bounded by
+ conf.CONVERT_TIMEOUT, conf.CONVERT_MEMORY and conf.CONVERT_CPU.
+-ConvertAll(fnames, parallel=None) converts a list of files in parallel on a process pool
+ of conf.CONVERT_WORKERS processes, returning the list of results in the same order.
+ If parallel is given, at most that many are converted at once (in groups of that
+ size), so that the caller can hold one conversion slot per running conversion.
+-soffice refuses to run twice on the same profile directory, and conversions run at once
+ in request threads, preview workers and the pool. Each soffice run therefore takes a
+ profile that no other run is using. Profiles are kept for reuse (so that soffice does
+ not set one up every time), one per process for each conversion running at once.
+-If convert.mapper is set, ConvertAll() calls mapper(ToPDF, fnames) instead of using the
+ pool; serve.py uses this to run conversions as greenlets, since a multiprocessing pool
+ would block the gevent hub.
+-Merge(pdfs, out) concatenates PDFs into out, using PyPDF2 if it is installed or
+ pdfunite otherwise. It raises MergeError if PyPDF2 cannot read one of the PDFs, and
+ runner.Failed if pdfunite fails.
+-ExtractArchive(path, outdir) extracts the printable members of a zip archive, sorted by
+ name, under generated file names (member paths are never used on disk), and returns a
+ list of (path, member name) pairs together with the names of skipped members (those
+ whose extension cannot be printed or does not match their content; see sniff). It
+ raises ArchiveError if the archive is unreadable or exceeds conf.ARCHIVE_MAX_MEMBERS
+ members or conf.ARCHIVE_MAX_SIZE uncompressed bytes.
+'''
+
+import os
+import tempfile
+import threading
+import traceback
+import zipfile
+import multiprocessing
+
+import conf
+import preprocess
+import runner
+import sniff
+
+try:
+	from PyPDF2 import PdfFileMerger
+	from PyPDF2.utils import PdfReadError
+except ImportError:
+	PdfFileMerger = None
+	class PdfReadError(Exception):
+		pass
+
+class ArchiveError(Exception):
+	pass
+
+class MergeError(Exception):
+	pass
+
+# Idle soffice profile directories, per process (a forked pool worker must not take its
+# parent's), and the number made so far in each
+_profiles = {}
+_profile_count = {}
+_profile_lock = threading.Lock()
+
+def _acquire_profile():
+	pid = os.getpid()
+	with _profile_lock:
+		idle = _profiles.setdefault(pid, [])
+		if idle:
+			return idle.pop()
+		_profile_count[pid] = n = _profile_count.get(pid, 0) + 1
+	return os.path.join(tempfile.gettempdir(), 'print-soffice-%d-%d'%(pid, n))
+
+def _release_profile(path):
+	with _profile_lock:
+		_profiles.setdefault(os.getpid(), []).append(path)
+
+def _convert(cmd):
+	return runner.Run(cmd, conf.CONVERT_TIMEOUT, conf.CONVERT_MEMORY, conf.CONVERT_CPU)
+
+def ToPDF(fname):
+	base, ext = os.path.splitext(fname)
+	ext = ext[1:].lower()
+	out = base+'.pdf'
+	try:
+		if ext == 'pdf':
+			return fname
+		elif ext in conf.IMAGE_EXTENSIONS and preprocess.Image is not None:
+			os.rename(preprocess.shrink_image(fname), out)
+			return out
+		elif ext == 'ps':
+			outcome = _convert(['ps2pdf', fname, out])
+		else:
+			profile = _acquire_profile()
+			try:
+				cmd = ['soffice', '-env:UserInstallation=file://'+profile, '--headless']
+				if ext not in conf.CONVERTABLE_EXTENSIONS:
+					cmd.append('--infilter=Text (encoded):UTF8,LF,,')
+				cmd += ['--convert-to', 'pdf', '--outdir', os.path.dirname(fname), fname]
+				outcome = _convert(cmd)
+			finally:
+				_release_profile(profile)
+	except Exception:
+		traceback.print_exc()
+		return None
+	if not outcome.ok:
+		# A killed converter may leave a partial PDF behind
+		if os.path.exists(out):
+			os.unlink(out)
+		return None
+	if not os.path.exists(out):
+		return None
+	return out
+
+_pool = None
+_pool_lock = threading.Lock()
+mapper = None
+
+def _get_pool():
+	global _pool
+	with _pool_lock:
+		if _pool is None:
+			_pool = multiprocessing.Pool(conf.CONVERT_WORKERS)
+		return _pool
+
+def ConvertAll(fnames, parallel=None):
+	if len(fnames) == 1:
+		return [ToPDF(fnames[0])]
+	step = parallel or len(fnames)
+	ret = []
+	for i in xrange(0, len(fnames), step):
+		group = fnames[i:i+step]
+		ret.extend(mapper(ToPDF, group) if mapper is not None else _get_pool().map(ToPDF, group, 1))
+	return ret
+
+def Merge(pdfs, out):
+	if len(pdfs) == 1:
+		os.rename(pdfs[0], out)
+	elif PdfFileMerger is not None:
+		merger = PdfFileMerger(strict=False)
+		try:
+			for pdf in pdfs:
+				merger.append(pdf, import_bookmarks=False)
+			with open(out, 'wb') as f:
+				merger.write(f)
+		except (PdfReadError, IOError, ValueError), e:
+			raise MergeError(str(e))
+		finally:
+			merger.close()
+	else:
+		_convert(['pdfunite'] + pdfs + [out]).Check()
+	return out
+
+def ExtractArchive(path, outdir):
+	try:
+		archive = zipfile.ZipFile(path)
+		infos = sorted(archive.infolist(), key=lambda info: info.filename)
+	except (zipfile.BadZipfile, zipfile.LargeZipFile, IOError), e:
+		raise ArchiveError('Unreadable archive: %s'%(e,))
+	if len(infos) > conf.ARCHIVE_MAX_MEMBERS:
+		raise ArchiveError('Archive has more than %d members'%(conf.ARCHIVE_MAX_MEMBERS,))
+	if sum(info.file_size for info in infos) > conf.ARCHIVE_MAX_SIZE:
+		raise ArchiveError('Archive is too large when extracted')
+	members, skipped = [], []
+	total = 0
+	for idx, info in enumerate(infos):
+		name = info.filename
+		base = name.rpartition('/')[2]
+		if not base or base.startswith('.') or name.startswith('__MACOSX/'):
+			continue
+		ext = base.rpartition('.')[2].lower()
+		if ext not in conf.ALLOWED_EXTENSIONS and ext not in conf.CONVERTABLE_EXTENSIONS:
+			skipped.append(name)
+			continue
+		try:
+			src = archive.open(info)
+			head = src.read(conf.SNIFF_SIZE)
+		except (zipfile.BadZipfile, RuntimeError, NotImplementedError), e:
+			raise ArchiveError('Unreadable member %s: %s'%(name, e))
+		try:
+			ext = sniff.Sniff(head, ext)
+		except sniff.Unprintable:
+			skipped.append(name)
+			continue
+		fname = os.path.join(outdir, 'member%04d.%s'%(idx, ext))
+		with open(fname, 'wb') as f:
+			try:
+				total += len(head)
+				f.write(head)
+				for chunk in iter(lambda: src.read(65536), ''):
+					# The sizes in the directory are not trusted
+					total += len(chunk)
+					if total > conf.ARCHIVE_MAX_SIZE:
+						raise ArchiveError('Archive is too large when extracted')
+					f.write(chunk)
+			except (zipfile.BadZipfile, RuntimeError, NotImplementedError), e:
+				raise ArchiveError('Unreadable member %s: %s'%(name, e))
+		members.append((fname, name))
+	return members, skipped
@@ -0,0 +1,74 @@
+'''
+print -- CSLabs Print Server
+dedup -- Duplicate Submission Index
+
+This module keeps a small, bounded, in-memory record of recent print submissions so
+that a double-clicked Print button (or a resubmission after a slow response) does not
+spool and charge the same document twice.
+
+Submissions are identified by a key chosen by the caller; the print view uses a tuple of
+(user ID, content hash, print options). The index is shared between all request threads
+of a worker and is protected by a lock.
+
+A submission is registered by calling .Claim() with its key:
+
+	entry, owner = index.Claim(key)
+
+If owner is True, this is the first submission with that key inside the window; the
+caller must do the work and then call .Release() with the result (any object), or
+.Discard() if the work failed in a way that should not be remembered. If owner is False,
+entry refers to the earlier submission, and entry.Wait() returns its result once it is
+available (waiting for it if the first submission is still in progress). Wait() returns
+None if the first submission was discarded or did not finish in time.
+
+Entries are forgotten once they have been released for longer than the window, or when
+the index holds more than its maximum number of entries (oldest first).
+'''
+
+import threading
+import time
+from collections import OrderedDict
+
+class DedupEntry(object):
+	def __init__(self, created):
+		self.created = created
+		self.result  = None
+		self.done    = threading.Event()
+	def Wait(self, timeout=None):
+		self.done.wait(timeout)
+		return self.result
+
+class DedupIndex(object):
+	def __init__(self, window, size):
+		self.window  = window
+		self.size    = size
+		self.entries = OrderedDict()
+		self.lock    = threading.Lock()
+	def _expire(self, now):
+		while self.entries:
+			key, entry = next(self.entries.iteritems())
+			if not entry.done.is_set() or entry.created + self.window > now:
+				break
+			del self.entries[key]
+	def Claim(self, key):
+		now = time.time()
+		with self.lock:
+			self._expire(now)
+			entry = self.entries.get(key)
+			if entry is not None:
+				return entry, False
+			entry = DedupEntry(now)
+			self.entries[key] = entry
+			while len(self.entries) > self.size:
+				self.entries.popitem(last=False)
+			return entry, True
+	def Release(self, key, entry, result):
+		entry.result = result
+		entry.done.set()
+	def Discard(self, key, entry):
+		with self.lock:
+			if self.entries.get(key) is entry:
+				del self.entries[key]
+		entry.done.set()
+	def __len__(self):
+		return len(self.entries)
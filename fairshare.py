@@ -0,0 +1,203 @@
+'''
+print -- CSLabs Print Server
+fairshare -- Fair-Share Job Scheduling
+
+CUPS prints jobs in the order they reach it, so a user who submits a long document in
+many parts holds up everyone who submits after them. This module holds jobs back
+between the print pipeline and CUPS and releases them in fair order:
+
+-At most "window" jobs released by the scheduler may be printing at once (a job is
+ printing until finished(handle) says otherwise; see below); the others wait.
+-Waiting jobs are released in the order of weighted fair queuing over the pages each
+ user prints. Every user has a virtual finish time; a job of n pages starts at the
+ later of the scheduler's virtual time and its user's finish time, and finishes n pages
+ later. The job with the earliest virtual finish is released first, so a user's pages
+ are interleaved with everyone else's instead of printing as one block, and a user who
+ has just printed many pages waits behind those who have not.
+-A job that has waited max_wait seconds is released first (oldest first), even if the
+ window is full, so that large jobs are not starved (and jobs still move if CUPS stops
+ reporting jobs as finished).
+
+	scheduler = FairScheduler(send, finished, window, max_wait, half_life, classes, poll, restore)
+	cls = scheduler.Submit(user.id, pages, item)
+
+Submit() queues a job and returns at once; a dispatcher thread later calls send(item),
+which lets CUPS print the job and returns a handle (or None if the job is already done),
+and then polls finished(handle) until the job leaves the window. finished() is called
+without the scheduler's lock held, every poll seconds while any job is in the window,
+so it may ask CUPS; it must not depend on anything that can forget the job (print.py
+passes the CUPS job ID and asks CUPS for its state).
+
+The scheduler only keeps waiting jobs in the memory of the worker process, so it is up
+to the caller to keep them somewhere that outlives the worker. print.py submits every
+job to CUPS at once, held, and send() releases it; a job whose worker exits (or is
+restarted) stays held in CUPS. When the dispatcher thread starts, it calls restore() (if
+given), which returns a list of (uid, pages, item) to queue again; print.py's lists the
+jobs held on the printer. The thread starts with the first Submit(), or with Start()
+(which print.py calls on a worker's first request, so that held jobs are picked up
+without waiting for a new one). Under uwsgi, the server must run with --enable-threads,
+or the thread never runs.
+
+The wait of every released job is recorded per user class. A user's class is chosen
+when they submit, from the pages they submitted recently (decaying by half every
+half_life seconds): classes is a list of (pages, name), and a user is in the class of
+the largest threshold they reach. Stats() returns, for each class, the number of jobs,
+their mean, 90th percentile (of the recent ones) and largest wait, and every release is
+logged to stderr as one JSON object per line (prefixed with "fairshare: ").
+'''
+
+import sys
+import json
+import time
+import threading
+import traceback
+from collections import deque
+
+class Pending(object):
+	def __init__(self, seq, uid, pages, item, cls, start, finish):
+		self.seq     = seq
+		self.uid     = uid
+		self.pages   = pages
+		self.item    = item
+		self.cls     = cls
+		self.start   = start
+		self.finish  = finish
+		self.arrived = time.time()
+
+class ClassStats(object):
+	def __init__(self, size):
+		self.jobs   = 0
+		self.total  = 0.0
+		self.max    = 0.0
+		self.recent = deque(maxlen=size)
+	def Record(self, wait):
+		self.jobs += 1
+		self.total += wait
+		self.max = max(self.max, wait)
+		self.recent.append(wait)
+	def ToDict(self):
+		recent = sorted(self.recent)
+		return {'jobs': self.jobs, 'mean_wait': self.total / self.jobs if self.jobs else 0.0, 'p90_wait': recent[int(len(recent)*0.9)] if recent else 0.0, 'max_wait': self.max}
+
+class FairScheduler(object):
+	# Users whose recent pages have decayed below this are forgotten once the table is this large
+	PRUNE_SIZE = 1024
+	PRUNE_PAGES = 0.5
+	def __init__(self, send, finished, window, max_wait, half_life, classes, poll=1.0, restore=None):
+		self.send      = send
+		self.finished  = finished
+		self.restore   = restore
+		self.window    = window
+		self.max_wait  = max_wait
+		self.half_life = half_life
+		self.classes   = sorted(classes)
+		self.poll      = poll
+		self.queue     = []
+		self.inflight  = []
+		self.vtime     = 0.0
+		self.finishes  = {}
+		self.recent    = {}
+		self.seq       = 0
+		self.stats     = {}
+		self.cond      = threading.Condition()
+		self.thread    = None
+	def _recent(self, uid, now):
+		pages, stamp = self.recent.get(uid, (0.0, now))
+		return pages * 0.5 ** ((now - stamp) / self.half_life)
+	def _class(self, pages):
+		name = self.classes[0][1]
+		for threshold, cls in self.classes:
+			if pages >= threshold:
+				name = cls
+		return name
+	def Submit(self, uid, pages, item):
+		'''Queues a job of the given number of pages for user uid; returns the user's class.'''
+		now = time.time()
+		pages = max(pages, 1)
+		with self.cond:
+			recent = self._recent(uid, now)
+			cls = self._class(recent)
+			if len(self.recent) >= self.PRUNE_SIZE:
+				self._prune(now)
+			self.recent[uid] = (recent + pages, now)
+			start = max(self.vtime, self.finishes.get(uid, 0.0))
+			self.finishes[uid] = start + pages
+			self.seq += 1
+			self.queue.append(Pending(self.seq, uid, pages, item, cls, start, start + pages))
+			self._start()
+			self.cond.notify_all()
+		return cls
+	def Start(self):
+		'''Starts the dispatcher thread (and so restores jobs) if it has not started yet.'''
+		with self.cond:
+			self._start()
+	def _start(self):
+		# Called with the lock held. Started lazily, so that it runs in the worker rather
+		# than a forking master
+		if self.thread is None:
+			self.thread = threading.Thread(target=self._dispatch)
+			self.thread.daemon = True
+			self.thread.start()
+	def _prune(self, now):
+		for uid in self.recent.keys():
+			if self._recent(uid, now) < self.PRUNE_PAGES and self.finishes.get(uid, 0.0) <= self.vtime:
+				del self.recent[uid]
+				self.finishes.pop(uid, None)
+	def Waiting(self):
+		with self.cond:
+			return len(self.queue)
+	def _next(self):
+		# Called with the lock held; returns the job to release now, or None
+		if not self.queue:
+			return None
+		now = time.time()
+		aged = [job for job in self.queue if now - job.arrived >= self.max_wait]
+		if aged:
+			return min(aged, key=lambda job: job.seq)
+		if len(self.inflight) >= self.window:
+			return None
+		return min(self.queue, key=lambda job: (job.finish, job.seq))
+	def _reap(self):
+		# Without the lock, since finished() may wait on CUPS
+		with self.cond:
+			inflight = list(self.inflight)
+		done = []
+		for handle in inflight:
+			try:
+				if self.finished(handle):
+					done.append(handle)
+			except Exception:
+				traceback.print_exc()
+		if done:
+			with self.cond:
+				self.inflight = [handle for handle in self.inflight if handle not in done]
+	def _dispatch(self):
+		if self.restore is not None:
+			try:
+				for uid, pages, item in self.restore():
+					self.Submit(uid, pages, item)
+			except Exception:
+				traceback.print_exc()
+		while True:
+			self._reap()
+			with self.cond:
+				job = self._next()
+				if job is None:
+					self.cond.wait(self.poll)
+					continue
+				self.queue.remove(job)
+				self.vtime = max(self.vtime, job.start)
+				wait = time.time() - job.arrived
+				self.stats.setdefault(job.cls, ClassStats(100)).Record(wait)
+			sys.stderr.write('fairshare: %s\n'%(json.dumps({'uid': job.uid, 'class': job.cls, 'pages': job.pages, 'wait': round(wait, 3), 'waiting': len(self.queue)}, sort_keys=True),))
+			try:
+				handle = self.send(job.item)
+			except Exception:
+				traceback.print_exc()
+				continue
+			if handle is not None:
+				with self.cond:
+					self.inflight.append(handle)
+	def Stats(self):
+		with self.cond:
+			return dict((cls, stats.ToDict()) for cls, stats in self.stats.iteritems())
@@ -0,0 +1,309 @@
+'''
+print -- CSLabs Print Server
+ipp -- IPP Client
+
+This module talks the Internet Printing Protocol to CUPS directly, so that submitting a
+job does not fork a shell and an lp process and open a fresh connection to cupsd each
+time. It keeps one persistent HTTP connection per thread to the CUPS socket (or to a
+host and port). Before a request is sent on it, a connection the server has closed is
+replaced with a new one. A request that fails once it has been (partly) sent is retried
+on a new connection only if it is safe to repeat; a Print-Job is not, since CUPS may
+already have accepted it, and raises Unconfirmed instead.
+
+An IPPClient is created with the address of the server: a filesystem path for a unix
+socket (the default, conf.IPP_SOCKET), or a (host, port) tuple:
+
+	client = IPPClient(conf.IPP_SOCKET)
+
+Jobs are submitted with .PrintJob(), given the file to print, the requesting user name,
+the job name and a list of job attributes (see below); it returns the ID assigned by
+CUPS:
+
+	job_id = client.PrintJob(fname, 'doe', 'doe:thesis.pdf', [(TAG_INTEGER, 'copies', [2])])
+
+The printer is conf.IPP_PRINTER, or the CUPS default printer (asked for once) if that is
+None. A job submitted with the job attribute job-hold-until "indefinite" is held by CUPS
+until it is released with .ReleaseJob(), given its ID and the name of the user it was
+submitted for:
+
+	client.ReleaseJob(job_id, 'doe')
+
+Job status is queried with .GetJobs(), which fetches the state of every job on the
+printer (or only those of one user) in a single request, and .JobStates(), which answers
+for many job IDs at once and shares one Get-Jobs among callers that ask within
+conf.IPP_STATUS_TTL seconds of each other:
+
+	states = client.JobStates([12, 13])	# {12: 'processing', 13: 'completed'}
+
+Attributes are given as (value tag, name, list of values) tuples, using the TAG_*
+constants; values are ints for integers and enums, bools for booleans, (low, high)
+tuples for ranges and strings otherwise. Responses decode the same way, into dicts that
+map names to lists of values. A response with an error status raises IPPError, whose
+.status is the IPP status code; I/O errors propagate as they are, except that of a
+Print-Job whose request was sent, which raises Unconfirmed (the job may or may not
+print, so it must not be submitted again).
+'''
+
+import os
+import time
+import struct
+import select
+import socket
+import httplib
+import threading
+
+import conf
+
+# Operations
+OP_PRINT_JOB          = 0x0002
+OP_GET_JOB_ATTRIBUTES = 0x0009
+OP_GET_JOBS           = 0x000A
+OP_RELEASE_JOB        = 0x000D
+OP_CUPS_GET_DEFAULT   = 0x4001
+
+# Delimiter tags
+TAG_OPERATION   = 0x01
+TAG_JOB         = 0x02
+TAG_END         = 0x03
+TAG_PRINTER     = 0x04
+TAG_UNSUPPORTED = 0x05
+
+# Value tags
+TAG_INTEGER   = 0x21
+TAG_BOOLEAN   = 0x22
+TAG_ENUM      = 0x23
+TAG_RANGE     = 0x33
+TAG_TEXT      = 0x41
+TAG_NAME      = 0x42
+TAG_KEYWORD   = 0x44
+TAG_URI       = 0x45
+TAG_CHARSET   = 0x47
+TAG_LANGUAGE  = 0x48
+TAG_MIMETYPE  = 0x49
+
+JOB_STATES = {3: 'pending', 4: 'pending-held', 5: 'processing', 6: 'processing-stopped', 7: 'canceled', 8: 'aborted', 9: 'completed'}
+
+class IPPError(Exception):
+	def __init__(self, status, message=''):
+		Exception.__init__(self, status, message)
+		self.status  = status
+		self.message = message
+
+class Unconfirmed(Exception):
+	pass
+
+def _encode_value(tag, value):
+	if tag in (TAG_INTEGER, TAG_ENUM):
+		return struct.pack('>i', value)
+	if tag == TAG_BOOLEAN:
+		return struct.pack('>B', 1 if value else 0)
+	if tag == TAG_RANGE:
+		return struct.pack('>ii', value[0], value[1])
+	if isinstance(value, unicode):
+		value = value.encode('utf-8')
+	return value
+
+def _decode_value(tag, data):
+	if tag in (TAG_INTEGER, TAG_ENUM) and len(data) == 4:
+		return struct.unpack('>i', data)[0]
+	if tag == TAG_BOOLEAN and len(data) == 1:
+		return bool(ord(data))
+	if tag == TAG_RANGE and len(data) == 8:
+		return struct.unpack('>ii', data)
+	return data
+
+# Encodes an IPP message: groups is a list of (delimiter tag, attribute list) pairs
+def encode(code, request_id, groups):
+	parts = [struct.pack('>BBHI', 1, 1, code, request_id)]
+	for gtag, attrs in groups:
+		parts.append(chr(gtag))
+		for tag, name, values in attrs:
+			for idx, value in enumerate(values):
+				data = _encode_value(tag, value)
+				key = name if idx == 0 else ''
+				parts.append(struct.pack('>BH', tag, len(key)) + key + struct.pack('>H', len(data)) + data)
+	parts.append(chr(TAG_END))
+	return ''.join(parts)
+
+# Decodes an IPP message into (code, request ID, [(delimiter tag, {name: [values]})], data)
+def decode(msg):
+	version, code, request_id = struct.unpack('>HHI', msg[:8])
+	pos = 8
+	groups = []
+	attrs = None
+	name = None
+	while pos < len(msg):
+		tag = ord(msg[pos])
+		pos += 1
+		if tag == TAG_END:
+			break
+		if tag < 0x10:
+			attrs = {}
+			groups.append((tag, attrs))
+			continue
+		nlen = struct.unpack('>H', msg[pos:pos+2])[0]
+		pos += 2
+		if nlen:
+			name = msg[pos:pos+nlen]
+			pos += nlen
+		vlen = struct.unpack('>H', msg[pos:pos+2])[0]
+		pos += 2
+		value = _decode_value(tag, msg[pos:pos+vlen])
+		pos += vlen
+		if attrs is None:
+			raise IPPError(-1, 'Attribute outside of a group')
+		attrs.setdefault(name, []).append(value)
+	return code, request_id, groups, msg[pos:]
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+	def __init__(self, path, timeout):
+		httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+		self.path = path
+	def connect(self):
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.sock.settimeout(self.timeout)
+		self.sock.connect(self.path)
+
+class TCPHTTPConnection(httplib.HTTPConnection):
+	def connect(self):
+		httplib.HTTPConnection.connect(self)
+		# The header and document are sent separately; don't let Nagle delay them
+		self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+class IPPClient(object):
+	def __init__(self, address, printer=None, timeout=30):
+		self.address    = address
+		self.printer    = printer
+		self.timeout    = timeout
+		self.local      = threading.local()
+		self.request_id = 0
+		self.lock       = threading.Lock()
+		self.states     = ({}, 0)
+		self.pending    = None
+	def _connection(self):
+		conn = getattr(self.local, 'conn', None)
+		if conn is None:
+			if isinstance(self.address, basestring):
+				conn = UnixHTTPConnection(self.address, self.timeout)
+			else:
+				conn = TCPHTTPConnection(self.address[0], self.address[1], timeout=self.timeout)
+			self.local.conn = conn
+		return conn
+	def Close(self):
+		conn = getattr(self.local, 'conn', None)
+		if conn is not None:
+			conn.close()
+			self.local.conn = None
+	def _next_id(self):
+		with self.lock:
+			self.request_id += 1
+			return self.request_id
+	def _dropped(self):
+		# An idle connection is readable only if the server has closed it (or broken protocol)
+		conn = getattr(self.local, 'conn', None)
+		return conn is not None and conn.sock is not None and bool(select.select([conn.sock], [], [], 0)[0])
+	# Sends a request; self.local.sent tells whether any of it was sent if this fails
+	def _post(self, path, header, document):
+		self.local.sent = False
+		if self._dropped():
+			self.Close()
+		conn = self._connection()
+		length = len(header)
+		if document is not None:
+			length += os.fstat(document.fileno()).st_size
+			document.seek(0)
+		conn.putrequest('POST', path)
+		conn.putheader('Content-Type', 'application/ipp')
+		conn.putheader('Content-Length', str(length))
+		# Connects if needed, so a connection failure still counts as nothing sent
+		if conn.sock is None:
+			conn.connect()
+		self.local.sent = True
+		conn.endheaders()
+		conn.send(header)
+		if document is not None:
+			for chunk in iter(lambda: document.read(65536), ''):
+				conn.send(chunk)
+		resp = conn.getresponse()
+		body = resp.read()
+		if resp.status != 200:
+			raise IPPError(-resp.status, 'HTTP %d %s'%(resp.status, resp.reason))
+		return body
+	def Request(self, code, attrs, groups=(), path='/', document=None, repeatable=True):
+		'''Sends a request; one that is not repeatable raises Unconfirmed if it fails after being sent.'''
+		ops = [(TAG_CHARSET, 'attributes-charset', ['utf-8']), (TAG_LANGUAGE, 'attributes-natural-language', ['en'])] + list(attrs)
+		header = encode(code, self._next_id(), [(TAG_OPERATION, ops)] + list(groups))
+		try:
+			body = self._post(path, header, document)
+		except (socket.error, httplib.HTTPException), e:
+			self.Close()
+			if self.local.sent and not repeatable:
+				raise Unconfirmed('Request failed after it was sent: %s'%(e,))
+			if not self.local.sent:
+				raise
+			# The server may have closed the connection as the request was sent; retry once
+			body = self._post(path, header, document)
+		status, request_id, rgroups, data = decode(body)
+		if status >= 0x0100:
+			message = ''
+			for gtag, gattrs in rgroups:
+				if gtag == TAG_OPERATION and 'status-message' in gattrs:
+					message = gattrs['status-message'][0]
+			raise IPPError(status, message)
+		return rgroups
+	def PrinterURI(self):
+		if self.printer is None:
+			for gtag, attrs in self.Request(OP_CUPS_GET_DEFAULT, [(TAG_KEYWORD, 'requested-attributes', ['printer-name'])]):
+				if gtag == TAG_PRINTER:
+					self.printer = attrs['printer-name'][0]
+			if self.printer is None:
+				raise IPPError(0x0406, 'No default printer')
+		return 'ipp://localhost/printers/'+self.printer
+	def PrintJob(self, fname, username, title, attrs):
+		uri = self.PrinterURI()
+		ops = [(TAG_URI, 'printer-uri', [uri]), (TAG_NAME, 'requesting-user-name', [username]), (TAG_NAME, 'job-name', [title]), (TAG_MIMETYPE, 'document-format', ['application/octet-stream'])]
+		with open(fname, 'rb') as document:
+			groups = self.Request(OP_PRINT_JOB, ops, [(TAG_JOB, attrs)], uri.partition('//localhost')[2], document, False)
+		for gtag, gattrs in groups:
+			if gtag == TAG_JOB and 'job-id' in gattrs:
+				return gattrs['job-id'][0]
+		raise IPPError(-1, 'No job-id in response')
+	def ReleaseJob(self, job_id, username):
+		uri = self.PrinterURI()
+		ops = [(TAG_URI, 'printer-uri', [uri]), (TAG_INTEGER, 'job-id', [job_id]), (TAG_NAME, 'requesting-user-name', [username])]
+		self.Request(OP_RELEASE_JOB, ops, path=uri.partition('//localhost')[2])
+	def GetJobs(self, which='not-completed', username=None):
+		uri = self.PrinterURI()
+		ops = [(TAG_URI, 'printer-uri', [uri]), (TAG_KEYWORD, 'which-jobs', [which]), (TAG_KEYWORD, 'requested-attributes', ['job-id', 'job-state', 'job-state-reasons', 'job-name', 'job-originating-user-name', 'job-k-octets', 'job-media-sheets-completed'])]
+		if username is not None:
+			ops += [(TAG_NAME, 'requesting-user-name', [username]), (TAG_BOOLEAN, 'my-jobs', [True])]
+		return [attrs for gtag, attrs in self.Request(OP_GET_JOBS, ops) if gtag == TAG_JOB]
+	def JobStates(self, job_ids):
+		with self.lock:
+			states, stamp = self.states
+			fresh = time.time() - stamp < conf.IPP_STATUS_TTL and all(i in states for i in job_ids)
+			if not fresh:
+				# Only one caller fetches; the others wait for its result
+				pending = self.pending
+				if pending is None:
+					pending = self.pending = threading.Event()
+					owner = True
+				else:
+					owner = False
+		if fresh:
+			return dict((i, states[i]) for i in job_ids)
+		if owner:
+			try:
+				states = {}
+				for attrs in self.GetJobs('all'):
+					states[attrs['job-id'][0]] = JOB_STATES.get(attrs.get('job-state', [0])[0], 'unknown')
+				with self.lock:
+					self.states = (states, time.time())
+			finally:
+				with self.lock:
+					self.pending = None
+				pending.set()
+		else:
+			pending.wait(self.timeout)
+			states = self.states[0]
+		return dict((i, states.get(i, 'unknown')) for i in job_ids)
@@ -0,0 +1,132 @@
+'''
+print -- CSLabs Print Server
+jobstatus -- Live Job Status
+
+This module tracks the state of each user's recent print jobs so that the print page
+can show them as they change instead of being reloaded. A job moves through these
+states:
+
+-"queued", when the submission has been accepted,
+-"converting", while it is converted and preprocessed,
+-"waiting", while CUPS holds it until its turn to print (see fairshare),
+-"printing", once it has been released, and
+-"done" or "failed", when CUPS reports it completed, or it was canceled, aborted or
+ could not be converted or spooled.
+
+The print pipeline records jobs on the module's "board" (a JobBoard):
+
+	job = board.Add(user.id, filename)
+	board.Set(job, 'converting')
+	board.Set(job, 'printing', cups_id=42)
+
+While jobs are printing, one shared poller thread asks CUPS for the state of all of them
+at once every conf.JOB_POLL_INTERVAL seconds (see ipp.IPPClient.JobStates), however many
+clients are watching; under uwsgi, this needs --enable-threads. Every change bumps the board's version; a client waits for the
+changes to its user's jobs after the version it last saw with:
+
+	version, jobs = board.Since(user.id, version, timeout)
+
+which returns as soon as there are any (or after timeout seconds, with an empty list).
+Only the last conf.JOB_STATUS_KEEP jobs of each user are kept. board.Active(user.id)
+tells whether any of them has not finished yet (is not "done" or "failed").
+'''
+
+import time
+import threading
+import traceback
+from collections import deque
+
+import conf
+import ipp
+
+# CUPS job states, as reported by ipp.IPPClient.JobStates, mapped to ours
+CUPS_STATES = {
+	'pending': 'printing',
+	'pending-held': 'printing',
+	'processing': 'printing',
+	'processing-stopped': 'printing',
+	'completed': 'done',
+	'canceled': 'failed',
+	'aborted': 'failed',
+}
+
+class Job(object):
+	def __init__(self, id, uid, title):
+		self.id      = id
+		self.uid     = uid
+		self.title   = title
+		self.state   = 'queued'
+		self.message = ''
+		self.cups_id = None
+		self.version = 0
+		self.updated = time.time()
+	def ToDict(self):
+		return {'id': self.id, 'title': self.title, 'state': self.state, 'message': self.message, 'cups_id': self.cups_id, 'updated': self.updated}
+
+class JobBoard(object):
+	def __init__(self, client, interval, keep):
+		self.client  = client
+		self.interval = interval
+		self.keep    = keep
+		self.users   = {}
+		self.version = 0
+		self.next_id = 0
+		self.cond    = threading.Condition()
+		self.poller  = None
+	def _changed(self, job):
+		self.version += 1
+		job.version = self.version
+		job.updated = time.time()
+		self.cond.notify_all()
+	def Add(self, uid, title):
+		with self.cond:
+			self.next_id += 1
+			job = Job(self.next_id, uid, title)
+			self.users.setdefault(uid, deque(maxlen=self.keep)).append(job)
+			self._changed(job)
+			# Started lazily, so that it runs in the worker rather than a forking master
+			if self.poller is None:
+				self.poller = threading.Thread(target=self._poll)
+				self.poller.daemon = True
+				self.poller.start()
+		return job
+	def Set(self, job, state, message='', cups_id=None):
+		with self.cond:
+			job.state = state
+			job.message = message
+			if cups_id is not None:
+				job.cups_id = cups_id
+			self._changed(job)
+	def Since(self, uid, version, timeout):
+		deadline = time.time() + timeout
+		with self.cond:
+			while True:
+				jobs = [job for job in self.users.get(uid, ()) if job.version > version]
+				remaining = deadline - time.time()
+				if jobs or remaining <= 0:
+					return self.version, [job.ToDict() for job in jobs]
+				self.cond.wait(remaining)
+	def Active(self, uid):
+		with self.cond:
+			return any(job.state not in ('done', 'failed') for job in self.users.get(uid, ()))
+	def _printing(self):
+		with self.cond:
+			return [job for jobs in self.users.itervalues() for job in jobs if job.state == 'printing' and job.cups_id is not None]
+	def _poll(self):
+		while True:
+			time.sleep(self.interval)
+			jobs = self._printing()
+			if not jobs:
+				continue
+			try:
+				states = self.client.JobStates([job.cups_id for job in jobs])
+			except Exception:
+				traceback.print_exc()
+				continue
+			for job in jobs:
+				# CUPS forgets finished jobs eventually; one it does not know has finished
+				state = CUPS_STATES.get(states.get(job.cups_id), 'done')
+				if state != job.state:
+					self.Set(job, state, states.get(job.cups_id, ''))
+
+board = JobBoard(ipp.IPPClient(conf.IPP_SOCKET, conf.IPP_PRINTER), conf.JOB_POLL_INTERVAL, conf.JOB_STATUS_KEEP)
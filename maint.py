@@ -0,0 +1,259 @@
+'''
+print -- CSLabs Print Server
+maint -- Database Maintenance
+
+This module backs up, compacts and checks the server's sqlite databases (DATABASES:
+"pykota", pykota.db, and "sessions", sessions.db) while the server is running. Every
+operation uses a connection of its own, never userdb's or sessiondb's, so it does not
+disturb their transactions, and works in small steps where sqlite allows it, so that
+requests are never locked out for long:
+
+-Backup(name) copies a database to conf.BACKUP_DIR, conf.BACKUP_STEP_PAGES pages at a
+ time, sleeping conf.BACKUP_STEP_SLEEP seconds between steps, during which the database
+ is unlocked. If a write is committed during the copy, the copy starts over (after
+ conf.BACKUP_RESTARTS restarts, the last copy is made in one step). This is what
+ sqlite's online backup API does; it is used through apsw when that is installed (the
+ sqlite3 module of Python 2 does not expose it), and emulated by copying the file
+ otherwise. Only the conf.BACKUP_KEEP newest backups of each database are kept.
+-Vacuum(name) returns free pages to the filesystem with incremental VACUUM,
+ conf.VACUUM_STEP_PAGES pages per transaction. Incremental VACUUM needs
+ auto_vacuum=INCREMENTAL, which a database created without it only gets from one full
+ (blocking) VACUUM; the first Vacuum() of such a database does that.
+-Analyze(name) updates the query planner's statistics, reading at most
+ conf.ANALYZE_LIMIT rows of each index (where sqlite supports analysis_limit).
+-Check(name, quick=False) runs PRAGMA integrity_check (or quick_check), which holds a
+ read lock throughout; it cannot be done in steps.
+
+Maintain(name) runs a quick check, a backup, ANALYZE and incremental VACUUM in turn (see
+TASKS), stopping if the check fails, as the console's scheduled maintenance does. Each
+operation returns a Report, with the file size, page count and free page count of the
+database before and after, the time taken and notes (such as the backup's file name or
+the problems found by a check); str() of a Report is a summary for the console.
+'''
+
+import os
+import time
+import glob
+import sqlite3
+
+try:
+	import apsw
+except ImportError:
+	apsw = None
+
+import conf
+
+DATABASES = {
+	'pykota': os.path.join(os.path.dirname(__file__), 'pykota.db'),
+	'sessions': os.path.join(os.path.dirname(__file__), 'sessions.db'),
+}
+
+class MaintenanceError(Exception):
+	pass
+
+class Stats(object):
+	def __init__(self, path):
+		self.size = os.path.getsize(path)
+		conn = sqlite3.connect(path)
+		try:
+			self.page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+			self.pages     = conn.execute('PRAGMA page_count').fetchone()[0]
+			self.free      = conn.execute('PRAGMA freelist_count').fetchone()[0]
+		finally:
+			conn.close()
+	def __str__(self):
+		return '%d bytes, %d pages (%d free)'%(self.size, self.pages, self.free)
+
+class Report(object):
+	def __init__(self, name, action, before, after, elapsed, notes=()):
+		self.name    = name
+		self.action  = action
+		self.before  = before
+		self.after   = after
+		self.elapsed = elapsed
+		self.notes   = list(notes)
+		self.ok      = True
+	def __str__(self):
+		lines = ['%s of %s took %.2fs'%(self.action, self.name, self.elapsed),
+				 '  before: %s'%(self.before,),
+				 '  after:  %s'%(self.after,)]
+		lines.extend('  '+note for note in self.notes)
+		return '\n'.join(lines)
+
+def _path(name):
+	try:
+		return DATABASES[name]
+	except KeyError:
+		raise MaintenanceError('Unknown database: %s (expected one of %s)'%(name, ', '.join(sorted(DATABASES))))
+
+def _connect(path):
+	# In autocommit mode, so that transactions are only those begun here
+	return sqlite3.connect(path, timeout=conf.MAINT_BUSY_TIMEOUT, isolation_level=None)
+
+def _run(name, action, f):
+	path = _path(name)
+	before = Stats(path)
+	start = time.time()
+	notes = f(path)
+	return Report(name, action, before, Stats(path), time.time() - start, notes)
+
+def _backup_apsw(path, dest, progress):
+	src = apsw.Connection(path)
+	src.setbusytimeout(int(1000*conf.MAINT_BUSY_TIMEOUT))
+	out = apsw.Connection(dest)
+	steps = 0
+	with out.backup('main', src, 'main') as backup:
+		while not backup.done:
+			backup.step(conf.BACKUP_STEP_PAGES)
+			steps += 1
+			if progress:
+				progress(backup.pagecount - backup.remaining, backup.pagecount)
+			if not backup.done:
+				time.sleep(conf.BACKUP_STEP_SLEEP)
+	out.close()
+	src.close()
+	return ['%d steps (sqlite backup API)'%(steps,)]
+
+def _backup_copy(path, dest, progress):
+	conn = _connect(path)
+	try:
+		if conn.execute('PRAGMA journal_mode').fetchone()[0].lower() == 'wal':
+			# The main file alone is not the database; copy a snapshot instead
+			conn.execute('VACUUM INTO ?', (dest,))
+			return ['copied with VACUUM INTO (WAL database)']
+		restarts = 0
+		while True:
+			step = conf.BACKUP_STEP_PAGES if restarts < conf.BACKUP_RESTARTS else None
+			steps, done = _copy_pages(conn, path, dest, step, progress)
+			if done:
+				return ['%d steps, %d restarts'%(steps, restarts)]
+			restarts += 1
+	finally:
+		conn.close()
+
+# Copies the file of the database, step pages at a time (or all at once if step is None),
+# each under a read lock; returns (steps, done), where done is False if a write was
+# committed during the copy
+def _copy_pages(conn, path, dest, step, progress):
+	version = None
+	steps = 0
+	offset = 0
+	with open(path, 'rb') as src, open(dest, 'wb') as out:
+		while True:
+			conn.execute('BEGIN')
+			try:
+				# Reading the schema takes the read lock (and rolls back a hot journal)
+				conn.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+				current = conn.execute('PRAGMA data_version').fetchone()[0]
+				if version is None:
+					version = current
+				elif current != version:
+					return steps, False
+				page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+				pages = conn.execute('PRAGMA page_count').fetchone()[0]
+				src.seek(offset)
+				data = src.read(pages*page_size - offset if step is None else min(step*page_size, pages*page_size - offset))
+			finally:
+				conn.execute('COMMIT')
+			out.write(data)
+			offset += len(data)
+			steps += 1
+			if progress:
+				progress(offset // page_size, pages)
+			if offset >= pages*page_size:
+				out.truncate(offset)
+				return steps, True
+			time.sleep(conf.BACKUP_STEP_SLEEP)
+
+def Backup(name, progress=None):
+	'''Backs up a database to conf.BACKUP_DIR; progress, if given, is called with (pages done, pages).'''
+	def backup(path):
+		if not os.path.isdir(conf.BACKUP_DIR):
+			os.makedirs(conf.BACKUP_DIR)
+		dest = os.path.join(conf.BACKUP_DIR, '%s-%s.db'%(name, time.strftime('%Y%m%d-%H%M%S')))
+		tmp = dest+'.tmp'
+		try:
+			notes = (_backup_apsw if apsw is not None else _backup_copy)(path, tmp, progress)
+			os.rename(tmp, dest)
+		finally:
+			if os.path.exists(tmp):
+				os.unlink(tmp)
+		notes.insert(0, 'backup: %s (%s)'%(dest, Stats(dest)))
+		# Names sort by time
+		for old in sorted(glob.glob(os.path.join(conf.BACKUP_DIR, name+'-*.db')))[:-conf.BACKUP_KEEP]:
+			os.unlink(old)
+			notes.append('removed old backup %s'%(old,))
+		return notes
+	return _run(name, 'Backup', backup)
+
+def Vacuum(name, max_pages=None):
+	'''Returns free pages (at most max_pages, if given) to the filesystem.'''
+	def vacuum(path):
+		conn = _connect(path)
+		try:
+			if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+				conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+				conn.execute('VACUUM')
+				return ['full VACUUM, to enable incremental VACUUM']
+			freed = 0
+			while max_pages is None or freed < max_pages:
+				free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+				if not free:
+					break
+				step = min(free, conf.VACUUM_STEP_PAGES, (max_pages - freed) if max_pages is not None else free)
+				conn.execute('PRAGMA incremental_vacuum(%d)'%(step,)).fetchall()
+				freed += step
+				time.sleep(conf.BACKUP_STEP_SLEEP)
+			return ['%d pages freed'%(freed,)]
+		finally:
+			conn.close()
+	return _run(name, 'Vacuum', vacuum)
+
+def Analyze(name):
+	def analyze(path):
+		conn = _connect(path)
+		try:
+			# Ignored by sqlite older than 3.32, which reads every row
+			conn.execute('PRAGMA analysis_limit=%d'%(conf.ANALYZE_LIMIT,))
+			conn.execute('ANALYZE')
+			return []
+		finally:
+			conn.close()
+	return _run(name, 'Analyze', analyze)
+
+def Check(name, quick=False):
+	def check(path):
+		conn = _connect(path)
+		try:
+			results = [row[0] for row in conn.execute('PRAGMA quick_check' if quick else 'PRAGMA integrity_check')]
+		finally:
+			conn.close()
+		if results == ['ok']:
+			return ['no problems found']
+		return ['PROBLEM: '+result for result in results]
+	report = _run(name, 'Quick check' if quick else 'Integrity check', check)
+	report.ok = report.notes == ['no problems found']
+	return report
+
+# The operations of Maintain(), in order
+TASKS = ('check', 'backup', 'analyze', 'vacuum')
+
+def Maintain(name, tasks=TASKS, progress=None):
+	'''Runs the given operations on a database, stopping after a failed check; returns their Reports.'''
+	reports = []
+	for task in tasks:
+		if task == 'check':
+			report = Check(name, True)
+		elif task == 'backup':
+			report = Backup(name, progress)
+		elif task == 'analyze':
+			report = Analyze(name)
+		elif task == 'vacuum':
+			report = Vacuum(name)
+		else:
+			raise MaintenanceError('Unknown task: %s'%(task,))
+		reports.append(report)
+		# A damaged database should not replace a good backup
+		if not report.ok:
+			break
+	return reports
@@ -0,0 +1,133 @@
+'''
+print -- CSLabs Print Server
+preprocess -- Spool Payload Preprocessing
+
+This module shrinks documents before they are handed to lp, so that less data has to
+reach the printer before it can start:
+
+-Images (conf.IMAGE_EXTENSIONS) are downsampled to at most conf.PRINTER_DPI over a
+ Letter page and recompressed into a single-page PDF.
+-PDFs with a page range selected have the range extracted here, and the range is then
+ dropped from the options given to lp (which would otherwise send the whole document
+ and let the printer skip pages).
+
+Both steps rely on optional libraries (PIL for images, PyPDF2 for page extraction); if a
+library is not installed, or a document cannot be processed, it is spooled unchanged.
+The result is only used when it is smaller than the input.
+
+	fname, opts = Preprocess(fname, ext, opts)
+
+Preprocess() returns the file to spool (the input path, or a new file next to it which
+the caller must remove) and the print options to spool it with.
+
+Every processed job is recorded in the module's "stats" (a PreprocessStats), which holds
+the total bytes in and out and the most recent per-job records.
+'''
+
+import os
+import sys
+import time
+import threading
+import traceback
+from collections import deque
+
+import conf
+
+try:
+	from PIL import Image
+except ImportError:
+	Image = None
+
+try:
+	from PyPDF2 import PdfFileReader, PdfFileWriter
+except ImportError:
+	PdfFileReader = PdfFileWriter = None
+
+# Printable area of a Letter page, in inches
+PAGE_SIZE = (8.0, 10.5)
+
+class PreprocessStats(object):
+	def __init__(self, size):
+		self.jobs      = 0
+		self.bytes_in  = 0
+		self.bytes_out = 0
+		self.recent    = deque(maxlen=size)
+		self.lock      = threading.Lock()
+	def Record(self, fname, step, before, after, elapsed):
+		with self.lock:
+			self.jobs += 1
+			self.bytes_in += before
+			self.bytes_out += after
+			self.recent.append((time.time(), os.path.basename(fname), step, before, after, elapsed))
+		sys.stderr.write('preprocess: %s %s %d -> %d bytes (%.1f%%) in %.3fs\n'%(step, os.path.basename(fname), before, after, 100.0*after/before if before else 100.0, elapsed))
+
+stats = PreprocessStats(100)
+
+# Parses an lp page range ("1-3,5,8-") into a sorted list of 0-based page indices; as with
+# lp -P, pages are printed in document order and once each, however the range lists them
+def page_indices(pages, npages):
+	ret = set()
+	for part in pages.split(','):
+		if not part:
+			continue
+		first, dash, last = part.partition('-')
+		first = int(first) if first else 1
+		last = (int(last) if last else npages) if dash else first
+		ret.update(i-1 for i in xrange(max(first, 1), min(last, npages)+1))
+	return sorted(ret)
+
+def shrink_image(fname):
+	img = Image.open(fname)
+	w, h = img.size
+	box = [int(dim*conf.PRINTER_DPI) for dim in (PAGE_SIZE if h >= w else reversed(PAGE_SIZE))]
+	if img.format == 'JPEG':
+		img.draft('RGB', tuple(box))
+	if img.mode != 'RGB':
+		if img.mode in ('RGBA', 'LA', 'P'):
+			img = img.convert('RGBA')
+			bg = Image.new('RGB', img.size, (255, 255, 255))
+			bg.paste(img, mask=img.split()[-1])
+			img = bg
+		else:
+			img = img.convert('RGB')
+	img.thumbnail(tuple(box), Image.ANTIALIAS)
+	out = os.path.splitext(fname)[0]+'.pre.pdf'
+	img.save(out, 'PDF', resolution=float(conf.PRINTER_DPI), quality=conf.IMAGE_QUALITY)
+	return out
+
+def extract_pages(fname, pages):
+	with open(fname, 'rb') as src:
+		reader = PdfFileReader(src, strict=False)
+		if reader.isEncrypted:
+			return None
+		writer = PdfFileWriter()
+		for i in page_indices(pages, reader.getNumPages()):
+			writer.addPage(reader.getPage(i))
+		if not writer.getNumPages():
+			return None
+		out = os.path.splitext(fname)[0]+'.pre.pdf'
+		with open(out, 'wb') as f:
+			writer.write(f)
+	return out
+
+def Preprocess(fname, ext, opts):
+	if ext in conf.IMAGE_EXTENSIONS and Image is not None:
+		step, func, newopts = 'image', shrink_image, opts
+	elif ext == 'pdf' and opts['pages'] and PdfFileReader is not None:
+		step, func, newopts = 'pages', lambda fname: extract_pages(fname, opts['pages']), dict(opts, pages='')
+	else:
+		return fname, opts
+	start = time.time()
+	try:
+		out = func(fname)
+	except Exception:
+		traceback.print_exc()
+		return fname, opts
+	if out is None:
+		return fname, opts
+	before, after = os.path.getsize(fname), os.path.getsize(out)
+	stats.Record(fname, step, before, after, time.time() - start)
+	if after >= before:
+		os.unlink(out)
+		return fname, opts
+	return out, newopts
@@ -0,0 +1,211 @@
+'''
+print -- CSLabs Print Server
+preview -- Print Previews
+
+This module renders small thumbnails of the pages of a document, so that the print page
+can show what is about to be printed before the user confirms it. Rendering happens on
+background worker threads (conf.PREVIEW_WORKERS of them), never in the request:
+
+	cache.Request(digest, fname, pages)
+
+queues the document fname (already saved, e.g. as an upload; see upload.Upload.Store)
+for rendering, where digest is the SHA-256 of its contents and pages the page range
+selected for printing (in lp syntax, or empty). The first conf.PREVIEW_PAGES pages of
+the document and the first conf.PREVIEW_PAGES pages of the selection are rendered, at
+conf.PREVIEW_DPI. Documents are converted to PDF as for printing (see convert.ToPDF) and
+pages are rendered with pdftoppm, through runner; images are thumbnailed with PIL.
+
+Thumbnails are cached on disk (in conf.PREVIEW_DIR, one directory per digest) by content
+hash, so the same document is never rendered twice, whoever uploads it, and a changed
+page selection only renders the pages not seen yet. Once the cache exceeds
+conf.PREVIEW_CACHE_SIZE bytes, the least recently used documents are evicted.
+
+	cache.Status(digest)		# {'state': 'pending', 'npages': 12, 'pages': [1, 2]}
+	cache.Get(digest, page)		# path of the thumbnail of a page, or None
+
+The state is "pending" while pages are being rendered (or have not been asked for),
+"ready" once the document has been rendered and "failed" if it could not be.
+
+At most conf.PREVIEW_QUEUE documents wait to be rendered; Request() raises
+admission.Busy when the queue is full. If cache.limit is set to an
+admission.ConcurrencyLimit (print.py sets it to its conversion limit), a worker holds
+a slot of it while it renders, so that previews and print jobs share the same bound on
+conversions.
+'''
+
+import os
+import json
+import Queue
+import shutil
+import tempfile
+import threading
+import traceback
+
+import conf
+import convert
+from admission import Busy
+import preprocess
+import runner
+
+class PreviewCache(object):
+	def __init__(self, path, max_bytes, workers, queue_size, limit=None):
+		self.path      = path
+		self.max_bytes = max_bytes
+		self.workers   = workers
+		self.limit     = limit
+		self.queue     = Queue.Queue(queue_size)
+		self.pending   = {}
+		self.lock      = threading.Lock()
+		self.threads   = []
+	def _dir(self, digest):
+		return os.path.join(self.path, digest)
+	def _thumb(self, digest, page):
+		return os.path.join(self._dir(digest), '%d.png'%(page,))
+	def _info(self, digest):
+		try:
+			with open(os.path.join(self._dir(digest), 'info')) as f:
+				return json.load(f)
+		except (IOError, ValueError):
+			return {}
+	def _set_info(self, digest, **info):
+		with open(os.path.join(self._dir(digest), 'info'), 'w') as f:
+			json.dump(info, f)
+	def Get(self, digest, page):
+		fname = self._thumb(digest, page)
+		if not os.path.exists(fname):
+			return None
+		# The directory's mtime orders documents for eviction
+		try:
+			os.utime(self._dir(digest), None)
+		except OSError:
+			pass
+		return fname
+	def Status(self, digest):
+		info = self._info(digest)
+		try:
+			pages = sorted(int(name[:-4]) for name in os.listdir(self._dir(digest)) if name.endswith('.png'))
+		except OSError:
+			pages = []
+		with self.lock:
+			pending = digest in self.pending
+		if pending or not info:
+			state = 'pending'
+		else:
+			state = info.get('state', 'pending')
+		return {'state': state, 'npages': info.get('npages'), 'pages': pages}
+	def Request(self, digest, fname, pages=''):
+		with self.lock:
+			self.pending[digest] = self.pending.get(digest, 0) + 1
+			# Started lazily, so that they run in the worker rather than a forking master
+			while len(self.threads) < self.workers:
+				thread = threading.Thread(target=self._work)
+				thread.daemon = True
+				thread.start()
+				self.threads.append(thread)
+		try:
+			self.queue.put_nowait((digest, fname, pages))
+		except Queue.Full:
+			self._done(digest)
+			raise Busy('preview', conf.BUSY_RETRY_AFTER)
+	def _done(self, digest):
+		with self.lock:
+			self.pending[digest] -= 1
+			if not self.pending[digest]:
+				del self.pending[digest]
+	def _acquire(self):
+		# A worker has nothing else to do, so it waits for as long as it takes
+		while self.limit is not None:
+			try:
+				self.limit.Acquire()
+				return
+			except Busy:
+				pass
+	def _work(self):
+		while True:
+			digest, fname, pages = self.queue.get()
+			self._acquire()
+			try:
+				self._render(digest, fname, pages)
+			except Exception:
+				traceback.print_exc()
+				try:
+					self._set_info(digest, state='failed', npages=None)
+				except IOError:
+					pass
+			finally:
+				if self.limit is not None:
+					self.limit.Release()
+				self._done(digest)
+			self._evict()
+	def _wanted(self, pages, npages):
+		wanted = range(1, min(npages or conf.PREVIEW_PAGES, conf.PREVIEW_PAGES)+1)
+		if pages:
+			wanted += [i+1 for i in preprocess.page_indices(pages, npages or 0x7fffffff)[:conf.PREVIEW_PAGES]]
+		return sorted(set(wanted))
+	def _render(self, digest, fname, pages):
+		outdir = self._dir(digest)
+		if not os.path.isdir(outdir):
+			os.makedirs(outdir)
+		info = self._info(digest)
+		if info.get('state') == 'failed':
+			return
+		npages = info.get('npages')
+		wanted = [page for page in self._wanted(pages, npages) if not os.path.exists(self._thumb(digest, page))]
+		if info and not wanted:
+			return
+		ext = fname.rpartition('.')[2].lower()
+		tmpdir = tempfile.mkdtemp()
+		try:
+			# Conversion writes next to its input
+			src = os.path.join(tmpdir, 'doc.'+ext)
+			shutil.copyfile(fname, src)
+			if ext in conf.IMAGE_EXTENSIONS and preprocess.Image is not None:
+				img = preprocess.Image.open(src)
+				img.thumbnail((int(conf.PREVIEW_DPI*8.5), int(conf.PREVIEW_DPI*11)), preprocess.Image.ANTIALIAS)
+				if img.mode not in ('RGB', 'L'):
+					img = img.convert('RGB')
+				img.save(self._thumb(digest, 1), 'PNG')
+				self._set_info(digest, state='ready', npages=1)
+				return
+			pdf = convert.ToPDF(src)
+			if pdf is None:
+				self._set_info(digest, state='failed', npages=None)
+				return
+			if npages is None and preprocess.PdfFileReader is not None:
+				with open(pdf, 'rb') as f:
+					npages = preprocess.PdfFileReader(f, strict=False).getNumPages()
+				wanted = [page for page in self._wanted(pages, npages) if not os.path.exists(self._thumb(digest, page))]
+			for page in wanted:
+				out = os.path.join(tmpdir, 'page%d'%(page,))
+				outcome = runner.Run(['pdftoppm', '-png', '-r', str(conf.PREVIEW_DPI), '-f', str(page), '-l', str(page), '-singlefile', pdf, out], conf.CONVERT_TIMEOUT, conf.CONVERT_MEMORY, conf.CONVERT_CPU)
+				# Pages past the end (when the page count is unknown) simply fail
+				if outcome.ok and os.path.exists(out+'.png'):
+					os.rename(out+'.png', self._thumb(digest, page))
+			rendered = any(os.path.exists(self._thumb(digest, page)) for page in self._wanted(pages, npages))
+			self._set_info(digest, state='ready' if rendered else 'failed', npages=npages)
+		finally:
+			shutil.rmtree(tmpdir, True)
+	def _evict(self):
+		if not os.path.isdir(self.path):
+			return
+		docs = []
+		total = 0
+		for digest in os.listdir(self.path):
+			path = self._dir(digest)
+			try:
+				size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+				docs.append((os.path.getmtime(path), size, digest))
+			except OSError:
+				continue
+			total += size
+		docs.sort()
+		for mtime, size, digest in docs:
+			if total <= self.max_bytes:
+				break
+			with self.lock:
+				if digest in self.pending:
+					continue
+			shutil.rmtree(self._dir(digest), True)
+			total -= size
+
+cache = PreviewCache(conf.PREVIEW_DIR, conf.PREVIEW_CACHE_SIZE, conf.PREVIEW_WORKERS, conf.PREVIEW_QUEUE)
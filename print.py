@@ -3,18 +3,117 @@ import smtplib
 import base64
 import re
 import traceback
+import json
+import shutil
+import tempfile
+import socket
+import httplib
+import time
 #import urllib
 
-from flask import Flask, render_template, redirect, url_for, request, g, flash
+from flask import Flask, render_template, redirect, url_for, request, g, flash, jsonify, Response, send_file
+from jinja2 import FileSystemBytecodeCache
+from werkzeug.datastructures import MultiDict
 from userdb import User, Group, AccessEntry, AccessToken, DBError, NoSuchEntity, TooManyEntities
 from sessiondb import Session
+from dedup import DedupIndex
+from admission import Busy, RateLimiter, ConcurrencyLimit
+from fairshare import FairScheduler
+from upload import Upload, UploadError, NoSuchUpload
+from preprocess import Preprocess, PdfFileReader, page_indices
+from convert import ToPDF, ConvertAll, Merge, MergeError, ExtractArchive, ArchiveError
+from sniff import SniffStream, SniffFile, Unprintable
+import runner
+from ipp import IPPClient
+import ipp
+import jobstatus
+import preview
+import usage
+import profiler
 import conf
 import os
 
 app = Flask('print')
-app.debug = True
+app.debug = conf.DEBUG
+if not app.debug:
+	# Set on the environment itself: setting app.debug creates it (on Flask 1.0 and later),
+	# after which app.jinja_options is no longer read
+	if not os.path.isdir(conf.TEMPLATE_CACHE_DIR):
+		os.makedirs(conf.TEMPLATE_CACHE_DIR)
+	app.jinja_env.auto_reload = False
+	app.jinja_env.bytecode_cache = FileSystemBytecodeCache(conf.TEMPLATE_CACHE_DIR)
+
+# Rendered parts of pages that are the same for every user (see cached_fragment)
+fragments = {}
+
+# Returns the fragment for key, rendering it with render() the first time; key must hold
+# everything the fragment depends on. In debug mode, nothing is cached.
+def cached_fragment(key, render):
+	if app.debug:
+		return render()
+	try:
+		return fragments[key]
+	except KeyError:
+		fragments[key] = value = render()
+		return value
+
+# Compiles every template (loading it from the bytecode cache if it is there), so that
+# no request has to
+def precompile_templates():
+	for name in app.jinja_env.list_templates(extensions=('html', 'txt')):
+		app.jinja_env.get_template(name)
+
+# The allowed extensions, as listed on the print page
+@app.template_global()
+def extension_list():
+	return cached_fragment(('extensions', tuple(conf.ALL_EXTENSIONS)), lambda: ', '.join(conf.ALL_EXTENSIONS))
 
 valid_page = re.compile("^[-,0-9]*$")
+lp_request_id = re.compile(r"request id is .*-([0-9]+) ")
+
+# Connection to CUPS for submitting jobs, if IPP is used
+printer = IPPClient(conf.IPP_SOCKET, conf.IPP_PRINTER) if conf.SPOOLER == 'ipp' else None
+
+# Recent print submissions, used to ignore duplicates
+submissions = DedupIndex(conf.DEDUP_WINDOW, conf.DEDUP_SIZE)
+
+# Admission control for print submissions and conversions
+submit_limiter = RateLimiter(conf.RATE_LIMIT_PER_MINUTE / 60.0, conf.RATE_LIMIT_BURST)
+conversions = ConcurrencyLimit('conversion', conf.MAX_CONVERSIONS, conf.ADMISSION_WAIT, conf.BUSY_RETRY_AFTER)
+# Preview rendering takes conversion slots too (see preview)
+preview.cache.limit = conversions
+
+# Whether the print page may watch jobs over a long-lived event stream; set by serve.py,
+# where such a stream holds a greenlet rather than a worker thread (see job_watch)
+stream_jobs = False
+
+# Fair-share order in which jobs held in CUPS are released (see dispatch_job, cups_finished
+# and restore_jobs)
+scheduler = FairScheduler(lambda item: dispatch_job(item), lambda job_id: cups_finished(job_id), conf.SCHED_WINDOW, conf.SCHED_MAX_WAIT, conf.SCHED_HALF_LIFE, conf.SCHED_CLASSES, conf.JOB_POLL_INTERVAL, lambda: restore_jobs())
+
+# Starts the scheduler on a worker's first request, so that jobs left held in CUPS are
+# released (see restore_jobs) without waiting for someone to submit another
+@app.before_first_request
+def start_scheduler():
+	scheduler.Start()
+
+# Before running view: sample the request if profiling is on (see profiler); registered
+# first, so that it also covers the other before_request functions
+@app.before_request
+def do_begin_profile():
+	profiler.sampler.Begin(request.endpoint or 'unrouted')
+
+# After running view: stop sampling the request (this runs after the other
+# after_request functions, which run in reverse order)
+@app.after_request
+def do_end_profile(resp):
+	profiler.sampler.End()
+	return resp
+
+# A view that raises skips after_request; the sample must still end
+@app.teardown_request
+def do_teardown_profile(exc):
+	profiler.sampler.End()
 
 # Runs a function with a response after the response has been generated
 def add_after_request(f):
@@ -38,20 +137,26 @@ def flash(msg, cat):
 	g.flashes.append((msg, cat))
 
 # Gets User and Session objects for a given request
+# (API clients may instead present the session ID as an "Authorization: Bearer" token)
 def get_user_session(request):
 	sid = request.cookies.get('session')
-	try:
-		sid = int(sid)
-	except (ValueError, TypeError):
-		sid = None
+	auth = request.headers.get('Authorization', '')
+	if auth.startswith('Bearer '):
+		sid = auth[len('Bearer '):].strip()
+	sess = None
 	if sid:
 		try:
 			sess = Session.FromID(sid)
 		except DBError:
-			sid = None
-	if not sid:
+			pass
+	if sess is None:
 		sess = Session.Create(User.NOBODY)
-		add_after_request(lambda resp: resp.set_cookie('session', str(sess.id)))
+	# The session ID may also change during the view (see Session.Update)
+	def set_cookie(resp):
+		if str(sess.id) != sid:
+			resp.set_cookie('session', str(sess.id))
+		return resp
+	add_after_request(set_cookie)
 	user=sess.User()
 	return user, sess
 
@@ -73,15 +178,17 @@ def do_set_global_conf():
 def index():
 	return redirect(url_for('print_main'))
 	
-# View for /print/ (a frame set)
+# View for /print/ (a frame set); it is the same for every user, so it is rendered once
+# per mount point
 @app.route('/print/')
 def print_main():
-	return render_template('print_main.html', operations=[['Log In/Out', url_for('loginout')],
+	return cached_fragment(('print_main', request.script_root), lambda: render_template('print_main.html', operations=[['Log In/Out', url_for('loginout')],
 														  ['Register', url_for('register')],
 														  ['Print File', url_for('print_file')],
 														  ['Set password', url_for('passwd')],
+														  ['Usage', url_for('show_usage')],
 														  ['Reset account password', url_for('reset_pw')],
-														  ['Contact maintainers', url_for('contact')]])
+														  ['Contact maintainers', url_for('contact')]]))
 
 # Null operation view
 @app.route('/print/op/null/')
@@ -247,6 +354,369 @@ def print_test():
 		os.system('lp -U %s /home/vaillap/test.txt'%g.user.username) 
 		return 'You just printed a test page!  How do you feel about yourself?'
 
+# Parses the print options submitted with a job; returns None if they are malformed
+def parse_options(values):
+	pages = values.get('pages', '')
+	if not valid_page.match(pages):
+		return None
+	return {
+		'copies': values.get('copies', 1, int),
+		'pages': pages,
+		'collate': bool(values.get('collate', '')),
+		'duplex': values.get('duplex', False, bool),
+	}
+
+# Builds the lp command line options for a job
+def lp_options(user, filename, opts):
+	options = []
+	options.append('-n %d'%(opts['copies'],))
+	if opts['pages']:
+		options.append('-P "%s"'%(opts['pages'],))
+	if opts['collate']:
+		options.append('-o Collate=True')
+	options.append('-o sides=two-sided-long-edge' if opts['duplex'] else '-o sides=one-sided')
+	options.append('-o media=Letter')
+	options.append('-U "%s"'%(user.username,))
+	options.append('-t \'%s:%s\''%(user.username.replace("'", '_'), filename.replace("'", '_')))
+	options.append('-H hold')
+	return options
+
+# Tells whether a file name has an extension that may be printed on its own
+def printable(filename):
+	ext = filename.rpartition('.')[2].lower()
+	return ext in conf.ALLOWED_EXTENSIONS or ext in conf.CONVERTABLE_EXTENSIONS
+
+# Tells whether a file name is that of an archive to be printed as one merged job
+def is_archive(filename):
+	return filename.rpartition('.')[2].lower() in conf.ARCHIVE_EXTENSIONS
+
+# Parses an lp page range ("1-3,5,8-") into a list of (first, last) pairs for IPP
+def page_ranges(pages):
+	ret = []
+	for part in pages.split(','):
+		if not part:
+			continue
+		first, dash, last = part.partition('-')
+		first = int(first) if first else 1
+		last = (int(last) if last else 0x7fffffff) if dash else first
+		ret.append((first, last))
+	return ret
+
+# Builds the IPP job attributes for a job, equivalent to lp_options
+def ipp_attributes(opts):
+	attrs = [(ipp.TAG_INTEGER, 'copies', [opts['copies']])]
+	if opts['pages']:
+		attrs.append((ipp.TAG_RANGE, 'page-ranges', page_ranges(opts['pages'])))
+	if opts['collate']:
+		attrs.append((ipp.TAG_KEYWORD, 'multiple-document-handling', ['separate-documents-collated-copies']))
+	attrs.append((ipp.TAG_KEYWORD, 'sides', ['two-sided-long-edge' if opts['duplex'] else 'one-sided']))
+	attrs.append((ipp.TAG_KEYWORD, 'media', ['na_letter_8.5x11in']))
+	attrs.append((ipp.TAG_KEYWORD, 'job-hold-until', ['indefinite']))
+	return attrs
+
+# Hands a file to CUPS (over IPP, or with lp as a fallback), which holds the job until
+# release_job; returns the job ID, or None if unknown. Raises runner.Failed if lp fails,
+# and ipp.Unconfirmed (without falling back to lp) if the connection failed after the job
+# was sent.
+def send_to_printer(user, fname, filename, opts):
+	if printer is not None:
+		try:
+			return printer.PrintJob(fname, user.username, '%s:%s'%(user.username, filename), ipp_attributes(opts))
+		except ipp.Unconfirmed:
+			# CUPS may have accepted the job; lp would print it a second time
+			raise
+		except (ipp.IPPError, socket.error, httplib.HTTPException):
+			traceback.print_exc()
+	# runner rather than os.system, so that lp is bounded and serve.py can wait for it cooperatively
+	outcome = runner.Run('lp %s %s'%(' '.join(lp_options(user, filename, opts)), fname), conf.SPOOL_TIMEOUT, conf.SPOOL_MEMORY, shell=True, capture=True)
+	match = lp_request_id.search(outcome.Check().output)
+	return int(match.group(1)) if match else None
+
+# Lets CUPS print a job held by send_to_printer (over IPP, or with lp as a fallback).
+# Raises ipp.IPPError if CUPS refuses (as it does once the job is no longer held), and
+# runner.Failed if lp fails.
+def release_job(job_id, username):
+	if printer is not None:
+		try:
+			printer.ReleaseJob(job_id, username)
+			return
+		except (socket.error, httplib.HTTPException):
+			traceback.print_exc()
+	runner.Run('lp -i %d -H resume -U "%s"'%(job_id, username), conf.SPOOL_TIMEOUT, conf.SPOOL_MEMORY, shell=True, capture=True).Check()
+
+# Saves an uploaded file, returning the hex SHA-256 digest of its contents
+def save_upload(rfile, fname):
+	digest = hashlib.sha256()
+	with open(fname, 'wb') as f:
+		while True:
+			chunk = rfile.stream.read(65536)
+			if not chunk:
+				break
+			digest.update(chunk)
+			f.write(chunk)
+	return digest.hexdigest()
+
+# Estimates the number of pages a preprocessed file prints (with copies), for scheduling
+def estimate_pages(fname, ext, opts):
+	npages = None
+	if ext == 'pdf' and PdfFileReader is not None:
+		try:
+			with open(fname, 'rb') as f:
+				npages = PdfFileReader(f, strict=False).getNumPages()
+		except Exception:
+			pass
+	elif ext in conf.IMAGE_EXTENSIONS:
+		npages = 1
+	if npages is None:
+		# Roughly a page per 3 KB of text, or per 32 KB of PDF, PostScript or printer data
+		npages = os.path.getsize(fname) // (32768 if ext in ('pdf', 'ps', 'prn') else 3072) + 1
+	if opts['pages']:
+		npages = len(page_indices(opts['pages'], npages))
+	return npages * opts['copies']
+
+# Converts (if necessary) and preprocesses a saved file, then hands it to CUPS, held, and
+# queues it for release (see scheduler); returns a (message, category) flash.
+# fname may also be a list of (path, name) pairs, which are converted in parallel and merged.
+# Progress is recorded on job (see jobstatus). A file is handled according to the extension
+# it was saved with, which reflects its content (see sniff) rather than the name it was sent with.
+def spool_file(user, fname, filename, opts, job):
+	ext = '' if isinstance(fname, list) else fname.rpartition('.')[2].lower()
+	cleanup = []
+	try:
+		jobstatus.board.Set(job, 'converting')
+		if isinstance(fname, list):
+			# One slot per conversion running at once
+			slots = conversions.AcquireUpTo(min(len(fname), conf.CONVERT_WORKERS))
+			try:
+				pdfs = ConvertAll([path for path, name in fname], slots)
+			finally:
+				conversions.Release(slots)
+			failed = [name for (path, name), pdf in zip(fname, pdfs) if pdf is None]
+			if failed:
+				return ('Could not convert %s to PDF'%(', '.join(failed),), 'error')
+			try:
+				fname = Merge(pdfs, os.path.join(os.path.dirname(pdfs[0]), 'merged.pdf'))
+			except MergeError, e:
+				return ('Could not merge the documents: %s'%(e,), 'error')
+			ext = 'pdf'
+		elif ext in conf.CONVERTABLE_EXTENSIONS:
+			with conversions:
+				pdf = ToPDF(fname)
+			if pdf is None:
+				return ('Could not convert the document to PDF', 'error')
+			fname = pdf
+			cleanup.append(fname)
+			ext = 'pdf'
+		elif ext not in conf.ALLOWED_EXTENSIONS:
+			return ('Bad file extension (consider printing to PDF)', 'error')
+		pfname, opts = Preprocess(fname, ext, opts)
+		if pfname != fname:
+			cleanup.append(pfname)
+		pages = estimate_pages(pfname, ext, opts)
+		try:
+			job_id = send_to_printer(user, pfname, filename, opts)
+		except ipp.Unconfirmed:
+			traceback.print_exc()
+			job_id = None
+		if job_id is None:
+			# Held where it cannot be released until restore_jobs finds it
+			return ('Could not confirm that the printer accepted the job; it may still print, so check before printing it again', 'error')
+	except runner.Failed, e:
+		return ('Could not print the document: %s'%(e,), 'error')
+	finally:
+		for f in cleanup:
+			if os.path.exists(f):
+				os.unlink(f)
+	jobstatus.board.Set(job, 'waiting', '%d pages'%(pages,), cups_id=job_id)
+	scheduler.Submit(user.id, pages, (job_id, user.username, job))
+	return ('Queued for printing', 'success')
+
+# The jobs held on the printer, as (uid, pages, item) for the scheduler to queue again
+# when it starts (see fairshare): jobs held by workers that have exited, which are not on
+# the job board, and any still queued by running workers. A job queued twice this way is
+# printed by whichever releases it first; the other finds it no longer held (see
+# dispatch_job).
+def restore_jobs():
+	ret = []
+	for attrs in jobstatus.board.client.GetJobs():
+		if ipp.JOB_STATES.get(attrs.get('job-state', [0])[0]) != 'pending-held':
+			continue
+		username = attrs.get('job-originating-user-name', [''])[0]
+		try:
+			uid = User.FromName(username).id
+		except DBError:
+			uid = None
+		# Guessed from the size, as estimate_pages does for printer data
+		pages = attrs.get('job-k-octets', [0])[0] // 32 + 1
+		ret.append((uid, pages, (attrs['job-id'][0], username, None)))
+	return ret
+
+# Whether a job handed to CUPS has left the scheduler's window. CUPS is asked directly
+# (through the job board's client, which batches and caches these queries), since the
+# board forgets all but each user's latest jobs.
+def cups_finished(job_id):
+	state = jobstatus.board.client.JobStates([job_id])[job_id]
+	return jobstatus.CUPS_STATES.get(state, 'done') != 'printing'
+
+# Releases a held job in CUPS when the scheduler lets it print, recording that on its job
+# (None for jobs restored from CUPS; see restore_jobs); returns the CUPS job ID while it is
+# printing, or None
+def dispatch_job(item):
+	job_id, username, job = item
+	try:
+		release_job(job_id, username)
+	except Exception:
+		traceback.print_exc()
+		# Released already (by another worker), canceled, or CUPS could not be asked
+		try:
+			held = jobstatus.board.client.JobStates([job_id])[job_id] == 'pending-held'
+		except Exception:
+			traceback.print_exc()
+			held = True
+		if held:
+			if job is not None:
+				jobstatus.board.Set(job, 'failed', 'Could not release the job to the printer; it stays held there until the print server restarts')
+			return None
+	if job is not None:
+		jobstatus.board.Set(job, 'printing', 'Sent to Printer (job %d)'%(job_id,), cups_id=job_id)
+	return job_id
+
+# Takes a token from the user's rate limit for the current request, unless it has already
+# been charged (a batch of files costs one token); raises Busy
+def charge_submission(user):
+	if not getattr(g, 'charged', False):
+		submit_limiter.Check(user.id)
+		g.charged = True
+
+# Runs a saved document through the print pipeline, ignoring duplicate submissions;
+# returns a list of (message, category) flashes describing the outcome. Only submissions
+# that are not duplicates are charged to the rate limit (raising Busy if it is exhausted).
+def submit_job(user, fname, filename, digest, opts):
+	key = (user.id, digest, tuple(sorted(opts.items())))
+	entry, owner = submissions.Claim(key)
+	if not owner:
+		result = entry.Wait(conf.DEDUP_WINDOW)
+		if result is None:
+			return [('An identical job is still being processed; please wait before submitting it again.', 'warning')]
+		return [result, ('This file was already submitted with the same options and was not printed again.', 'warning')]
+	try:
+		charge_submission(user)
+	except Busy:
+		submissions.Discard(key, entry)
+		raise
+	job = jobstatus.board.Add(user.id, filename)
+	try:
+		result = spool_file(user, fname, filename, opts, job)
+	except Busy:
+		submissions.Discard(key, entry)
+		jobstatus.board.Set(job, 'failed', 'Server busy')
+		raise
+	except Exception:
+		submissions.Discard(key, entry)
+		jobstatus.board.Set(job, 'failed', 'Internal error')
+		raise
+	if result[1] == 'error':
+		jobstatus.board.Set(job, 'failed', result[0])
+	submissions.Release(key, entry, result)
+	return [result]
+
+# Saves an uploaded file and runs it through the print pipeline (see submit_job)
+def submit_upload(user, rfile, opts):
+	try:
+		ext = SniffStream(rfile.stream, rfile.filename.rpartition('.')[2])
+	except Unprintable, e:
+		return [(str(e), 'error')]
+	fname = os.tmpnam()+'.'+ext
+	try:
+		digest = save_upload(rfile, fname)
+		return submit_job(user, fname, rfile.filename, digest, opts)
+	finally:
+		if os.path.exists(fname):
+			os.unlink(fname)
+
+# Saves several uploaded files (expanding archives) and prints them as one merged job
+def submit_merged(user, rfiles, opts):
+	tmpdir = tempfile.mkdtemp()
+	try:
+		members, skipped = [], []
+		digest = hashlib.sha256()
+		for idx, rfile in enumerate(rfiles):
+			if not printable(rfile.filename) and not is_archive(rfile.filename):
+				skipped.append(rfile.filename)
+				continue
+			try:
+				ext = SniffStream(rfile.stream, rfile.filename.rpartition('.')[2])
+			except Unprintable:
+				skipped.append(rfile.filename)
+				continue
+			fname = os.path.join(tmpdir, 'upload%04d.%s'%(idx, ''.join(c for c in ext if c.isalnum())))
+			digest.update(save_upload(rfile, fname))
+			if is_archive(rfile.filename):
+				outdir = os.path.join(tmpdir, 'archive%04d'%(idx,))
+				os.mkdir(outdir)
+				try:
+					extracted, rejected = ExtractArchive(fname, outdir)
+				except ArchiveError, e:
+					return [('%s: %s'%(rfile.filename, e), 'error')]
+				members.extend(extracted)
+				skipped.extend(rejected)
+			else:
+				members.append((fname, rfile.filename))
+		flashes = []
+		if skipped:
+			flashes.append(('Skipped files that cannot be printed: %s'%(', '.join(skipped),), 'warning'))
+		if not members:
+			return flashes + [('No printable files were submitted', 'error')]
+		title = rfiles[0].filename if len(rfiles) == 1 else '%s (+%d more)'%(rfiles[0].filename, len(rfiles)-1)
+		return flashes + submit_job(user, members, title+'.pdf', digest.hexdigest(), opts)
+	finally:
+		shutil.rmtree(tmpdir, True)
+
+# Returns the path of a complete upload's document, with the extension its content calls for
+# (see sniff); raises UploadError or Unprintable
+def upload_document(upload):
+	fname = upload.Finalize()
+	ext = SniffFile(fname, upload.filename.rpartition('.')[2])
+	if not fname.endswith('.'+ext):
+		# Linked rather than renamed, so that the upload can be finalized again
+		routed = os.path.splitext(fname)[0]+'.'+ext
+		if not os.path.exists(routed):
+			os.link(fname, routed)
+		fname = routed
+	return fname
+
+# Shows the print page with a preview of a stored upload, which is printed when confirmed.
+# The preview is charged to the rate limit (see print_file); raises Busy if the preview
+# queue is full.
+def show_preview(upload, opts):
+	try:
+		fname = upload_document(upload)
+	except (UploadError, Unprintable), e:
+		upload.Delete()
+		flash(str(e), 'error')
+		return render_template('op_print.html')
+	preview.cache.Request(upload.sha256, fname, opts['pages'])
+	return render_template('op_print.html', preview=upload, opts=opts)
+
+# Prints a stored upload (previewed earlier), deleting it once it has been submitted
+def submit_stored(user, upload, opts):
+	try:
+		fname = upload_document(upload)
+	except (UploadError, Unprintable), e:
+		upload.Delete()
+		return [(str(e), 'error')]
+	flashes = submit_job(user, fname, upload.filename, upload.sha256, opts)
+	upload.Delete()
+	return flashes
+
+# Refuses a print submission because of admission control
+def busy_response(e, **context):
+	if e.what == 'rate':
+		flash('You are submitting jobs too quickly; retry in %d s.'%(e.retry_after,), 'error')
+	else:
+		flash('The print server is busy; retry in %d s.'%(e.retry_after,), 'error')
+	return render_template('op_print.html', **context), 429, {'Retry-After': str(e.retry_after)}
+
 # Print entry point view operation
 @app.route('/print/op/print/', methods=['GET', 'POST'])
 def print_file():
@@ -257,45 +727,351 @@ def print_file():
 	if g.user.status != User.ST_NORMAL:
 		flash('Account disabled or not verified', 'error')
 	elif request.method == 'POST':
-		options = []
-		rfile = request.files['file']
-		copies = request.values.get('copies', 1, int)
-		options.append('-n %d'%(copies,))
-		pages = request.values.get('pages', '')
-		collate = request.values.get('collate', '')
-		if not valid_page.match(pages):
+		rfiles = [rfile for rfile in request.files.getlist('file') if rfile.filename]
+		opts = parse_options(request.values)
+		if opts is None:
 			flash('Bad page format', 'error')
-			return render_template("op_print.html")	
-		if pages:
-			options.append('-P "%s"'%(pages,))
-		if collate:
-			options.append('-o Collate=True')
-		duplex = request.values.get('duplex', False, bool)
-		options.append('-o sides=two-sided-long-edge' if duplex else '-o sides=one-sided')
-		options.append('-o media=Letter')
-		options.append('-U "%s"'%(g.user.username,))
-		options.append('-t \'%s:%s\''%(g.user.username.replace("'", '_'), rfile.filename.replace("'", '_')))
-		if rfile.filename.rpartition('.')[2].lower() in conf.ALLOWED_EXTENSIONS:
-                        fname = os.tmpnam()+'.'+rfile.filename.rpartition('.')[2]
-			request.files['file'].save(fname)
-                        os.system('lp %s %s'%(' '.join(options), fname))
-                        os.unlink(fname)
-                        flash('Sent to Printer', 'success')
-		elif rfile.filename.rpartition('.')[2].lower() in conf.CONVERTABLE_EXTENSIONS:
-                        fname = os.tmpnam()+'.'+rfile.filename.rpartition('.')[2]
-			request.files['file'].save(fname)
-			tmp_fold = os.path.dirname(fname)
-			os.system('soffice --headless --convert-to pdf --outdir %s %s'%(tmp_fold,fname))
-			conv_base, tmp_ext = os.path.splitext(fname);
-			fname_pdf = conv_base+'.pdf'
-			os.system('lp %s %s'%(' '.join(options), fname_pdf))
-                        os.unlink(fname)
-			os.unlink(fname_pdf)
-                        flash('Sent to Printer', 'success')
-		else:
+			return render_template("op_print.html")
+		# A previewed file is kept as an upload, and confirmed (or previewed again) by its ID
+		if request.values.get('upload'):
+			upload = get_upload(request.values['upload'])
+			if upload is None:
+				flash('The previewed file has expired; please choose it again', 'error')
+				return render_template('op_print.html')
+			if 'preview' in request.values:
+				try:
+					charge_submission(g.user)
+					return show_preview(upload, opts)
+				except Busy, e:
+					return busy_response(e, preview=upload, opts=opts)
+			try:
+				flashes = submit_stored(g.user, upload, opts)
+			except Busy, e:
+				return busy_response(e, preview=upload, opts=opts)
+			for msg in flashes:
+				flash(*msg)
+			return render_template('op_print.html')
+		if not rfiles:
+			flash('No file selected', 'error')
+			return render_template('op_print.html')
+		if len(rfiles) > conf.API_MAX_FILES:
+			flash('At most %d files may be printed at once'%(conf.API_MAX_FILES,), 'error')
+			return render_template('op_print.html')
+		merged = len(rfiles) > 1 or is_archive(rfiles[0].filename)
+		if not merged and not printable(rfiles[0].filename):
 			flash('Bad file extension (consider printing to PDF)', 'error')
+			return render_template('op_print.html')
+		if 'preview' in request.values:
+			if merged:
+				flash('Previews are only available for single documents', 'warning')
+				return render_template('op_print.html')
+			try:
+				charge_submission(g.user)
+			except Busy, e:
+				return busy_response(e)
+			Upload.Expire()
+			try:
+				upload = Upload.Store(g.user, rfiles[0].filename, rfiles[0].stream)
+			except UploadError, e:
+				flash(str(e), 'error')
+				return render_template('op_print.html')
+			try:
+				return show_preview(upload, opts)
+			except Busy, e:
+				upload.Delete()
+				return busy_response(e)
+		try:
+			if merged:
+				flashes = submit_merged(g.user, rfiles, opts)
+			else:
+				flashes = submit_upload(g.user, rfiles[0], opts)
+		except Busy, e:
+			return busy_response(e)
+		for msg in flashes:
+			flash(*msg)
 	return render_template('op_print.html')
 	
+# Builds a JSON error response for the API views
+def api_error(msg, code, headers={}):
+	return jsonify(error=msg), code, headers
+
+# Builds a JSON response for a submission refused by admission control
+def api_busy(e):
+	return api_error('busy, retry in %d s'%(e.retry_after,), 429, {'Retry-After': str(e.retry_after)})
+
+# Fetches an upload belonging to the current user, or None
+def get_upload(id):
+	try:
+		upload = Upload.FromID(id)
+	except NoSuchUpload:
+		return None
+	if upload.uid != g.user.id:
+		return None
+	return upload
+
+# Resumable upload creation view; expects filename, size and sha256 values
+@app.route('/print/api/upload/', methods=['POST'])
+def upload_create():
+	if g.user.status != User.ST_NORMAL:
+		return api_error('Account disabled or not verified', 403)
+	try:
+		filename = request.values['filename']
+		size = int(request.values['size'])
+		sha256 = request.values['sha256']
+	except (KeyError, ValueError):
+		return api_error('Bad request', 400)
+	if not printable(filename):
+		return api_error('Bad file extension (consider printing to PDF)', 400)
+	try:
+		submit_limiter.Check(g.user.id)
+	except Busy, e:
+		return api_busy(e)
+	Upload.Expire()
+	try:
+		upload = Upload.Create(g.user, filename, size, sha256)
+	except UploadError, e:
+		return api_error(str(e), 400)
+	return jsonify(id=upload.id, chunk_size=upload.chunk_size, chunks=upload.nchunks), 201
+
+# Resumable upload status view (GET) and cancellation (DELETE)
+@app.route('/print/api/upload/<id>/', methods=['GET', 'DELETE'])
+def upload_status(id):
+	upload = get_upload(id)
+	if upload is None:
+		return api_error('No such upload', 404)
+	if request.method == 'DELETE':
+		upload.Delete()
+		return jsonify(id=upload.id, deleted=True)
+	received = upload.Received()
+	return jsonify(id=upload.id, filename=upload.filename, size=upload.size, chunk_size=upload.chunk_size, chunks=upload.nchunks, received=received, offsets=[i*upload.chunk_size for i in received])
+
+# Resumable upload chunk view; the request body is the chunk
+@app.route('/print/api/upload/<id>/<int:index>', methods=['PUT'])
+def upload_chunk(id, index):
+	upload = get_upload(id)
+	if upload is None:
+		return api_error('No such upload', 404)
+	try:
+		upload.WriteChunk(index, request.stream)
+	except UploadError, e:
+		return api_error(str(e), 400)
+	return jsonify(id=upload.id, received=upload.Received())
+
+# Resumable upload finalization view; takes the same print options as print_file
+@app.route('/print/api/upload/<id>/finalize', methods=['POST'])
+def upload_finalize(id):
+	if g.user.status != User.ST_NORMAL:
+		return api_error('Account disabled or not verified', 403)
+	upload = get_upload(id)
+	if upload is None:
+		return api_error('No such upload', 404)
+	opts = parse_options(request.values)
+	if opts is None:
+		return api_error('Bad page format', 400)
+	try:
+		fname = upload_document(upload)
+	except Unprintable, e:
+		upload.Delete()
+		return api_error(str(e), 415)
+	except UploadError, e:
+		return api_error(str(e), 409)
+	# The upload was charged to the rate limit when it was created
+	g.charged = True
+	try:
+		results = submit_job(g.user, fname, upload.filename, upload.sha256, opts)
+	except Busy, e:
+		# The upload is kept so that finalization can simply be retried
+		return api_busy(e)
+	upload.Delete()
+	return jsonify(results=[{'message': msg, 'category': cat} for msg, cat in results])
+
+# Preview status view; lists the page thumbnails of an upload rendered so far
+@app.route('/print/api/preview/<id>')
+def preview_status(id):
+	upload = get_upload(id)
+	if upload is None:
+		return api_error('No such upload', 404)
+	status = preview.cache.Status(upload.sha256)
+	return jsonify(state=status['state'], npages=status['npages'], pages=[{'page': page, 'url': url_for('preview_page', id=id, page=page)} for page in status['pages']])
+
+# Preview page view; serves the thumbnail of one page of an upload
+@app.route('/print/op/preview/<id>/<int:page>')
+def preview_page(id, page):
+	upload = get_upload(id)
+	fname = upload and preview.cache.Get(upload.sha256, page)
+	if not fname:
+		return api_error('No such page', 404)
+	return send_file(fname, mimetype='image/png')
+
+# API login view; returns a token to be sent as "Authorization: Bearer <token>"
+@app.route('/print/api/login', methods=['POST'])
+def api_login():
+	try:
+		user = User.FromName(request.values['username'])
+		pwdhash = hashlib.sha512(request.values['password']).hexdigest()
+	except KeyError:
+		return api_error('Bad request', 400)
+	except DBError:
+		return api_error('Invalid username or password', 401)
+	if user.password != pwdhash:
+		return api_error('Invalid username or password', 401)
+	if user.status == User.ST_DISABLED:
+		return api_error('Account disabled', 403)
+	sess = Session.Create(user)
+	return jsonify(token=str(sess.id), username=user.username, balance=user.balance)
+
+# Merges per-file option overrides (from JSON) into the submitted form values
+def file_values(values, overrides):
+	values = MultiDict(values)
+	for k, v in overrides.iteritems():
+		if v is None or v is False:
+			values.pop(k, None)
+		else:
+			values[k] = unicode(v)
+	return values
+
+# Batch print API view. Expects one or more "file" parts; print options given as form
+# values apply to every file, and an optional "options" value holding a JSON list of
+# objects (one per file, in order) overrides them per file.
+@app.route('/print/api/print', methods=['POST'])
+def api_print():
+	if g.user.status != User.ST_NORMAL:
+		return api_error('Account disabled or not verified', 401 if g.user.id == User.NOBODY.id else 403)
+	rfiles = request.files.getlist('file')
+	if not rfiles:
+		return api_error('No files', 400)
+	if len(rfiles) > conf.API_MAX_FILES:
+		return api_error('At most %d files may be submitted at once'%(conf.API_MAX_FILES,), 400)
+	try:
+		overrides = json.loads(request.values.get('options', '[]'))
+		if not isinstance(overrides, list) or not all(isinstance(o, dict) for o in overrides):
+			raise ValueError(overrides)
+	except ValueError:
+		return api_error('Bad options', 400)
+	files = []
+	for idx, rfile in enumerate(rfiles):
+		res = {'filename': rfile.filename}
+		files.append(res)
+		opts = parse_options(file_values(request.values, overrides[idx] if idx < len(overrides) else {}))
+		if opts is None:
+			res.update(status='error', results=[{'message': 'Bad print options', 'category': 'error'}])
+		elif not printable(rfile.filename) and not is_archive(rfile.filename):
+			res.update(status='error', results=[{'message': 'Bad file extension (consider printing to PDF)', 'category': 'error'}])
+		else:
+			try:
+				if is_archive(rfile.filename):
+					results = submit_merged(g.user, [rfile], opts)
+				else:
+					results = submit_upload(g.user, rfile, opts)
+			except Busy, e:
+				res.update(status='busy', retry_after=e.retry_after, results=[{'message': 'busy, retry in %d s'%(e.retry_after,), 'category': 'error'}])
+			else:
+				res.update(status='error' if any(cat == 'error' for msg, cat in results) else 'ok', results=[{'message': msg, 'category': cat} for msg, cat in results])
+	return jsonify(files=files)
+
+# How the print page watches the current user's jobs: a dict of the URL and the interval
+# between polls (0 for an event stream), or None if they are not logged in or have no
+# unfinished jobs. Streams are only used when they do not hold a thread (see stream_jobs);
+# otherwise the page polls, and every poll is answered at once.
+@app.template_global()
+def job_watch():
+	if g.user.id == User.NOBODY.id or not jobstatus.board.Active(g.user.id):
+		return None
+	if stream_jobs:
+		return {'url': url_for('job_events'), 'interval': 0}
+	return {'url': url_for('job_list'), 'interval': conf.JOB_POLL_INTERVAL}
+
+# Job status event stream (server-sent events) for the current user's jobs. Each event
+# carries the jobs that changed, and its ID is the version to resume from (sent back by
+# EventSource as Last-Event-ID when it reconnects). Unless stream_jobs is set, the stream
+# does not wait: it sends what changed and ends, and the browser reconnects after
+# conf.JOB_POLL_INTERVAL seconds, so that it never holds a worker thread.
+@app.route('/print/api/jobs/events')
+def job_events():
+	uid = g.user.id
+	if uid == User.NOBODY.id:
+		return api_error('Not logged in', 401)
+	try:
+		version = int(request.headers.get('Last-Event-ID', request.args.get('since', 0)))
+	except ValueError:
+		version = 0
+	def stream(version):
+		if not stream_jobs:
+			yield 'retry: %d\n\n'%(conf.JOB_POLL_INTERVAL*1000,)
+			version, jobs = jobstatus.board.Since(uid, version, 0)
+			if jobs:
+				yield 'id: %d\nevent: jobs\ndata: %s\n\n'%(version, json.dumps(jobs))
+			return
+		deadline = time.time() + conf.SSE_DURATION
+		yield 'retry: %d\n\n'%(conf.SSE_RETRY*1000,)
+		while time.time() < deadline:
+			version, jobs = jobstatus.board.Since(uid, version, min(conf.SSE_KEEPALIVE, deadline - time.time()))
+			if jobs:
+				yield 'id: %d\nevent: jobs\ndata: %s\n\n'%(version, json.dumps(jobs))
+			else:
+				yield ': keepalive\n\n'
+	return Response(stream(version), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Job status poll view: returns the current user's jobs changed after version "since".
+# Under serve.py (see stream_jobs) it waits up to "wait" seconds for a change; otherwise
+# it answers at once, so that a poll never holds a worker thread.
+@app.route('/print/api/jobs')
+def job_list():
+	if g.user.id == User.NOBODY.id:
+		return api_error('Not logged in', 401)
+	since = request.args.get('since', 0, int)
+	wait = min(request.args.get('wait', 0, float), conf.SSE_KEEPALIVE) if stream_jobs else 0
+	version, jobs = jobstatus.board.Since(g.user.id, since, wait)
+	return jsonify(version=version, jobs=jobs)
+
+# Usage view operation: the current user's printing per day, and for users with the
+# "usage" access, everyone's (see usage)
+@app.route('/print/op/usage/')
+def show_usage():
+	days = max(1, min(request.args.get('days', conf.USAGE_DAYS, int), 366))
+	start, end = usage.Period(days)
+	# Bounded, so that a long backlog is rolled up over several requests
+	if usage.rollup.Stale():
+		usage.rollup.Refresh(conf.USAGE_BATCH)
+	report = {'mine': usage.rollup.Days(start, end, g.user.id)}
+	if g.user.AccessToken().GetAccess('usage'):
+		report.update(days=usage.rollup.Days(start, end), users=usage.rollup.Users(start, end, conf.USAGE_TOP), printers=usage.rollup.Printers(start, end), hours=usage.rollup.Hours(start, end))
+	return render_template('op_usage.html', start=start, end=end, days=days, report=report)
+
+# Profiler control view: shows the profiling settings and a summary per endpoint; a POST
+# with "action" start (with optional rate, interval and duration) or stop changes them
+@app.route('/print/api/profile', methods=['GET', 'POST'])
+def profile_control():
+	if not g.user.AccessToken().GetAccess('profile'):
+		return api_error('Forbidden', 403)
+	if request.method == 'POST':
+		action = request.values.get('action')
+		if action == 'start':
+			profiler.Start(request.values.get('rate', None, float), request.values.get('interval', None, float), request.values.get('duration', None, float))
+		elif action == 'stop':
+			profiler.Stop()
+		else:
+			return api_error('Bad request', 400)
+	else:
+		profiler.sampler.Flush()
+	return jsonify(settings=profiler.Settings(), endpoints=profiler.Summary())
+
+# Profile download view: the samples of every worker (or of one endpoint) in the folded
+# format of flamegraph.pl
+@app.route('/print/api/profile/folded')
+def profile_folded():
+	if not g.user.AccessToken().GetAccess('profile'):
+		return api_error('Forbidden', 403)
+	profiler.sampler.Flush()
+	return Response(profiler.Folded(request.args.get('endpoint')), mimetype='text/plain', headers={'Content-Disposition': 'attachment; filename=profile.folded'})
+
+# Scheduler view: the jobs waiting in this worker and their waits per user class (see fairshare)
+@app.route('/print/api/queue')
+def queue_status():
+	if not g.user.AccessToken().GetAccess('usage'):
+		return api_error('Forbidden', 403)
+	return jsonify(waiting=scheduler.Waiting(), classes=scheduler.Stats())
+
 # Registration verification view operation
 @app.route('/print/op/verify')
 def verify():
@@ -334,3 +1110,8 @@ def contact():
 @app.route('/print/op/test2/')
 def test2():
 	return 'Hello from test2!'
+
+# In production, templates are compiled at import (in a forking master, once for every
+# worker) rather than by the first request for each
+if not app.debug:
+	precompile_templates()
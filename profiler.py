@@ -0,0 +1,210 @@
+'''
+print -- CSLabs Print Server
+profiler -- Sampling Profiler
+
+This module profiles live workers without restarting them. While profiling is on, a
+fraction of requests (the rate) is sampled: a background thread looks at the stack of
+each sampled request every interval seconds (with sys._current_frames, so the request
+itself does no extra work) and counts the stacks it sees, per endpoint. Waits show up
+as well as computation; a request waiting on soffice is seen in runner.Run.
+
+Profiling is switched on and off through a control file in conf.PROFILE_DIR, which
+every worker process looks at (at most every conf.PROFILE_CHECK seconds), so that the
+console or any one worker can control all of them:
+
+	Start(rate=0.1, interval=0.005, duration=600)
+	Stop()
+
+Profiling stops by itself after its duration. Start() also discards the samples of the
+previous run. Each worker writes its counts to its own file in conf.PROFILE_DIR every
+conf.PROFILE_FLUSH seconds, and
+
+	Summary()		# {endpoint: {'requests': 12, 'seconds': 3.4, 'samples': 680}}
+	Folded(endpoint=None)	# "endpoint;frame;frame 42" lines, for flamegraph.pl
+
+merge those of every worker. Each frame is written as "function (file:line)", where
+line is the first line of the function; the endpoint is the outermost frame.
+
+In print.py, the module's "sampler" (a Sampler) is hooked into every request with
+before_request and after_request. Since samples are taken from another thread, uwsgi
+must run with threads enabled; under serve.py, where requests are greenlets on one
+thread, nothing is sampled.
+'''
+
+import os
+import sys
+import json
+import time
+import glob
+import thread
+import random
+import threading
+
+import conf
+
+def _write(fname, text):
+	# Written whole, so that readers in other processes never see part of it
+	tmp = '%s.%d.tmp'%(fname, os.getpid())
+	with open(tmp, 'w') as f:
+		f.write(text)
+	os.rename(tmp, fname)
+
+def _read(fname):
+	try:
+		with open(fname) as f:
+			return json.load(f)
+	except (IOError, ValueError):
+		return {}
+
+def _fold(endpoint, frame):
+	names = []
+	while frame is not None:
+		code = frame.f_code
+		names.append('%s (%s:%d)'%(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+		frame = frame.f_back
+	names.append(endpoint)
+	return ';'.join(reversed(names))
+
+class Sampler(object):
+	def __init__(self, path):
+		self.path       = path
+		self.settings   = {}
+		self.generation = None
+		self.checked    = 0
+		self.mtime      = None
+		self.active     = {}
+		self.stacks     = {}
+		self.requests   = {}
+		self.dirty      = False
+		self.flushed    = 0
+		self.lock       = threading.Lock()
+		self.thread     = None
+	def _poll(self):
+		now = time.time()
+		if now - self.checked < conf.PROFILE_CHECK:
+			return
+		self.checked = now
+		try:
+			mtime = os.path.getmtime(os.path.join(self.path, 'control'))
+		except OSError:
+			mtime = None
+		if mtime == self.mtime:
+			return
+		self.mtime = mtime
+		self.settings = _read(os.path.join(self.path, 'control'))
+		if self.settings.get('generation') != self.generation:
+			with self.lock:
+				self.generation = self.settings.get('generation')
+				self.stacks = {}
+				self.requests = {}
+	def Enabled(self):
+		return self.settings.get('until', 0) > time.time()
+	def Begin(self, endpoint):
+		'''Samples the current request (with probability the rate), if profiling is on.'''
+		self._poll()
+		if not self.Enabled() or random.random() >= self.settings.get('rate', 0):
+			return False
+		with self.lock:
+			self.active[thread.get_ident()] = (endpoint, time.time())
+			# Started lazily, so that it runs in the worker rather than a forking master
+			if self.thread is None:
+				self.thread = threading.Thread(target=self._sample)
+				self.thread.daemon = True
+				self.thread.start()
+		return True
+	def End(self):
+		with self.lock:
+			entry = self.active.pop(thread.get_ident(), None)
+			if entry is None:
+				return
+			endpoint, start = entry
+			counts = self.requests.setdefault(endpoint, [0, 0.0])
+			counts[0] += 1
+			counts[1] += time.time() - start
+			self.dirty = True
+	def _sample(self):
+		while True:
+			if self.Enabled():
+				time.sleep(self.settings.get('interval', conf.PROFILE_INTERVAL))
+			else:
+				time.sleep(conf.PROFILE_CHECK)
+			if self.active:
+				frames = sys._current_frames()
+				with self.lock:
+					for ident, (endpoint, start) in self.active.items():
+						frame = frames.get(ident)
+						if frame is None:
+							continue
+						counts = self.stacks.setdefault(endpoint, {})
+						stack = _fold(endpoint, frame)
+						counts[stack] = counts.get(stack, 0) + 1
+						self.dirty = True
+			if self.dirty and time.time() - self.flushed >= conf.PROFILE_FLUSH:
+				try:
+					self.Flush()
+				except (IOError, OSError):
+					pass
+	def Flush(self):
+		'''Writes this worker's counts to its file in the profile directory.'''
+		with self.lock:
+			if self.generation is None:
+				return
+			text = json.dumps({'generation': self.generation, 'stacks': self.stacks, 'requests': self.requests})
+			self.dirty = False
+			self.flushed = time.time()
+		_write(os.path.join(self.path, '%d.json'%(os.getpid(),)), text)
+
+sampler = Sampler(conf.PROFILE_DIR)
+
+def Settings():
+	return _read(os.path.join(conf.PROFILE_DIR, 'control'))
+
+def Start(rate=None, interval=None, duration=None):
+	if not os.path.isdir(conf.PROFILE_DIR):
+		os.makedirs(conf.PROFILE_DIR)
+	for fname in glob.glob(os.path.join(conf.PROFILE_DIR, '*.json')):
+		os.unlink(fname)
+	settings = {
+		'generation': '%.6f'%(time.time(),),
+		'rate': conf.PROFILE_RATE if rate is None else rate,
+		'interval': conf.PROFILE_INTERVAL if interval is None else interval,
+		'until': time.time() + (conf.PROFILE_DURATION if duration is None else duration),
+	}
+	_write(os.path.join(conf.PROFILE_DIR, 'control'), json.dumps(settings))
+	return settings
+
+def Stop():
+	settings = Settings()
+	if settings:
+		settings['until'] = 0
+		_write(os.path.join(conf.PROFILE_DIR, 'control'), json.dumps(settings))
+	return settings
+
+def _collect():
+	generation = Settings().get('generation')
+	for fname in glob.glob(os.path.join(conf.PROFILE_DIR, '*.json')):
+		data = _read(fname)
+		if data and data.get('generation') == generation:
+			yield data
+
+def Summary():
+	ret = {}
+	for data in _collect():
+		for endpoint, (count, seconds) in data['requests'].iteritems():
+			entry = ret.setdefault(endpoint, {'requests': 0, 'seconds': 0.0, 'samples': 0})
+			entry['requests'] += count
+			entry['seconds'] += seconds
+		for endpoint, stacks in data['stacks'].iteritems():
+			entry = ret.setdefault(endpoint, {'requests': 0, 'seconds': 0.0, 'samples': 0})
+			entry['samples'] += sum(stacks.itervalues())
+	return ret
+
+def Folded(endpoint=None):
+	merged = {}
+	for data in _collect():
+		for name, stacks in data['stacks'].iteritems():
+			if endpoint is not None and name != endpoint:
+				continue
+			for stack, count in stacks.iteritems():
+				merged[stack] = merged.get(stack, 0) + count
+	return ''.join('%s %d\n'%(stack, count) for stack, count in sorted(merged.iteritems()))
@@ -0,0 +1,132 @@
+'''
+print -- CSLabs Print Server
+runner -- Bounded Subprocesses
+
+This module runs the external programs of the print pipeline (soffice, ps2pdf, pdfunite
+and lp) so that a misbehaving one cannot hold a worker indefinitely:
+
+-Each command runs in a process group of its own, which is killed as a whole when the
+ command exceeds its wall-clock timeout, and cleaned up when it exits (soffice leaves
+ soffice.bin behind otherwise).
+-The address space (memory) and CPU time of the command are limited with rlimits; a
+ command that runs out of CPU time is killed by the kernel.
+
+	outcome = Run(['ps2pdf', fname, out], timeout=120, memory=2**31, cpu=120)
+
+Run() never raises for a failed command; it returns an Outcome, whose .status is one of
+"ok", "failed" (nonzero exit status), "timeout", "cpu-limit", "killed" (by some other
+signal) or "error" (the command could not be started), and which also holds the exit
+status, the wall-clock time taken and, if capture is set, the output of the command.
+outcome.Check() raises Failed if the command did not succeed, for callers that treat
+that as an error.
+
+Every outcome is recorded in the module's "stats" (a RunStats), which counts outcomes by
+command and status, and is logged to stderr as one JSON object per line (prefixed with
+"runner: "), so that failures and timeouts can be collected and graphed from the logs.
+'''
+
+import os
+import sys
+import json
+import time
+import signal
+import resource
+import threading
+import subprocess
+from collections import deque
+
+class Outcome(object):
+	def __init__(self, name, status, returncode, elapsed, output=None):
+		self.name       = name
+		self.status     = status
+		self.returncode = returncode
+		self.elapsed    = elapsed
+		self.output     = output
+	@property
+	def ok(self):
+		return self.status == 'ok'
+	def Check(self):
+		if not self.ok:
+			raise Failed(self)
+		return self
+	def ToDict(self):
+		return {'cmd': self.name, 'status': self.status, 'returncode': self.returncode, 'elapsed': round(self.elapsed, 3)}
+
+class Failed(Exception):
+	def __init__(self, outcome):
+		if outcome.status == 'timeout':
+			msg = '%s timed out after %.0fs'%(outcome.name, outcome.elapsed)
+		elif outcome.status == 'failed':
+			msg = '%s failed with exit status %d'%(outcome.name, outcome.returncode)
+		else:
+			msg = '%s failed (%s)'%(outcome.name, outcome.status)
+		Exception.__init__(self, msg)
+		self.outcome = outcome
+
+class RunStats(object):
+	def __init__(self, size):
+		self.counts = {}
+		self.recent = deque(maxlen=size)
+		self.lock   = threading.Lock()
+	def Record(self, outcome):
+		with self.lock:
+			key = (outcome.name, outcome.status)
+			self.counts[key] = self.counts.get(key, 0) + 1
+			self.recent.append((time.time(), outcome))
+		sys.stderr.write('runner: %s\n'%(json.dumps(outcome.ToDict(), sort_keys=True),))
+
+stats = RunStats(100)
+
+def _limits(memory, cpu):
+	def apply():
+		os.setsid()
+		if memory:
+			resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+		if cpu:
+			# SIGXCPU at the soft limit, SIGKILL if that is ignored
+			resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu+5))
+	return apply
+
+def _killpg(pgid):
+	try:
+		os.killpg(pgid, signal.SIGKILL)
+	except OSError:
+		pass
+
+def Run(cmd, timeout, memory=None, cpu=None, shell=False, capture=False, name=None):
+	if name is None:
+		name = os.path.basename(cmd.split()[0] if shell else cmd[0])
+	start = time.time()
+	try:
+		proc = subprocess.Popen(cmd, shell=shell, stdout=subprocess.PIPE if capture else None, preexec_fn=_limits(memory, cpu), close_fds=True)
+	except OSError, e:
+		outcome = Outcome(name, 'error', None, time.time() - start, str(e))
+		stats.Record(outcome)
+		return outcome
+	expired = threading.Event()
+	def expire():
+		expired.set()
+		_killpg(proc.pid)
+	timer = threading.Timer(timeout, expire)
+	timer.daemon = True
+	timer.start()
+	try:
+		output = proc.communicate()[0]
+	finally:
+		timer.cancel()
+		# The command's own children may outlive it
+		_killpg(proc.pid)
+	ret = proc.returncode
+	if expired.is_set():
+		status = 'timeout'
+	elif ret == 0:
+		status = 'ok'
+	elif ret > 0:
+		status = 'failed'
+	elif -ret == signal.SIGXCPU:
+		status = 'cpu-limit'
+	else:
+		status = 'killed'
+	outcome = Outcome(name, status, ret, time.time() - start, output)
+	stats.Record(outcome)
+	return outcome
@@ -0,0 +1,56 @@
+'''
+print -- CSLabs Print Server
+serve -- Cooperative Server
+
+This module serves the print application (print.app) on gevent instead of OS threads.
+The standard library is monkey-patched before the application is imported, so that the
+slow parts of the I/O-bound views yield to other requests while they wait instead of
+holding a thread:
+
+-SMTP delivery in register, reset_pw and contact (smtplib uses the patched sockets),
+-soffice, ps2pdf and lp runs in print_file (through the patched subprocess module, which
+ runner uses rather than os.system for this reason), and
+-waits on admission control slots and duplicate submissions (patched threading).
+
+Conversions of merged jobs run as greenlets (see convert.mapper) rather than on the
+multiprocessing pool, and the print page watches jobs over a long-lived event stream
+(print.stream_jobs) rather than by polling. The routes and templates are those of
+print.py, unchanged.
+
+To serve standalone on conf.ASYNC_CONNECTIONS concurrent connections:
+
+	python serve.py [--host HOST] [--port PORT]
+
+or under uwsgi, which then does the monkey-patching itself:
+
+	uwsgi --master --http :80 --gevent 200 --gevent-monkey-patch --wsgi-file serve.py --callable app
+
+bench.py's "async" benchmark compares how many slow submissions one worker carries in
+each model.
+'''
+
+from gevent import monkey
+monkey.patch_all(subprocess=True)
+
+import argparse
+
+import gevent.pool
+from gevent.pywsgi import WSGIServer
+
+import conf
+import convert
+
+convert.mapper = gevent.pool.Pool(conf.CONVERT_WORKERS).map
+
+# "print" is a keyword, so the module cannot be imported with an import statement
+printmod = __import__('print')
+printmod.stream_jobs = True
+app = printmod.app
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Serve the print server on gevent')
+	parser.add_argument('--host', default='')
+	parser.add_argument('--port', type=int, default=80)
+	args = parser.parse_args()
+	server = WSGIServer((args.host, args.port), app, spawn=gevent.pool.Pool(conf.ASYNC_CONNECTIONS))
+	server.serve_forever()
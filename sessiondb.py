@@ -22,19 +22,23 @@ FromName classmethod.
 A Session may also be created by passing .Create() a User or user ID. This will create
 and return a new Session object with a unique ID.
 
-Sessions support .Update() and .Delete() as with Users and Groups.
+Sessions support .Update() and .Delete() as with Users and Groups. Note that .Update()
+may change session.id (the cookie backend issues a new signed ID for the new user), so
+callers that hand the ID to a client must send it again afterward.
+
+Where sessions are kept is decided by conf.SESSION_BACKEND; the module's "backend" is
+one of the stores in sessionstore (see), and session IDs are whatever it issues (ints
+for the sqlite and memory stores, strings for signed cookies). FromID accepts the ID as
+given by the client, and raises NoSuchEntity for IDs the backend does not accept.
 
 Finally, as a convenience, calling session.User() will return the User associated with
 the Session, or raise a NoSuchEntity error.
 '''
 
-import sqlite3
-import os
-
+import sessionstore
 from userdb import _instantiate, User
 
-db = sqlite3.connect(os.path.join(os.path.dirname(__file__), 'sessions.db'), check_same_thread = False)
-cur = db.cursor()
+backend = sessionstore.FromConf()
 
 class Session(object):
 	def __init__(self, id, uid):
@@ -42,20 +46,16 @@ class Session(object):
 		self.uid = uid
 	@classmethod
 	def FromID(cls, id):
-		cur.execute('SELECT id, uid FROM sessions WHERE id=?', (id,))
-		return _instantiate(cls, cur.fetchall(), 'id', id)
+		row = backend.Get(id)
+		return _instantiate(cls, [] if row is None else [row], 'id', id)
 	@classmethod
 	def Create(cls, user):
 		if isinstance(user, User):
 			user = user.id
-		cur.execute('INSERT INTO sessions (uid) VALUES (?)', (user,))
-		db.commit()
-		return cls(cur.lastrowid, user)
+		return cls(backend.Create(user), user)
 	def Update(self):
-		cur.execute('UPDATE sessions SET uid=? WHERE id=?', (self.uid, self.id))
-		db.commit()
+		self.id = backend.Update(self.id, self.uid)
 	def Delete(self):
-		cur.execute('DELETE FROM sessions WHERE id=?', (self.id,))
-		db.commit()
+		backend.Delete(self.id)
 	def User(self):
 		return User.FromID(self.uid)
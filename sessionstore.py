@@ -0,0 +1,129 @@
+'''
+print -- CSLabs Print Server
+sessionstore -- Session Storage Backends
+
+This module holds the interchangeable stores behind sessiondb.Session. It does not
+depend on userdb, so the stores can be used (and benchmarked) without the pykota
+database. Every backend maps a session ID to a user ID through four methods:
+
+-.Get(id) returns the (id, user ID) pair of a session, with the ID in the backend's own
+ form, or None if the ID is not valid (IDs come from cookies and may be any string),
+-.Create(uid) returns the ID of a new session,
+-.Update(id, uid) changes the user of a session and returns its ID, which may differ
+ from the one passed in (the caller must then hand the new one to the client), and
+-.Delete(id) ends a session.
+
+The backends are:
+
+-SqliteBackend, which keeps sessions in the "sessions" table of an sqlite file (the
+ original sessions.db); IDs are the table's rowids.
+-MemoryBackend, which keeps them in a dict; sessions do not outlive the process, so it
+ is meant for tests and single-process development servers.
+-SignedCookieBackend, which stores nothing: the ID is the user ID and issue time signed
+ with HMAC-SHA256, and is checked (including its age against max_age) without any
+ lookup. Since nothing is stored, Delete() cannot revoke an ID that a client keeps;
+ logging out replaces the cookie with one for User.NOBODY.
+
+FromConf() builds the backend selected by conf.SESSION_BACKEND.
+'''
+
+import os
+import hmac
+import time
+import base64
+import sqlite3
+import hashlib
+import threading
+
+import conf
+
+class SqliteBackend(object):
+	def __init__(self, path):
+		self.db   = sqlite3.connect(path, check_same_thread = False)
+		self.lock = threading.Lock()
+	def Get(self, id):
+		try:
+			id = int(id)
+		except (ValueError, TypeError):
+			return None
+		rows = self.db.execute('SELECT id, uid FROM sessions WHERE id=?', (id,)).fetchall()
+		return rows[0] if rows else None
+	def Create(self, uid):
+		with self.lock:
+			cur = self.db.execute('INSERT INTO sessions (uid) VALUES (?)', (uid,))
+			self.db.commit()
+			return cur.lastrowid
+	def Update(self, id, uid):
+		with self.lock:
+			self.db.execute('UPDATE sessions SET uid=? WHERE id=?', (uid, id))
+			self.db.commit()
+		return id
+	def Delete(self, id):
+		with self.lock:
+			self.db.execute('DELETE FROM sessions WHERE id=?', (id,))
+			self.db.commit()
+
+class MemoryBackend(object):
+	def __init__(self):
+		self.sessions = {}
+		self.next_id  = 0
+		self.lock     = threading.Lock()
+	def Get(self, id):
+		try:
+			id = int(id)
+		except (ValueError, TypeError):
+			return None
+		uid = self.sessions.get(id)
+		return None if uid is None else (id, uid)
+	def Create(self, uid):
+		with self.lock:
+			self.next_id += 1
+			self.sessions[self.next_id] = uid
+			return self.next_id
+	def Update(self, id, uid):
+		self.sessions[id] = uid
+		return id
+	def Delete(self, id):
+		self.sessions.pop(id, None)
+
+class SignedCookieBackend(object):
+	def __init__(self, secret, max_age):
+		if not secret:
+			raise ValueError('SignedCookieBackend needs a secret (conf.SESSION_SECRET)')
+		self.secret  = secret
+		self.max_age = max_age
+	def _sign(self, payload):
+		return base64.urlsafe_b64encode(hmac.new(self.secret, payload, hashlib.sha256).digest()).rstrip('=')
+	def Get(self, id):
+		if not isinstance(id, basestring):
+			return None
+		try:
+			id = str(id)
+		except UnicodeError:
+			return None
+		payload, dot, sig = id.rpartition('.')
+		if not dot or not hmac.compare_digest(self._sign(payload), sig):
+			return None
+		try:
+			uid, issued = [int(part) for part in payload.split('.')]
+		except ValueError:
+			return None
+		if issued + self.max_age < time.time():
+			return None
+		return id, uid
+	def Create(self, uid):
+		payload = '%d.%d'%(uid, time.time())
+		return payload+'.'+self._sign(payload)
+	def Update(self, id, uid):
+		return self.Create(uid)
+	def Delete(self, id):
+		pass
+
+def FromConf():
+	if conf.SESSION_BACKEND == 'sqlite':
+		return SqliteBackend(os.path.join(os.path.dirname(__file__), 'sessions.db'))
+	elif conf.SESSION_BACKEND == 'memory':
+		return MemoryBackend()
+	elif conf.SESSION_BACKEND == 'cookie':
+		return SignedCookieBackend(conf.SESSION_SECRET, conf.SESSION_MAX_AGE)
+	raise ValueError('Unknown session backend: %r'%(conf.SESSION_BACKEND,))
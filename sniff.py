@@ -0,0 +1,149 @@
+'''
+print -- CSLabs Print Server
+sniff -- Content Sniffing
+
+The extension of an uploaded file is chosen by the client, so it says little about what
+the file is; a renamed binary would otherwise be handed to soffice or lp and take up a
+worker until they give up on it. This module looks at the first conf.SNIFF_SIZE bytes
+of a file to find out what it really is, before anything is saved or converted.
+
+Content is classified into one of these kinds: "pdf", "ps", "pcl" (PCL or PJL printer
+data), "png", "jpeg", "gif", "zip" (which includes OOXML and OpenDocument files), "ole"
+(legacy Office files), "rtf", "text", "empty" and "binary". Each extension accepts some
+kinds (see ACCEPTS); extensions not listed there are source and text formats, which
+accept text, including PostScript and RTF source, and are always printed as text:
+
+	ext = Sniff(head, ext)
+
+returns the extension the file should be handled as, or raises Unprintable if its
+content does not match its extension. Files whose content can be printed directly (PDF,
+PostScript and images) are handled as what they are, so a PDF named .ps is spooled as a
+PDF; others keep their extension. SniffStream() and SniffFile() read the head of a
+stream (which is rewound) or of a file on disk.
+
+Every classification is recorded in the module's "stats" (a SniffStats), which counts
+accepted files and rejections by extension and kind.
+'''
+
+import sys
+import time
+import threading
+
+import conf
+
+IMAGE_KINDS = ('png', 'jpeg', 'gif')
+
+ACCEPTS = {
+	'pdf': ('pdf',),
+	'ps': ('ps', 'pdf'),
+	'prn': ('pcl', 'ps', 'pdf', 'text'),
+	'png': IMAGE_KINDS,
+	'jpg': IMAGE_KINDS,
+	'jpeg': IMAGE_KINDS,
+	'gif': IMAGE_KINDS,
+	'docx': ('zip',),
+	'pptx': ('zip',),
+	'xlsx': ('zip',),
+	'odt': ('zip',),
+	'odp': ('zip',),
+	'ods': ('zip',),
+	'odg': ('zip',),
+	'odf': ('zip',),
+	# Word, Excel and PowerPoint open either format whatever the extension says
+	'doc': ('ole', 'zip', 'rtf'),
+	'xls': ('ole', 'zip'),
+	'ppt': ('ole', 'zip'),
+	'rtf': ('rtf',),
+	'zip': ('zip',),
+}
+
+# Kinds accepted by the text extensions not listed in ACCEPTS
+TEXT_KINDS = ('text', 'ps', 'rtf')
+
+# Kinds that are handled as themselves, whatever the extension (among those it accepts)
+ROUTES = {'pdf': 'pdf', 'ps': 'ps', 'png': 'png', 'jpeg': 'jpg', 'gif': 'gif'}
+
+# Control characters that do not occur in text
+_BINARY_CHARS = set(chr(c) for c in range(32) if chr(c) not in '\t\n\r\f\b\x1b')
+
+class Unprintable(Exception):
+	def __init__(self, ext, kind):
+		if kind == 'empty':
+			msg = 'The file is empty'
+		else:
+			msg = 'The file does not look like a .%s file (its content is %s)'%(ext, kind)
+		Exception.__init__(self, msg)
+		self.ext  = ext
+		self.kind = kind
+
+class SniffStats(object):
+	def __init__(self):
+		self.accepted = 0
+		self.rejected = {}
+		self.elapsed  = 0.0
+		self.lock     = threading.Lock()
+	def Record(self, ext, kind, ok, elapsed):
+		with self.lock:
+			self.elapsed += elapsed
+			if ok:
+				self.accepted += 1
+			else:
+				self.rejected[ext, kind] = self.rejected.get((ext, kind), 0) + 1
+		if not ok:
+			sys.stderr.write('sniff: rejected .%s with %s content (%.0fus)\n'%(ext, kind, 1e6*elapsed))
+
+stats = SniffStats()
+
+def _is_text(head):
+	if '\0' in head:
+		return False
+	return sum(c in _BINARY_CHARS for c in head) * 20 < len(head)
+
+def classify(head):
+	if not head:
+		return 'empty'
+	if head.startswith('%!') or head.startswith('\x04%!') or head.startswith('\xc5\xd0\xd3\xc6'):
+		return 'ps'
+	if head.startswith('%PDF-'):
+		return 'pdf'
+	if head.startswith('\x89PNG\r\n\x1a\n'):
+		return 'png'
+	if head.startswith('\xff\xd8\xff'):
+		return 'jpeg'
+	if head.startswith('GIF87a') or head.startswith('GIF89a'):
+		return 'gif'
+	if head.startswith('PK\x03\x04') or head.startswith('PK\x05\x06'):
+		return 'zip'
+	if head.startswith('\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'):
+		return 'ole'
+	if head.startswith('{\\rtf'):
+		return 'rtf'
+	if head.startswith('\x1bE') or head.startswith('\x1b%-12345X'):
+		return 'pcl'
+	if _is_text(head):
+		return 'text'
+	return 'binary'
+
+def Sniff(head, ext):
+	start = time.time()
+	ext = ext.lower()
+	kind = classify(head)
+	if ext in ACCEPTS:
+		ok = kind in ACCEPTS[ext]
+		route = ROUTES.get(kind, ext)
+	else:
+		ok = kind in TEXT_KINDS
+		route = ext
+	stats.Record(ext, kind, ok, time.time() - start)
+	if not ok:
+		raise Unprintable(ext, kind)
+	return route
+
+def SniffStream(stream, ext):
+	head = stream.read(conf.SNIFF_SIZE)
+	stream.seek(0)
+	return Sniff(head, ext)
+
+def SniffFile(fname, ext):
+	with open(fname, 'rb') as f:
+		return Sniff(f.read(conf.SNIFF_SIZE), ext)
@@ -1 +1,106 @@
 // Print server client side libraries
+
+// Keeps the list with id listId up to date with the jobs from url: polled every interval
+// seconds, or as a stream of job status events if interval is 0. Watching stops once none
+// of the jobs is unfinished.
+function watchJobs(url, listId, interval) {
+	var list = document.getElementById(listId);
+	var items = {};
+	var states = {};
+	var version = 0;
+	var errors = 0;
+	function show(jobs) {
+		for (var i = 0; i < jobs.length; i++) {
+			var job = jobs[i];
+			var item = items[job.id];
+			if (!item) {
+				item = items[job.id] = document.createElement('li');
+				list.insertBefore(item, list.firstChild);
+			}
+			item.className = 'job job_' + job.state;
+			item.textContent = job.title + ': ' + job.state + (job.message ? ' (' + job.message + ')' : '');
+			states[job.id] = job.state;
+		}
+		if (jobs.length)
+			list.parentNode.style.display = '';
+	}
+	function unfinished() {
+		for (var id in states)
+			if (states[id] != 'done' && states[id] != 'failed')
+				return true;
+		return false;
+	}
+	function poll() {
+		var req = new XMLHttpRequest();
+		req.open('GET', url + '?since=' + version);
+		req.onload = function() {
+			if (req.status != 200) {
+				if (++errors < 10)
+					setTimeout(poll, 5000);
+				return;
+			}
+			var status = JSON.parse(req.responseText);
+			version = status.version;
+			show(status.jobs);
+			if (unfinished())
+				setTimeout(poll, interval * 1000);
+		};
+		req.onerror = function() {
+			if (++errors < 10)
+				setTimeout(poll, 5000);
+		};
+		req.send();
+	}
+	if (interval) {
+		poll();
+		return;
+	}
+	if (!window.EventSource)
+		return;
+	var source = new EventSource(url);
+	source.addEventListener('jobs', function(ev) {
+		show(JSON.parse(ev.data));
+		if (!unfinished())
+			source.close();
+	});
+}
+
+// Shows the page thumbnails listed by the preview status at url in the element with id
+// thumbsId as they are rendered, and the state of the preview in the element stateId
+function watchPreview(url, thumbsId, stateId) {
+	var thumbs = document.getElementById(thumbsId);
+	var state = document.getElementById(stateId);
+	var shown = {};
+	var tries = 0;
+	function poll() {
+		var req = new XMLHttpRequest();
+		req.open('GET', url);
+		req.onload = function() {
+			if (req.status != 200)
+				return;
+			var status = JSON.parse(req.responseText);
+			for (var i = 0; i < status.pages.length; i++) {
+				var page = status.pages[i];
+				if (shown[page.page])
+					continue;
+				var fig = shown[page.page] = document.createElement('figure');
+				fig.className = 'thumb';
+				var img = document.createElement('img');
+				img.src = page.url;
+				var caption = document.createElement('figcaption');
+				caption.textContent = 'Page ' + page.page;
+				fig.appendChild(img);
+				fig.appendChild(caption);
+				thumbs.appendChild(fig);
+			}
+			if (status.state == 'failed')
+				state.textContent = 'No preview is available for this file.';
+			else if (status.state == 'ready')
+				state.textContent = status.npages ? 'Preview (' + status.npages + ' pages):' : 'Preview:';
+			else if (++tries < 120)
+				setTimeout(poll, 1000);
+		};
+		req.send();
+	}
+	poll();
+}
@@ -1 +1 @@
-sudo uwsgi --master --http :80 --wsgi-file print.py --callable app
+sudo uwsgi --master --enable-threads --http :80 --wsgi-file print.py --callable app
@@ -0,0 +1,164 @@
+'''
+print -- CSLabs Print Server
+upload -- Resumable Uploads
+
+This module stores documents that are uploaded in numbered chunks, so that a client on a
+bad connection can resume an interrupted upload instead of starting again from zero.
+Uploads live in the spool directory (conf.SPOOL_DIR), one subdirectory per upload, holding:
+
+-"meta", the upload's owner, file name, size and declared SHA-256 digest,
+-"data.<ext>", the document itself, written in place at each chunk's offset, and
+-"chunks", the indices of the chunks received so far, one per line.
+
+The protocol, as driven by the print views, is:
+
+	upload = Upload.Create(user, filename, size, sha256)
+	upload.WriteChunk(index, stream)	# for each chunk, in any order, possibly repeated
+	upload.Received()			# indices of chunks stored so far
+	fname = upload.Finalize()		# verifies and returns the path of the document
+	...
+	upload.Delete()
+
+Chunk i covers bytes [i*chunk_size, (i+1)*chunk_size) of the document; every chunk but
+the last must be exactly chunk_size bytes long. Finalize() raises UploadError if any chunk
+is missing or the digest of the assembled data does not match the one declared at
+creation.
+
+A document that arrives whole (as from the print form) may also be kept as an upload, so
+that it can be printed later without being sent again (the print page does this to show
+a preview first). Upload.Store(user, filename, stream) saves it, computing its size and
+digest, and returns an upload that is complete and ready to be finalized.
+
+Uploads are found again with Upload.FromID(), which raises NoSuchUpload, and are removed
+by Upload.Expire() once they have not been written to for conf.UPLOAD_EXPIRY seconds.
+'''
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import binascii
+
+import conf
+
+class UploadError(Exception):
+	pass
+
+class NoSuchUpload(UploadError):
+	pass
+
+def _valid_id(id):
+	return len(id) == 32 and all(c in '0123456789abcdef' for c in id)
+
+class Upload(object):
+	def __init__(self, id, uid, filename, size, sha256, chunk_size):
+		self.id         = id
+		self.uid        = uid
+		self.filename   = filename
+		self.size       = size
+		self.sha256     = sha256
+		self.chunk_size = chunk_size
+	@property
+	def path(self):
+		return os.path.join(conf.SPOOL_DIR, self.id)
+	@property
+	def datapath(self):
+		# soffice and lp look at the extension, so the data file keeps it
+		ext = ''.join(c for c in self.filename.rpartition('.')[2] if c.isalnum())
+		return os.path.join(self.path, 'data.'+ext)
+	@property
+	def nchunks(self):
+		return max(1, (self.size + self.chunk_size - 1) // self.chunk_size)
+	@classmethod
+	def FromID(cls, id):
+		if not _valid_id(id):
+			raise NoSuchUpload(id)
+		try:
+			with open(os.path.join(conf.SPOOL_DIR, id, 'meta')) as f:
+				meta = json.load(f)
+		except (IOError, ValueError):
+			raise NoSuchUpload(id)
+		return cls(id, meta['uid'], meta['filename'], meta['size'], meta['sha256'], meta['chunk_size'])
+	@classmethod
+	def Create(cls, user, filename, size, sha256):
+		if size < 0 or size > conf.UPLOAD_MAX_SIZE:
+			raise UploadError('Bad upload size')
+		if len(sha256) != 64:
+			raise UploadError('Bad SHA-256 digest')
+		self = cls(binascii.hexlify(os.urandom(16)), getattr(user, 'id', user), filename, size, sha256.lower(), conf.UPLOAD_CHUNK_SIZE)
+		os.makedirs(self.path)
+		with open(self.datapath, 'wb') as f:
+			f.truncate(size)
+		open(os.path.join(self.path, 'chunks'), 'w').close()
+		self._write_meta()
+		return self
+	def _write_meta(self):
+		with open(os.path.join(self.path, 'meta'), 'w') as f:
+			json.dump({'uid': self.uid, 'filename': self.filename, 'size': self.size, 'sha256': self.sha256, 'chunk_size': self.chunk_size}, f)
+	@classmethod
+	def Store(cls, user, filename, stream):
+		self = cls.Create(user, filename, 0, '0'*64)
+		digest = hashlib.sha256()
+		size = 0
+		try:
+			with open(self.datapath, 'wb') as f:
+				for chunk in iter(lambda: stream.read(65536), ''):
+					size += len(chunk)
+					if size > conf.UPLOAD_MAX_SIZE:
+						raise UploadError('Bad upload size')
+					digest.update(chunk)
+					f.write(chunk)
+		except:
+			self.Delete()
+			raise
+		self.size = size
+		self.sha256 = digest.hexdigest()
+		with open(os.path.join(self.path, 'chunks'), 'w') as f:
+			f.writelines('%d\n'%(i,) for i in xrange(self.nchunks))
+		self._write_meta()
+		return self
+	def WriteChunk(self, index, stream):
+		if index < 0 or index >= self.nchunks:
+			raise UploadError('Bad chunk index')
+		length = min(self.chunk_size, self.size - index * self.chunk_size)
+		data = stream.read(length + 1)
+		if len(data) != length:
+			raise UploadError('Chunk %d must be %d bytes long'%(index, length))
+		with open(self.datapath, 'r+b') as f:
+			f.seek(index * self.chunk_size)
+			f.write(data)
+		with open(os.path.join(self.path, 'chunks'), 'a') as f:
+			f.write('%d\n'%(index,))
+	def Received(self):
+		with open(os.path.join(self.path, 'chunks')) as f:
+			return sorted(set(int(line) for line in f if line.strip()))
+	def Finalize(self):
+		missing = set(xrange(self.nchunks)) - set(self.Received())
+		if missing and self.size:
+			raise UploadError('Missing chunks: %s'%(', '.join(str(i) for i in sorted(missing)),))
+		fname = self.datapath
+		digest = hashlib.sha256()
+		with open(fname, 'rb') as f:
+			for chunk in iter(lambda: f.read(65536), ''):
+				digest.update(chunk)
+		if digest.hexdigest() != self.sha256:
+			raise UploadError('SHA-256 mismatch; the upload is corrupt')
+		return fname
+	def Delete(self):
+		shutil.rmtree(self.path, True)
+	@classmethod
+	def Expire(cls):
+		if not os.path.isdir(conf.SPOOL_DIR):
+			return
+		cutoff = time.time() - conf.UPLOAD_EXPIRY
+		for id in os.listdir(conf.SPOOL_DIR):
+			if not _valid_id(id):
+				continue
+			path = os.path.join(conf.SPOOL_DIR, id)
+			try:
+				mtime = os.path.getmtime(os.path.join(path, 'chunks'))
+			except OSError:
+				mtime = 0
+			if mtime < cutoff:
+				shutil.rmtree(path, True)
@@ -0,0 +1,150 @@
+'''
+print -- CSLabs Print Server
+usage -- Usage Rollups
+
+PyKota records every job in its "jobhistory" table, which only ever grows; answering a
+usage question from it (pages per user per day, the busiest hours, the volume of each
+printer) means scanning all of it. This module instead keeps aggregates of the history
+in (non-pykota) tables of the same database, which are updated incrementally:
+
+-"usage_daily" holds, per day, user and printer, the number of jobs, denied jobs, pages
+ (jobsize, which includes copies), bytes and the total price of the jobs;
+-"usage_hourly" holds the same, per hour and printer; and
+-"usage_watermark" holds the ID of the last history row that has been rolled up.
+
+	rollup.Refresh()
+
+rolls up the history rows added since the last refresh (in batches of conf.USAGE_BATCH
+rows, each in one transaction with the watermark, so that every row is counted exactly
+once, whichever process refreshes). Days and hours are local time. Denied jobs count
+toward jobs and denied, but not toward pages or price. History rows are assumed not to
+change once written; rows purged from the history afterwards stay counted.
+
+The reports read only the rollup tables, so their cost depends on the period asked for
+rather than the size of the history. Periods are given as (start, end) days, inclusive,
+as "YYYY-MM-DD" strings (see Period()):
+
+	rollup.Days(start, end, userid=None)	# per day, for everyone or one user
+	rollup.Users(start, end, limit)		# the users who printed the most pages
+	rollup.Printers(start, end)		# per printer
+	rollup.Hours(start, end)		# per hour of the day (00 to 23)
+
+Each returns a list of dicts with the keys "jobs", "denied", "pages", "bytes" and
+"price", and the key it is grouped by ("day", "userid" and "username", "printerid" and
+"printername", or "hour"). Stale() tells whether the last refresh in this process is
+older than conf.USAGE_REFRESH_INTERVAL seconds.
+'''
+
+import os
+import time
+import sqlite3
+import datetime
+import threading
+
+import conf
+
+_COLUMNS = ('jobs', 'denied', 'pages', 'bytes', 'price')
+
+_SCHEMA = (
+	'CREATE TABLE IF NOT EXISTS usage_watermark (name TEXT PRIMARY KEY, lastid INTEGER)',
+	'CREATE TABLE IF NOT EXISTS usage_daily (day TEXT, userid INTEGER, printerid INTEGER, jobs INTEGER, denied INTEGER, pages INTEGER, bytes INTEGER, price FLOAT, PRIMARY KEY (day, userid, printerid))',
+	'CREATE INDEX IF NOT EXISTS usage_daily_user ON usage_daily (userid, day)',
+	'CREATE TABLE IF NOT EXISTS usage_hourly (hour TEXT, printerid INTEGER, jobs INTEGER, denied INTEGER, pages INTEGER, bytes INTEGER, price FLOAT, PRIMARY KEY (hour, printerid))',
+	'INSERT OR IGNORE INTO usage_watermark (name, lastid) VALUES ("jobhistory", 0)',
+)
+
+# Sums of the columns selected from a rollup table
+_SUMS = ', '.join('SUM(%s)'%(col,) for col in _COLUMNS)
+
+def Period(days, end=None):
+	'''Returns the (start, end) days of the period of the given number of days ending on end (today by default).'''
+	end = end or datetime.date.today()
+	return (end - datetime.timedelta(days=days-1)).isoformat(), end.isoformat()
+
+def _add(table, key, values):
+	sums = table.get(key)
+	if sums is None:
+		table[key] = list(values)
+	else:
+		for i, v in enumerate(values):
+			sums[i] += v
+
+def _totals(key, rows):
+	return [dict(zip(key+_COLUMNS, row)) for row in rows]
+
+class UsageRollup(object):
+	def __init__(self, path):
+		# Transactions are begun explicitly (see Refresh)
+		self.db        = sqlite3.connect(path, check_same_thread = False, isolation_level = None)
+		self.lock      = threading.Lock()
+		self.ready     = False
+		self.refreshed = None
+	def _setup(self):
+		if not self.ready:
+			for sql in _SCHEMA:
+				self.db.execute(sql)
+			self.ready = True
+	def Stale(self):
+		return self.refreshed is None or self.refreshed + conf.USAGE_REFRESH_INTERVAL < time.time()
+	def Refresh(self, max_rows=None):
+		'''Rolls up new history rows (at most max_rows, if given); returns the number rolled up.'''
+		with self.lock:
+			self._setup()
+			total = 0
+			while max_rows is None or total < max_rows:
+				batch = conf.USAGE_BATCH if max_rows is None else min(conf.USAGE_BATCH, max_rows - total)
+				count = self._step(batch)
+				total += count
+				if count < batch:
+					break
+			self.refreshed = time.time()
+			return total
+	def _step(self, batch):
+		# IMMEDIATE takes the write lock before the watermark is read, so that two
+		# processes cannot roll up the same rows
+		self.db.execute('BEGIN IMMEDIATE')
+		try:
+			lastid = self.db.execute('SELECT lastid FROM usage_watermark WHERE name="jobhistory"').fetchone()[0]
+			rows = self.db.execute('SELECT id, userid, printerid, action, jobsize, jobsizebytes, jobprice, strftime("%Y-%m-%d %H", COALESCE(jobdate, CURRENT_TIMESTAMP), "localtime") FROM jobhistory WHERE id>? ORDER BY id LIMIT ?', (lastid, batch)).fetchall()
+			if not rows:
+				self.db.execute('COMMIT')
+				return 0
+			daily = {}
+			hourly = {}
+			for id, userid, printerid, action, size, nbytes, price, hour in rows:
+				if action == 'DENY':
+					values = (1, 1, 0, nbytes or 0, 0.0)
+				else:
+					values = (1, 0, size or 0, nbytes or 0, price or 0.0)
+				_add(daily, (hour[:10], userid, printerid), values)
+				_add(hourly, (hour, printerid), values)
+			self.db.executemany('INSERT OR IGNORE INTO usage_daily (day, userid, printerid, jobs, denied, pages, bytes, price) VALUES (?, ?, ?, 0, 0, 0, 0, 0.0)', daily.keys())
+			self.db.executemany('UPDATE usage_daily SET jobs=jobs+?, denied=denied+?, pages=pages+?, bytes=bytes+?, price=price+? WHERE day=? AND userid IS ? AND printerid IS ?', [tuple(v)+k for k, v in daily.iteritems()])
+			self.db.executemany('INSERT OR IGNORE INTO usage_hourly (hour, printerid, jobs, denied, pages, bytes, price) VALUES (?, ?, 0, 0, 0, 0, 0.0)', hourly.keys())
+			self.db.executemany('UPDATE usage_hourly SET jobs=jobs+?, denied=denied+?, pages=pages+?, bytes=bytes+?, price=price+? WHERE hour=? AND printerid IS ?', [tuple(v)+k for k, v in hourly.iteritems()])
+			self.db.execute('UPDATE usage_watermark SET lastid=? WHERE name="jobhistory"', (rows[-1][0],))
+			self.db.execute('COMMIT')
+		except:
+			self.db.execute('ROLLBACK')
+			raise
+		return len(rows)
+	def Watermark(self):
+		with self.lock:
+			self._setup()
+			return self.db.execute('SELECT lastid FROM usage_watermark WHERE name="jobhistory"').fetchone()[0]
+	def _query(self, key, sql, args):
+		with self.lock:
+			self._setup()
+			return _totals(key, self.db.execute(sql, args).fetchall())
+	def Days(self, start, end, userid=None):
+		if userid is None:
+			return self._query(('day',), 'SELECT day, %s FROM usage_daily WHERE day BETWEEN ? AND ? GROUP BY day ORDER BY day'%(_SUMS,), (start, end))
+		return self._query(('day',), 'SELECT day, %s FROM usage_daily WHERE userid=? AND day BETWEEN ? AND ? GROUP BY day ORDER BY day'%(_SUMS,), (userid, start, end))
+	def Users(self, start, end, limit):
+		return self._query(('userid', 'username'), 'SELECT d.userid, u.username, %s FROM usage_daily AS d LEFT JOIN users AS u ON u.id=d.userid WHERE d.day BETWEEN ? AND ? GROUP BY d.userid ORDER BY SUM(d.pages) DESC LIMIT ?'%(_SUMS,), (start, end, limit))
+	def Printers(self, start, end):
+		return self._query(('printerid', 'printername'), 'SELECT d.printerid, p.printername, %s FROM usage_daily AS d LEFT JOIN printers AS p ON p.id=d.printerid WHERE d.day BETWEEN ? AND ? GROUP BY d.printerid ORDER BY SUM(d.pages) DESC'%(_SUMS,), (start, end))
+	def Hours(self, start, end):
+		return self._query(('hour',), 'SELECT substr(hour, 12, 2) AS h, %s FROM usage_hourly WHERE hour BETWEEN ? AND ? GROUP BY h ORDER BY h'%(_SUMS,), (start+' 00', end+' 23'))
+
+rollup = UsageRollup(os.path.join(os.path.dirname(__file__), 'pykota.db'))
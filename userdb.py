@@ -93,7 +93,8 @@ A group may be queried for its users:
 In this case, users will be a list of:
 -User objects, if the users could be found in the database, and
 -user IDs, as integers, if those IDs don't correspond to users in the database.
-The former case is most likely.
+The former case is most likely. The members are read with a single query (joining the
+membership table to the users table), however many there are.
 
 Similarly, a user can be queried for its groups:
 
@@ -113,6 +114,41 @@ These calls do *not* require calls to .Update(); they will update the database a
 .Update() does explicitly). All four calls may also accept a group or user ID in place of
 a Group or User, respectively.
 
+To change many memberships at once (such as enrolling a class), use:
+
+	added = group.AddUsers(users)
+	removed = group.RemoveUsers(users)
+
+which take a list of Users or user IDs, apply the whole list in one transaction, and return
+the number of memberships actually added (users already in the group are left alone) or
+removed. User.FromNames(names) finds the users with any of the given names in a few queries;
+names without a user are simply absent from the result; User.FromIDs(ids) does the same
+for user IDs.
+
+For bulk work, User.Iter() yields every user in turn from its own cursor (unlike
+User.All(), it does not build a list), and User.BulkImport() creates (and, with
+update=True, updates) many users in a single transaction:
+
+	created, updated, skipped = User.BulkImport(rows, update=True)
+
+Each row is a dict with some of the keys in User.IMPORT_FIELDS ("username" is required);
+missing values default as in User.Create() for new users and are left unchanged for
+existing ones. Existing users are skipped (and their names returned) unless update is
+set. With dry_run=True, nothing is written; only the counts are returned. An optional progress
+callable is called as progress(done, total) as rows are written.
+
+Normally every change is committed as soon as it is made. Changes made inside a
+Transaction are instead committed together when the outermost Transaction ends, or all
+rolled back if it ends with an exception:
+
+	with Transaction():
+		for user in users:
+			user.balance = 0
+			user.Update()
+
+As the database connection is shared by the whole process, Transactions are meant for
+single-threaded tools such as the console, not for the web application.
+
 Finally, both users and groups can be deleted by using the .Delete() method:
 
 	user.Delete()
@@ -184,13 +220,52 @@ The root user (User.ROOT) has a special-cased AccessToken (actually a GrantAllAc
 that grants that user all privileges in the system. However, the root user, by default, has
 no password. Use this account with care; the system will not prevent it from doing anything,
 even harmful things!
+
+AccessTokens answer for one user at a time. The reverse question, which users have a given
+access, is answered by the module's "access_index" (an AccessIndex), which holds the effective
+access of every user, computed by the same rules as above:
+
+	uids = access_index.Who('color-printer')	# sorted user IDs, always including root
+	users = access_index.Users('color-printer')	# the same, as User objects
+	access_index.Accesses()				# every access string mentioned in an entry
+
+The index is read from the database once, on first use, and then kept up to date as entries,
+memberships and groups are changed through this module. Changes made by other processes are
+noticed (through sqlite's data_version) and cause the index to be read again on its next use;
+access_index.Invalidate() forces that.
+
+Similarly, the module's "name_index" (a NameIndex) keeps every username and email in
+sorted lists, to find users by prefix without reading the users table:
+
+	ids = name_index.Prefix('doe')			# sorted IDs of the users whose names start so
+	ids = name_index.Prefix('doe@', 'email')	# or whose emails do
+	ids = name_index.Equal('doe')			# or whose names are exactly that
+	names = name_index.Complete('do', limit=20)	# the distinct names starting so, in order
+
+It is kept up to date by User.Create(), .Update() and .Delete(). When another process
+commits, only the users added since (by rowid) are read, unless users were deleted, in
+which case the index is read again; a user renamed by another process is not noticed
+until name_index.Invalidate() (the web application does not rename users).
 '''
 
 import sqlite3
+import threading
+import bisect
 import os
 
 db = sqlite3.connect(os.path.join(os.path.dirname(__file__), 'pykota.db'), check_same_thread = False)
-cur = db.cursor()
+
+# A cursor runs one statement at a time, and requests may be served on several threads at
+# once (uwsgi --threads), so each thread gets a cursor of its own on the shared connection
+class _ThreadCursor(threading.local):
+	def __init__(self):
+		self.cursor = db.cursor()
+	def __getattr__(self, name):
+		return getattr(self.cursor, name)
+	def __iter__(self):
+		return iter(self.cursor)
+
+cur = _ThreadCursor()
 
 class DBError(Exception):
 	pass
@@ -201,6 +276,50 @@ class NoSuchEntity(DBError):
 class TooManyEntities(DBError):
 	pass
 
+# Depth of nested Transactions; while nonzero, changes are not committed
+_transaction_depth = 0
+
+def _commit():
+	if not _transaction_depth:
+		db.commit()
+
+def _rollback():
+	if not _transaction_depth:
+		db.rollback()
+		access_index.Invalidate()
+		name_index.Invalidate()
+
+class Transaction(object):
+	def __enter__(self):
+		global _transaction_depth
+		_transaction_depth += 1
+		return self
+	def __exit__(self, tp, value, tb):
+		global _transaction_depth
+		_transaction_depth -= 1
+		if not _transaction_depth:
+			if tp is None:
+				db.commit()
+			else:
+				db.rollback()
+				access_index.Invalidate()
+				name_index.Invalidate()
+		return False
+
+# Converts a list of entities (of class cls) or IDs into a list of IDs
+def _ids(objs, cls):
+	return [obj.id if isinstance(obj, cls) else obj for obj in objs]
+
+# Runs a query whose "IN (%s)" takes a list of values, in chunks well below sqlite's
+# limit on the number of parameters; returns all of the rows
+def _select_in(sql, values):
+	values = list(values)
+	rows = []
+	for i in xrange(0, len(values), 500):
+		chunk = values[i:i+500]
+		rows.extend(cur.execute(sql%(','.join('?'*len(chunk)),), chunk).fetchall())
+	return rows
+
 def _instantiate(cls, rows, attrib, val, mult=False):
 	if not rows:
 		raise NoSuchEntity(cls, attrib, val)
@@ -234,18 +353,21 @@ class AccessEntry(object):
 		if isinstance(user, User):
 			user = user.id
 		cur.execute('INSERT INTO acls (type, id, access, revoke, level) VALUES ("user", ?, ?, ?, ?)', (user, access, revoke, level))
-		db.commit()
+		_commit()
+		access_index._acl_changed('user', user)
 		return cls('user', user, access, revoke, level)
 	@classmethod
 	def CreateGroup(cls, group, access, revoke=0, level=0):
 		if isinstance(group, Group):
 			group = group.id
 		cur.execute('INSERT INTO acls (type, id, access, revoke, level) VALUES ("group", ?, ?, ?, ?)', (group, access, revoke, level))
-		db.commit()
+		_commit()
+		access_index._acl_changed('group', group)
 		return cls('group', group, access, revoke, level)
 	def Delete(self):
 		cur.execute('DELETE FROM acls WHERE type=? AND id=? AND access=? AND revoke=? AND level=?', (self.type, self.id, self.access, self.revoke, self.level))
-		db.commit()
+		_commit()
+		access_index._acl_changed(self.type, self.id)
 
 class AccessToken(object):
 	def __init__(self):
@@ -319,34 +441,56 @@ class Group(object):
 		if isinstance(inherit, Group):
 			inherit = inherit.id
 		cur.execute('INSERT INTO acgroups (name, inherit) VALUES (?, ?)', (name, inherit))
-		db.commit()
+		_commit()
+		access_index._group_changed(cur.lastrowid, inherit)
 		return cls(cur.lastrowid, name, inherit)
 	def Update(self):
-		cur.execute('UPDATE acgroups SET name=?, inherit=? WHERE id=?', (self.name, self.inherit.id if isinstance(self.inherit, Group) else self.inherit, self.id))
-		db.commit()
+		inherit = self.inherit.id if isinstance(self.inherit, Group) else self.inherit
+		cur.execute('UPDATE acgroups SET name=?, inherit=? WHERE id=?', (self.name, inherit, self.id))
+		_commit()
+		access_index._group_changed(self.id, inherit)
 	def Delete(self):
 		cur.execute('DELETE FROM acmembership WHERE gid=?', (self.id,))
 		cur.execute('DELETE FROM acgroups WHERE id=?', (self.id,))
-		db.commit()
+		_commit()
+		access_index._group_changed(self.id, None, True)
 	def Users(self):
-		cur.execute('SELECT uid FROM acmembership WHERE gid=?', (self.id,))
-		res = []
-		for row in cur:
-			try:
-				res.append(User.FromID(row[0]))
-			except DBError:
-				res.append(row[0])
-		return res
+		cur.execute('SELECT m.uid, u.id, u.username, u.password, u.email, u.balance, u.overcharge, u.vcode, u.status FROM acmembership m LEFT JOIN users u ON u.id=m.uid WHERE m.gid=?', (self.id,))
+		return [row[0] if row[1] is None else User(*row[1:]) for row in cur.fetchall()]
 	def AddUser(self, user):
 		if isinstance(user, User):
 			user = user.id
 		cur.execute('INSERT INTO acmembership (gid, uid) VALUES (?, ?)', (self.id, user))
-		db.commit()
+		_commit()
+		access_index._members_changed(self.id, [user], True)
 	def RemoveUser(self, user):
 		if isinstance(user, User):
 			user = user.id
 		cur.execute('DELETE FROM acmembership WHERE gid=? AND uid=?', (self.id, user))
-		db.commit()
+		_commit()
+		access_index._members_changed(self.id, [user], False)
+	def AddUsers(self, users):
+		present = set(row[0] for row in cur.execute('SELECT uid FROM acmembership WHERE gid=?', (self.id,)).fetchall())
+		new = sorted(set(_ids(users, User)) - present)
+		try:
+			cur.executemany('INSERT INTO acmembership (gid, uid) VALUES (?, ?)', [(self.id, uid) for uid in new])
+		except Exception:
+			_rollback()
+			raise
+		_commit()
+		access_index._members_changed(self.id, new, True)
+		return len(new)
+	def RemoveUsers(self, users):
+		uids = set(_ids(users, User))
+		try:
+			cur.executemany('DELETE FROM acmembership WHERE gid=? AND uid=?', [(self.id, uid) for uid in uids])
+			removed = cur.rowcount
+		except Exception:
+			_rollback()
+			raise
+		_commit()
+		access_index._members_changed(self.id, uids, False)
+		return removed
 	def AccessToken(self):
 		return AccessToken.FromGroup(self)
 
@@ -357,6 +501,7 @@ class User(object):
 	ST_DISABLED = 1
 	ST_UNVERIFIED = 2
 	ST_PWRESET = 3
+	IMPORT_FIELDS = ('username', 'password', 'email', 'balance', 'overcharge', 'vcode', 'status')
 	def __init__(self, id, username, password, email, balance, overcharge, vcode, status):
 		self.id         = id
 		self.username   = username
@@ -373,6 +518,46 @@ class User(object):
 			ret.append(cls(*row))
 		return ret
 	@classmethod
+	def Iter(cls):
+		# Uses its own cursor, so that other queries may run while iterating
+		icur = db.cursor()
+		for row in icur.execute('SELECT id, username, password, email, balance, overcharge, vcode, status FROM users ORDER BY id'):
+			yield cls(*row)
+	@classmethod
+	def BulkImport(cls, rows, update=False, dry_run=False, progress=None):
+		existing = dict(cur.execute('SELECT username, id FROM users').fetchall())
+		inserts, updates, skipped = [], [], []
+		for row in rows:
+			values = tuple(row.get(field) for field in cls.IMPORT_FIELDS)
+			if row['username'] in existing:
+				if update:
+					updates.append(values[1:]+(existing[row['username']],))
+				else:
+					skipped.append(row['username'])
+			else:
+				existing[row['username']] = None
+				inserts.append((values[0], values[1] or '', values[2], values[3] or 0, 1 if values[4] is None else values[4], values[5], values[6] or cls.ST_NORMAL))
+		if dry_run:
+			return len(inserts), len(updates), skipped
+		done = [0]
+		def counted(seq):
+			for item in seq:
+				yield item
+				done[0] += 1
+				if progress is not None and done[0] % 500 == 0:
+					progress(done[0], len(inserts)+len(updates))
+		try:
+			cur.executemany('INSERT INTO users (username, password, email, limitby, balance, overcharge, vcode, status) VALUES (?, ?, ?, "balance", ?, ?, ?, ?)', counted(inserts))
+			cur.executemany('UPDATE users SET password=COALESCE(?, password), email=COALESCE(?, email), balance=COALESCE(?, balance), overcharge=COALESCE(?, overcharge), vcode=COALESCE(?, vcode), status=COALESCE(?, status) WHERE id=?', counted(updates))
+		except Exception:
+			_rollback()
+			raise
+		if progress is not None:
+			progress(len(inserts)+len(updates), len(inserts)+len(updates))
+		_commit()
+		name_index.Invalidate()
+		return len(inserts), len(updates), skipped
+	@classmethod
 	def FromID(cls, id):
 		cur.execute('SELECT id, username, password, email, balance, overcharge, vcode, status FROM users WHERE id = ?', (id,))
 		return _instantiate(cls, cur.fetchall(), 'id', id)
@@ -381,46 +566,267 @@ class User(object):
 		cur.execute('SELECT id, username, password, email, balance, overcharge, vcode, status FROM users WHERE username = ?', (name,))
 		return _instantiate(cls, cur.fetchall(), 'name', name)
 	@classmethod
+	def FromNames(cls, names):
+		return [cls(*row) for row in _select_in('SELECT id, username, password, email, balance, overcharge, vcode, status FROM users WHERE username IN (%s)', set(names))]
+	@classmethod
+	def FromIDs(cls, ids):
+		return [cls(*row) for row in _select_in('SELECT id, username, password, email, balance, overcharge, vcode, status FROM users WHERE id IN (%s) ORDER BY id', set(ids))]
+	@classmethod
 	def FromEmail(cls, email, mult=False):
 		cur.execute('SELECT id, username, password, email, balance, overcharge, vcode, status FROM users WHERE email = ?', (email,))
 		return _instantiate(cls, cur.fetchall(), 'email', email, mult)
 	@classmethod
 	def Create(cls, username, password, email, balance, overcharge=1, vcode=None, status=ST_NORMAL):
 		cur.execute('INSERT INTO users (username, password, email, limitby, balance, overcharge, vcode, status) VALUES(?, ?, ?, "balance", ?, ?, ?, ?)', (username, password, email, balance, overcharge, vcode, status))
-		db.commit()
+		_commit()
+		name_index._user_changed(cur.lastrowid, username, email)
 		return cls(cur.lastrowid, username, password, email, balance, overcharge, vcode, status)
 	def Update(self):
 		cur.execute('UPDATE users SET username=?, password=?, email=?, balance=?, overcharge=? , vcode=? , status=? WHERE id=?', (self.username, self.password, self.email, self.balance, self.overcharge, self.vcode, self.status, self.id))		
-		db.commit()
+		_commit()
+		name_index._user_changed(self.id, self.username, self.email)
 	def Delete(self):
 		cur.execute('DELETE FROM acmembership WHERE uid=?', (self.id,))
 		cur.execute('DELETE FROM users WHERE id=?', (self.id,))
-		db.commit()
+		_commit()
+		access_index._user_deleted(self.id)
+		name_index._user_deleted(self.id)
 	def Groups(self):
-		cur.execute('SELECT gid FROM acmembership WHERE uid=?', (self.id,))
-		res = []
-		for row in cur:
-			try:
-				res.append(Group.FromID(row[0]))
-			except DBError:
-				res.append(row[0])
-		return res
+		cur.execute('SELECT m.gid, g.id, g.name, g.inherit FROM acmembership m LEFT JOIN acgroups g ON g.id=m.gid WHERE m.uid=?', (self.id,))
+		return [row[0] if row[1] is None else Group(*row[1:]) for row in cur.fetchall()]
 	def AddToGroup(self, group):
 		if isinstance(group, Group):
 			group = group.id
 		cur.execute('INSERT INTO acmembership (gid, uid) VALUES (?, ?)', (group, self.id))
-		db.commit()
+		_commit()
+		access_index._members_changed(group, [self.id], True)
 	def RemoveFromGroup(self, group):
 		if isinstance(group, Group):
 			group = group.id
-		cur.execute('REMOVE FROM acmembership WHERE gid=? AND uid=?', (group, self.id))
-		db.commit()
+		cur.execute('DELETE FROM acmembership WHERE gid=? AND uid=?', (group, self.id))
+		_commit()
+		access_index._members_changed(group, [self.id], False)
 	def AccessToken(self):
 		# XXX Special casing (also see below)
 		if self.id == self.ID_ROOT:
 			return GrantAllAccessToken()
 		return AccessToken.FromUser(self)
 
+# Sort key of an AccessEntry in AccessToken.Optimize; the largest key decides
+def _access_key(level, revoke):
+	return level*2+(1 if revoke else 0)
+
+class AccessIndex(object):
+	def __init__(self):
+		self.built   = False
+		self.version = None
+		self.lock    = threading.RLock()
+	def Invalidate(self):
+		self.built = False
+	def _refresh(self):
+		# sqlite3 commits before running a PRAGMA, which must not happen inside a Transaction:
+		# there, a built index is used as it is, and one that is not is built without a
+		# version (so that it is checked again after the Transaction)
+		if _transaction_depth:
+			if self.built:
+				return
+			version = None
+		else:
+			row = cur.execute('PRAGMA data_version').fetchone()
+			version = row[0] if row else None
+		# data_version only changes with commits from other connections; ours are tracked below
+		if self.built and version == self.version:
+			return
+		self.version    = version
+		self.user_acls  = {}
+		self.group_acls = {}
+		for type, id, access, revoke, level in cur.execute('SELECT type, id, access, revoke, level FROM acls').fetchall():
+			acls = (self.user_acls if type == 'user' else self.group_acls).setdefault(id, {})
+			acls[access] = max(acls.get(access, -1), _access_key(level, revoke))
+		self.inherit = dict(cur.execute('SELECT id, inherit FROM acgroups').fetchall())
+		self.members = {}
+		for gid, uid in cur.execute('SELECT gid, uid FROM acmembership').fetchall():
+			self.members.setdefault(uid, set()).add(gid)
+		self.effective = {}
+		self.granted   = {}
+		for uid in set(self.user_acls) | set(self.members):
+			self._compute(uid)
+		self.built = True
+	def _chain(self, gid):
+		chain = []
+		while gid and gid not in chain:
+			chain.append(gid)
+			gid = self.inherit.get(gid)
+		return chain
+	def _compute(self, uid):
+		for access, key in self.effective.pop(uid, {}).iteritems():
+			if not key % 2:
+				self.granted[access].discard(uid)
+		eff = dict(self.user_acls.get(uid, {}))
+		for gid in self.members.get(uid, ()):
+			for g in self._chain(gid):
+				for access, key in self.group_acls.get(g, {}).iteritems():
+					if key > eff.get(access, -1):
+						eff[access] = key
+		if eff:
+			self.effective[uid] = eff
+		for access, key in eff.iteritems():
+			if not key % 2:
+				self.granted.setdefault(access, set()).add(uid)
+	def _users_under(self, gid):
+		groups = set(g for g in set(self.inherit) | set([gid]) if gid in self._chain(g))
+		return [uid for uid, gids in self.members.iteritems() if gids & groups]
+	def _acl_changed(self, type, id):
+		with self.lock:
+			if not self.built:
+				return
+			acls = {}
+			for access, revoke, level in cur.execute('SELECT access, revoke, level FROM acls WHERE type=? AND id=?', (type, id)).fetchall():
+				acls[access] = max(acls.get(access, -1), _access_key(level, revoke))
+			if type == 'user':
+				self.user_acls[id] = acls
+				self._compute(id)
+			else:
+				self.group_acls[id] = acls
+				for uid in self._users_under(id):
+					self._compute(uid)
+	def _group_changed(self, gid, inherit, deleted=False):
+		with self.lock:
+			if not self.built:
+				return
+			affected = self._users_under(gid)
+			if deleted:
+				self.inherit.pop(gid, None)
+				for uid in affected:
+					self.members.get(uid, set()).discard(gid)
+			else:
+				self.inherit[gid] = inherit
+			for uid in affected:
+				self._compute(uid)
+	def _members_changed(self, gid, uids, added):
+		with self.lock:
+			if not self.built:
+				return
+			for uid in uids:
+				if added:
+					self.members.setdefault(uid, set()).add(gid)
+				else:
+					self.members.get(uid, set()).discard(gid)
+				self._compute(uid)
+	def _user_deleted(self, uid):
+		with self.lock:
+			if not self.built:
+				return
+			self.members.pop(uid, None)
+			self._compute(uid)
+	def Who(self, access):
+		with self.lock:
+			self._refresh()
+			return sorted(self.granted.get(access, set()) | set([User.ID_ROOT]))
+	def Users(self, access):
+		return User.FromIDs(self.Who(access))
+	def Accesses(self):
+		with self.lock:
+			self._refresh()
+			return sorted(set(access for acls in self.user_acls.values()+self.group_acls.values() for access in acls))
+
+access_index = AccessIndex()
+
+class NameIndex(object):
+	FIELDS = ('username', 'email')
+	def __init__(self):
+		self.built   = False
+		self.version = None
+		self.lock    = threading.RLock()
+	def Invalidate(self):
+		self.built = False
+	def _refresh(self):
+		# As for AccessIndex: no PRAGMA inside a Transaction
+		if _transaction_depth:
+			if self.built:
+				return
+			version = None
+		else:
+			row = cur.execute('PRAGMA data_version').fetchone()
+			version = row[0] if row else None
+		if self.built and version == self.version:
+			return
+		if self.built:
+			# Other processes add users (registrations) but do not rename them; new users
+			# are read by rowid, and a deletion (a count that does not add up) reloads all
+			rows = cur.execute('SELECT id, username, email FROM users WHERE id>?', (self.max_id,)).fetchall()
+			for id, username, email in rows:
+				self._add(id, username, email)
+			if cur.execute('SELECT COUNT(*) FROM users').fetchone()[0] != len(self.users):
+				self.built = False
+		if not self.built:
+			self.users = {}
+			self.sorted = {'username': [], 'email': []}
+			self.max_id = 0
+			for id, username, email in cur.execute('SELECT id, username, email FROM users').fetchall():
+				self.users[id] = (username, email)
+				self.max_id = max(self.max_id, id)
+				for field, value in zip(self.FIELDS, (username, email)):
+					if value is not None:
+						self.sorted[field].append((value, id))
+			for values in self.sorted.itervalues():
+				values.sort()
+			self.built = True
+		self.version = version
+	def _add(self, id, username, email):
+		# As read back from sqlite, so that the lists sort consistently
+		username, email = [value.decode('utf-8') if isinstance(value, str) else value for value in (username, email)]
+		self.users[id] = (username, email)
+		self.max_id = max(self.max_id, id)
+		for field, value in zip(self.FIELDS, (username, email)):
+			if value is not None:
+				bisect.insort(self.sorted[field], (value, id))
+	def _remove(self, id):
+		for field, value in zip(self.FIELDS, self.users.pop(id, (None, None))):
+			if value is not None:
+				values = self.sorted[field]
+				i = bisect.bisect_left(values, (value, id))
+				if i < len(values) and values[i] == (value, id):
+					del values[i]
+	def _user_changed(self, id, username, email):
+		with self.lock:
+			if not self.built or self.users.get(id) == (username, email):
+				return
+			self._remove(id)
+			self._add(id, username, email)
+	def _user_deleted(self, id):
+		with self.lock:
+			if self.built:
+				self._remove(id)
+	def _range(self, prefix, field):
+		if isinstance(prefix, str):
+			prefix = prefix.decode('utf-8')
+		values = self.sorted[field]
+		i = bisect.bisect_left(values, (prefix,))
+		while i < len(values) and values[i][0].startswith(prefix):
+			yield values[i]
+			i += 1
+	def Prefix(self, prefix, field='username'):
+		with self.lock:
+			self._refresh()
+			return sorted(id for value, id in self._range(prefix, field))
+	def Equal(self, value, field='username'):
+		with self.lock:
+			self._refresh()
+			return sorted(id for v, id in self._range(value, field) if v == value)
+	def Complete(self, prefix, field='username', limit=None):
+		with self.lock:
+			self._refresh()
+			ret = []
+			for value, id in self._range(prefix, field):
+				if not ret or ret[-1] != value:
+					if limit is not None and len(ret) >= limit:
+						break
+					ret.append(value)
+			return ret
+
+name_index = NameIndex()
+
 # Constants--do not touch
 
 User.ROOT   = User.FromID(User.ID_ROOT)